@@ -0,0 +1,99 @@
+"""
+==============
+bench_cold_start.py
+==============
+
+Cold start cost of the API Lambda: the time to import fts_controller in a
+fresh interpreter, as the Lambda runtime does on a new instance, and the
+imports taking the most of it. Fails if the median import time exceeds the
+budget, or if a module which must only be imported on first use (boto3,
+shapely, numpy) is imported at init.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_cold_start [--repeat 5] [--budget-ms 750] [--top 10]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+MODULE = 'fts.api.controllers.fts_controller'
+# Imported on first use only; their import at init is a cold start regression
+LAZY_MODULES = ('boto3', 'botocore', 'shapely', 'numpy', 'redis', 'pymemcache')
+# Database settings of the import, without an SSM parameter or a reachable host
+ENVIRON = {'DB_HOST': 'bench', 'DB_NAME': 'bench', 'DB_USERNAME': 'bench', 'DB_PASSWORD': 'bench',
+           'DB_PASSWORD_SSM_NAME': 'bench'}
+
+IMPORT_SCRIPT = (
+    "import json, sys, time\n"
+    "started = time.perf_counter()\n"
+    f"import {MODULE}\n"
+    "print(json.dumps({'ms': (time.perf_counter() - started) * 1000, 'modules': sorted(sys.modules)}))\n"
+)
+
+
+def measure_import():
+    """
+    Import the controller in a fresh interpreter.
+
+    Returns
+    -------
+    dict
+        Import time in ms, the imported modules, and the cumulative import
+        time in us of each module the controller imports
+    """
+    env = dict(os.environ, **ENVIRON)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', IMPORT_SCRIPT], env=env,
+                            capture_output=True, text=True, check=True)
+    measured = json.loads(result.stdout.splitlines()[-1])
+
+    # Modules are listed after the modules they import, nested ones indented
+    # by two spaces per level
+    imports, children = {}, {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            if name.strip() == MODULE:
+                imports = children
+            children = {}
+        elif not name.startswith('    '):
+            children[name.strip()] = int(cumulative)
+    measured['imports'] = imports
+    return measured
+
+
+def main():
+    """Print the import times and exit 1 when the budget is exceeded"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=750)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [measure_import() for _ in range(args.repeat)]
+    times = [run['ms'] for run in runs]
+    median = statistics.median(times)
+    print(f"import {MODULE}: median {median:.1f} ms, min {min(times):.1f} ms, max {max(times):.1f} ms")
+    print("slowest imports of the controller (cumulative ms):")
+    for name, cumulative in sorted(runs[-1]['imports'].items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {cumulative / 1000:8.1f}  {name}")
+
+    eager = [name for name in LAZY_MODULES if name in runs[-1]['modules']]
+    failed = False
+    if eager:
+        print(f"FAIL: imported at init: {', '.join(eager)}")
+        failed = True
+    if median > args.budget_ms:
+        print(f"FAIL: median import time {median:.1f} ms exceeds the {args.budget_ms:.0f} ms budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+==============
+bench_compression.py
+==============
+
+Benchmark of response compression: serves full pages of HUC, reach and
+river name requests from a snapshot written by benchmarks/synthetic_data.py,
+then compresses each body with gzip and, when the brotli module is
+installed, brotli at a range of levels. Reports the CPU time each level
+takes, the bytes it saves and the level fts.api.controllers.compression
+picks for the body, so that the level tables can be checked against the
+time a smaller response saves on the wire.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_compression --snapshot bench.sqlite [--page-size 1000] [--repeat 5]
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+
+GZIP_LEVELS = (1, 4, 6, 9)
+BROTLI_LEVELS = (1, 3, 5, 8, 11)
+
+
+def page_events(manifest, page_size, rng):
+    """
+    Build the events of the pages to compress.
+
+    Parameters
+    ----------
+    manifest : dict
+        Keys to query
+    page_size : int
+        Results per page
+    rng : random.Random
+        Random number generator
+
+    Returns
+    -------
+    list
+        (name, event) pairs
+    """
+    body = {'exact': 'false', 'page_number': '1', 'page_size': str(page_size)}
+    return [
+        ('huc', {'body': dict(body, HUC=rng.choice(manifest['hucs'])[:4], polygon_format='')}),
+        ('reach', {'body': dict(body, reach=rng.choice(manifest['reaches'])[:6], river_name='')}),
+        ('river', {'body': dict(body, name=rng.choice(manifest['river_names']).replace(' ', '%20'), exact='true')}),
+    ]
+
+
+def response_body(response):
+    """The JSON body the Lambda runtime returns for a response"""
+    return response if isinstance(response, bytes) else json.dumps(response).encode('utf-8')
+
+
+def time_compression(body, encoding, level, repeat):
+    """
+    Time the compression of a body.
+
+    Parameters
+    ----------
+    body : bytes
+        The JSON body
+    encoding : str
+        'br' or 'gzip'
+    level : int
+        gzip level or brotli quality
+    repeat : int
+        Times to compress it, the fastest is kept
+
+    Returns
+    -------
+    tuple
+        Fastest CPU time in ms, and the compressed size in bytes
+    """
+    from fts.api.controllers.compression import compress  # pylint: disable=import-outside-toplevel,import-error
+
+    best, size = None, 0
+    for _ in range(repeat):
+        started = time.process_time()
+        size = len(compress(body, encoding, level))
+        elapsed = (time.process_time() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, size
+
+
+def main():
+    """Compress the pages and print the report"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--snapshot', required=True, help='Snapshot written by benchmarks/synthetic_data.py')
+    parser.add_argument('--manifest', help='Keys to query, default SNAPSHOT.json')
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    with open(args.manifest or args.snapshot + '.json', encoding='utf-8') as file:
+        manifest = json.load(file)
+
+    os.environ.update(DB_BACKEND='snapshot', SNAPSHOT_PATH=args.snapshot, RESULT_CACHE_ENTRIES='0')
+    os.environ.setdefault('METRICS_ENABLED', 'false')
+    # pylint: disable-next=import-outside-toplevel,import-error
+    from fts.api.controllers import compression, fts_controller
+
+    encodings = [('gzip', GZIP_LEVELS)]
+    if compression.brotli_module() is not None:
+        encodings.append(('br', BROTLI_LEVELS))
+
+    report = []
+    for name, event in page_events(manifest, args.page_size, random.Random(args.seed)):
+        body = response_body(fts_controller.lambda_handler(event, None))
+        for encoding, levels in encodings:
+            chosen = compression.compression_level(encoding, len(body))
+            for level in levels:
+                cpu_ms, size = time_compression(body, encoding, level, args.repeat)
+                report.append({'page': name, 'bytes': len(body), 'encoding': encoding, 'level': level,
+                               'chosen': level == chosen, 'cpu_ms': round(cpu_ms, 2), 'compressed': size,
+                               'saved_pct': round(100 * (1 - size / len(body)), 1)})
+    if args.json:
+        print(json.dumps(report, indent=1))
+        return
+
+    columns = ['bytes', 'encoding', 'level', 'cpu_ms', 'compressed', 'saved_pct']
+    print(f"{'page':<8}" + ''.join(f'{column:>12}' for column in columns))
+    for row in report:
+        print(f"{row['page']:<8}" + ''.join(f'{row[column]:>12}' for column in columns) + (' *' if row['chosen'] else ''))
+    print('* level chosen for the page')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+==============
+bench_huc_geojson.py
+==============
+
+Per-row cost of HUC polygon_format=geojson responses, with the GeoJSON built
+from the flat polygons at request time, and with the GeoJSON precomputed by
+the HUC build.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_huc_geojson [--rows 100] [--vertices 100] [--repeat 20]
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import time
+
+for var in ('DB_HOST', 'DB_NAME', 'DB_USERNAME', 'DB_PASSWORD'):
+    os.environ.setdefault(var, 'bench')
+
+# pylint: disable=wrong-import-position,import-error
+from fts.api.controllers import fts_controller  # noqa: E402
+from fts.db.huc.simplify_huc import flat_bbox_to_geojson_polygon, flat_to_geojson_polygon  # noqa: E402
+
+
+class FetchallCursor:  # pylint: disable=too-few-public-methods
+    """Cursor stand-in which returns prepared rows"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchall(self):
+        """Return the prepared rows"""
+        return self.rows
+
+
+def flat_polygon(vertices):
+    """Random, roughly circular polygon as a comma delimited lon,lat string"""
+    lon, lat = random.uniform(-125, -70), random.uniform(25, 49)
+    points = []
+    for i in range(vertices):
+        angle = 2 * math.pi * i / vertices
+        radius = random.uniform(0.5, 1.5)
+        points.extend([lon + radius * math.cos(angle), lat + radius * math.sin(angle)])
+    return ','.join(str(point) for point in points)
+
+
+def make_rows(count, vertices):
+    """Flat and precomputed huc_table rows of the same polygons"""
+    flat_rows, precomputed_rows = [], []
+    for i in range(count):
+        hull = flat_polygon(max(4, vertices // 4))
+        visvalingam = flat_polygon(vertices)
+        values = list(map(float, hull.split(',')))
+        bbox = ','.join(str(v) for v in (min(values[::2]), min(values[1::2]), max(values[::2]), max(values[1::2])))
+        huc = f"18{i:06d}"
+        flat_rows.append([huc, 'Bench', hull, visvalingam, bbox])
+        precomputed_rows.append([huc, 'Bench', flat_to_geojson_polygon(hull),
+                                 flat_to_geojson_polygon(visvalingam), flat_bbox_to_geojson_polygon(bbox)])
+    return flat_rows, precomputed_rows
+
+
+def time_rows(rows, repeat):
+    """Best time per row in microseconds, including serializing the response"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = fts_controller.return_json(FetchallCursor(rows), 'HUC', '18', False, 'geojson', 0,
+                                              len(rows), 1, len(rows))
+        json.dumps(response)
+        best = min(best, time.perf_counter() - start)
+    return best / len(rows) * 1e6
+
+
+def main():
+    """Run the benchmark and print the per-row times"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--vertices', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(0)
+    flat_rows, precomputed_rows = make_rows(args.rows, args.vertices)
+    before = time_rows(flat_rows, args.repeat)
+    after = time_rows(precomputed_rows, args.repeat)
+
+    print(f"rows={args.rows} vertices={args.vertices}")
+    print(f"built at request time: {before:10.1f} us/row")
+    print(f"precomputed:           {after:10.1f} us/row")
+    print(f"speedup:               {before / after:10.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""
+==============
+bench_load.py
+==============
+
+Load test of lambda_handler: replays a weighted mix of HUC, region, reach,
+node and river name requests, built from the keys in a manifest written by
+benchmarks/synthetic_data.py, from concurrent threads for a fixed time or
+number of requests. Reports the p50/p95/p99 latency, requests/s, rows/s
+and bytes/s of each endpoint and of the whole mix.
+
+Serves from the snapshot written by synthetic_data.py, or from the MySQL
+database of the DB_HOST, DB_NAME, DB_USERNAME and DB_PASSWORD variables
+with --mysql. The result cache is off unless --cache is given, so that
+every request reaches the database.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_load --snapshot bench.sqlite [--concurrency 4] [--duration 30]
+    python -m benchmarks.bench_load --mysql --manifest bench.json [--requests 2000] [--mix huc=1,reach=3]
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Relative weight of each kind of request in the default mix
+DEFAULT_MIX = {'huc': 2, 'huc_exact': 1, 'region': 2, 'reach': 2, 'node': 1, 'river': 2}
+PERCENTILES = (50, 95, 99)
+
+
+def make_event(kind, manifest, rng, page_size):
+    """
+    Build the Lambda event of a request, with the parameters the API
+    Gateway templates pass.
+
+    Parameters
+    ----------
+    kind : str
+        One of DEFAULT_MIX
+    manifest : dict
+        Keys to query
+    rng : random.Random
+        Random number generator
+    page_size : int
+        Results per page
+
+    Returns
+    -------
+    tuple
+        The endpoint and the event
+    """
+    body = {'exact': 'false', 'page_number': '1', 'page_size': str(page_size)}
+    if kind in ('huc', 'huc_exact'):
+        huc = rng.choice(manifest['hucs'])
+        body.update(HUC=huc if kind == 'huc_exact' else huc[:rng.choice((4, 6, 8))],
+                    exact='true' if kind == 'huc_exact' else 'false', polygon_format='')
+    elif kind == 'region':
+        body.update(region=rng.choice(manifest['regions']).replace(' ', '%20'), polygon_format='')
+    elif kind == 'reach':
+        body.update(reach=rng.choice(manifest['reaches'])[:rng.choice((6, 8, 10))], river_name='')
+    elif kind == 'node':
+        body.update(node=rng.choice(manifest['nodes'])[:rng.choice((10, 12))], river_name='')
+    elif kind == 'river':
+        body.update(name=rng.choice(manifest['river_names']).replace(' ', '%20'), exact='true')
+    else:
+        raise ValueError(f'Unknown request kind {kind}')
+    return kind, {'body': body}
+
+
+def response_size(response):
+    """Rows and bytes of a response, as the Lambda runtime would return it"""
+    if isinstance(response, bytes):
+        body = response
+        response = json.loads(body)
+    else:
+        body = json.dumps(response).encode('utf-8')
+    results = response.get('results') or []
+    return len(results), len(body)
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of a list of values"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))]
+
+
+def summarize(samples, elapsed):
+    """
+    Summarize the samples of one endpoint or of the whole mix.
+
+    Parameters
+    ----------
+    samples : list
+        (latency ms, rows, bytes, error) of each request
+    elapsed : float
+        Seconds the load ran
+
+    Returns
+    -------
+    dict
+        Requests, errors, latency percentiles and mean in ms, and requests,
+        rows and bytes per second
+    """
+    latencies = [sample[0] for sample in samples]
+    summary = {'requests': len(samples), 'errors': sum(1 for sample in samples if sample[3])}
+    for pct in PERCENTILES:
+        summary[f'p{pct}_ms'] = round(percentile(latencies, pct), 2)
+    summary['mean_ms'] = round(statistics.fmean(latencies), 2)
+    summary['requests_s'] = round(len(samples) / elapsed, 1)
+    summary['rows_s'] = round(sum(sample[1] for sample in samples) / elapsed, 1)
+    summary['bytes_s'] = round(sum(sample[2] for sample in samples) / elapsed)
+    return summary
+
+
+def run_load(handler, events, concurrency, duration=None):
+    """
+    Replay events through a handler from concurrent threads.
+
+    Parameters
+    ----------
+    handler : callable
+        The Lambda handler
+    events : list
+        (endpoint, event) pairs, replayed in a loop when duration is given
+    concurrency : int
+        Number of threads sending requests
+    duration : float, optional
+        Seconds to run for; each event is sent once when not given
+
+    Returns
+    -------
+    tuple
+        Samples per endpoint, and the seconds the load ran
+    """
+    samples = {}
+    lock = threading.Lock()
+    position = iter(range(10 ** 12))
+
+    def worker(deadline):
+        while True:
+            index = next(position)
+            if duration is None and index >= len(events):
+                return
+            if duration is not None and time.perf_counter() >= deadline:
+                return
+            endpoint, event = events[index % len(events)]
+            error = None
+            started = time.perf_counter()
+            try:
+                response = handler(event, None)
+            except Exception as ex:  # pylint: disable=broad-except
+                error, response = str(ex), {}
+            latency = (time.perf_counter() - started) * 1000
+            rows, size = response_size(response)
+            with lock:
+                samples.setdefault(endpoint, []).append((latency, rows, size, error))
+
+    started = time.perf_counter()
+    deadline = started + (duration or 0)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(worker, deadline) for _ in range(concurrency)]:
+            future.result()
+    return samples, time.perf_counter() - started
+
+
+def parse_mix(value):
+    """Parse a mix such as 'huc=1,reach=3'"""
+    mix = {}
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f'Unknown request kind {kind}, expected one of {", ".join(DEFAULT_MIX)}')
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def main():
+    """Run the load and print the report"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--snapshot', help='Snapshot written by benchmarks/synthetic_data.py')
+    parser.add_argument('--mysql', action='store_true', help='Serve from the DB_* MySQL database')
+    parser.add_argument('--manifest', help='Keys to query, default SNAPSHOT.json')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--duration', type=float, help='Seconds to run for')
+    parser.add_argument('--requests', type=int, default=1000, help='Requests to send without --duration')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache', action='store_true', help='Keep the result cache on')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+    if not args.snapshot and not args.mysql:
+        parser.error('one of --snapshot or --mysql is required')
+
+    with open(args.manifest or args.snapshot + '.json', encoding='utf-8') as file:
+        manifest = json.load(file)
+
+    if args.snapshot:
+        os.environ.update(DB_BACKEND='snapshot', SNAPSHOT_PATH=args.snapshot)
+    if not args.cache:
+        os.environ['RESULT_CACHE_ENTRIES'] = '0'
+    os.environ.setdefault('METRICS_ENABLED', 'false')
+    os.environ.setdefault('DB_MAX_CONNECTIONS', str(args.concurrency))
+    from fts.api.controllers import fts_controller  # pylint: disable=import-outside-toplevel,import-error
+
+    rng = random.Random(args.seed)
+    kinds = rng.choices(list(args.mix), weights=list(args.mix.values()), k=args.requests)
+    events = [make_event(kind, manifest, rng, args.page_size) for kind in kinds]
+    samples, elapsed = run_load(fts_controller.lambda_handler, events, args.concurrency, args.duration)
+
+    report = {endpoint: summarize(values, elapsed) for endpoint, values in sorted(samples.items())}
+    report['all'] = summarize([sample for values in samples.values() for sample in values], elapsed)
+    if args.json:
+        print(json.dumps(report, indent=1))
+        return
+
+    columns = ['requests', 'errors', *[f'p{pct}_ms' for pct in PERCENTILES], 'mean_ms', 'requests_s', 'rows_s',
+               'bytes_s']
+    print(f"concurrency={args.concurrency} elapsed={elapsed:.1f}s backend={'mysql' if args.mysql else 'snapshot'}")
+    print(f"{'endpoint':<10}" + ''.join(f'{column:>12}' for column in columns))
+    for endpoint, summary in report.items():
+        print(f'{endpoint:<10}' + ''.join(f'{summary[column]:>12}' for column in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+==============
+bench_river_join.py
+==============
+
+EXPLAIN plans and latency of the /rivers/{name} reaches and nodes query, as
+it was (comma join filtering river_name LIKE on both tables) and as the API
+runs it now (join driven from the reaches found by river_name, nodes read
+through node_reach_id_idx). Needs a loaded SWORD database, read with the
+API's DB_HOST, DB_NAME, DB_USERNAME and DB_PASSWORD.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_river_join [--names Ohio Mississippi] [--page-size 100] [--repeat 5]
+"""
+
+import argparse
+import os
+import time
+
+import pymysql
+
+# pylint: disable=wrong-import-position,import-error
+from fts.api.controllers.fts_controller import RIVER_JOIN  # noqa: E402
+
+BEFORE = {
+    'count': "SELECT COUNT(*) FROM reaches, nodes WHERE reaches.reach_id = nodes.reach_id"
+             " AND reaches.river_name LIKE %s AND nodes.river_name LIKE %s",
+    'page': "SELECT reaches.*, nodes.* FROM reaches, nodes WHERE reaches.reach_id = nodes.reach_id"
+            " AND reaches.river_name LIKE %s AND nodes.river_name LIKE %s ORDER BY node_id LIMIT %s,%s",
+}
+AFTER = {
+    'count': f"SELECT COUNT(*) FROM {RIVER_JOIN} WHERE reaches.river_name LIKE %s",
+    'page': f"SELECT reaches.*, nodes.* FROM {RIVER_JOIN} WHERE reaches.river_name LIKE %s ORDER BY node_id LIMIT %s,%s",
+}
+
+
+def query_args(queries, name, page_size):
+    """Arguments of the count and page queries of a name"""
+    likes = (name + '%',) * (2 if queries is BEFORE else 1)
+    return {'count': likes, 'page': likes + (0, page_size)}
+
+
+def explain(cur, query, args):
+    """EXPLAIN rows of a query as aligned text"""
+    cur.execute("EXPLAIN " + query, args)
+    columns = [column[0] for column in cur.description]
+    rows = [[str(value) for value in row] for row in cur.fetchall()]
+    widths = [max(len(value) for value in values) for values in zip(columns, *rows)]
+    return "\n".join("  " + " | ".join(value.ljust(width) for value, width in zip(row, widths))
+                     for row in [columns] + rows)
+
+
+def best_time(cur, query, args, repeat):
+    """Best run time of a query in milliseconds, fetching all rows"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        cur.execute(query, args)
+        cur.fetchall()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main():
+    """Print the plans and times of both versions for each name"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--names', nargs='+', default=['Ohio', 'Mississippi'])
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    connection = pymysql.connect(host=os.environ['DB_HOST'], user=os.environ['DB_USERNAME'],
+                                 password=os.environ['DB_PASSWORD'], database=os.environ['DB_NAME'])
+    with connection.cursor() as cur:
+        for name in args.names:
+            for label, queries in (('before', BEFORE), ('after', AFTER)):
+                for kind, query in queries.items():
+                    values = query_args(queries, name, args.page_size)[kind]
+                    print(f"{name} {label} {kind}: {best_time(cur, query, values, args.repeat):10.1f} ms")
+                    print(explain(cur, query, values))
+            print()
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+==============
+compression.py
+==============
+
+Compression of large responses for clients which accept it. The encoding
+is negotiated from the Accept-Encoding header, and the level is chosen by
+the size of the body: small bodies get a slower, better level, while the
+multi MB river pages get a fast one, whose CPU time stays well below what
+the smaller response saves (see benchmarks/bench_compression.py).
+
+Compressed responses are returned in the binary response format of API
+Gateway proxy integrations, function URLs and load balancers: the body
+base64 encoded, with isBase64Encoded and a Content-Encoding header.
+Brotli is offered only when the brotli module is installed.
+"""
+
+import base64
+import functools
+import gzip
+
+# Supported encodings, in order of preference between equal q values
+ENCODINGS = ('br', 'gzip')
+# Compression level by body size: (largest size in bytes, level), the last
+# level for anything larger. Brotli qualities go from 0 to 11.
+GZIP_LEVELS = ((256 * 1024, 6), (2 * 1024 * 1024, 4), (None, 1))
+BROTLI_LEVELS = ((256 * 1024, 8), (2 * 1024 * 1024, 5), (None, 3))
+
+
+@functools.lru_cache(maxsize=None)
+def brotli_module():
+    """The brotli module, imported on first use, or None when not installed"""
+    try:
+        import brotli  # pylint: disable=import-outside-toplevel,import-error
+    except ImportError:
+        return None
+    return brotli
+
+
+def accepted_encoding(headers):
+    """
+    Pick the encoding of a response from the request headers.
+
+    Parameters
+    ----------
+    headers : dict
+        Request headers, with names in any case; may be None
+
+    Returns
+    -------
+    str or None
+        'br' or 'gzip', or None to send the response as it is
+    """
+    accept = next((value for name, value in (headers or {}).items() if name.lower() == 'accept-encoding'), '')
+    weights = {}
+    for part in str(accept or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[coding.strip().lower()] = weight
+
+    available = [coding for coding in ENCODINGS if coding != 'br' or brotli_module() is not None]
+    candidates = [(weights.get(coding, weights.get('*', 0.0)), -index, coding)
+                  for index, coding in enumerate(available)]
+    weight, _, coding = max(candidates)
+    return coding if weight > 0 else None
+
+
+def compression_level(encoding, size):
+    """
+    Choose the level for a body.
+
+    Parameters
+    ----------
+    encoding : str
+        'br' or 'gzip'
+    size : int
+        Size of the body in bytes
+
+    Returns
+    -------
+    int
+        gzip level or brotli quality
+    """
+    for largest, level in BROTLI_LEVELS if encoding == 'br' else GZIP_LEVELS:
+        if largest is None or size <= largest:
+            return level
+    raise ValueError(f'No level for {encoding}')
+
+
+def compress(body, encoding, level=None):
+    """
+    Compress a body.
+
+    Parameters
+    ----------
+    body : bytes
+        The body
+    encoding : str
+        'br' or 'gzip'
+    level : int, optional
+        gzip level or brotli quality, chosen by size when not given
+
+    Returns
+    -------
+    bytes
+        The compressed body
+    """
+    if level is None:
+        level = compression_level(encoding, len(body))
+    if encoding == 'br':
+        return brotli_module().compress(body, quality=level)
+    # mtime=0 keeps the output the same for the same body
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+def compressed_response(body, encoding, status_code=200, headers=None):
+    """
+    Compress a body into a binary proxy integration response.
+
+    Parameters
+    ----------
+    body : bytes
+        The JSON body
+    encoding : str
+        'br' or 'gzip'
+    status_code : int, optional
+        HTTP status of the response
+    headers : dict, optional
+        More headers to send with the response
+
+    Returns
+    -------
+    dict
+        The response, with the compressed body base64 encoded
+    """
+    return {
+        'statusCode': status_code,
+        'headers': {
+            **(headers or {}),
+            'Content-Type': 'application/json',
+            'Content-Encoding': encoding,
+            'Vary': 'Accept-Encoding',
+        },
+        'isBase64Encoded': True,
+        'body': base64.b64encode(compress(body, encoding)).decode('ascii'),
+    }
@@ -0,0 +1,101 @@
+"""
+==============
+conditional.py
+==============
+
+Validators of API responses. The HUC and SWORD tables only change when the
+loaders reload them and stamp a new dataset version, so a response is
+identified by the dataset version and the normalized request: its ETag is
+a hash of the two, and a request whose If-None-Match holds that ETag is
+answered 304 Not Modified without reading the tables. The ETag is weak: the
+response carries its own processing time, so two responses with the same
+ETag are equivalent rather than byte for byte identical. Cache-Control lets
+CloudFront and browser caches serve repeat requests for max-age seconds.
+"""
+
+import hashlib
+
+
+def response_etag(version, cache_key):
+    """
+    Build the ETag of a response.
+
+    Parameters
+    ----------
+    version : str
+        Dataset version stamped by the loaders
+    cache_key : tuple
+        The normalized request, from normalize_request
+
+    Returns
+    -------
+    str
+        Quoted weak ETag
+    """
+    digest = hashlib.sha256(repr((version, cache_key)).encode('utf-8')).hexdigest()
+    return f'W/"{digest[:32]}"'
+
+
+def if_none_match(event):
+    """
+    Read the If-None-Match of a request, from the event headers of proxy
+    integrations, or from the if_none_match parameter the REST API request
+    templates pass.
+
+    Parameters
+    ----------
+    event : dict
+        The lambda event
+
+    Returns
+    -------
+    str
+        The If-None-Match value, empty if the request has none
+    """
+    headers = event.get('headers') or {}
+    value = next((value for name, value in headers.items() if name.lower() == 'if-none-match'), None)
+    if value is None:
+        value = event['body'].get('if_none_match', '')
+    return str(value or '').strip()
+
+
+def etag_matches(condition, etag):
+    """
+    Tell whether an If-None-Match condition holds an ETag, comparing the
+    tags weakly as RFC 9110 asks for If-None-Match.
+
+    Parameters
+    ----------
+    condition : str
+        If-None-Match value: '*' or a comma separated list of ETags
+    etag : str
+        ETag of the current response
+
+    Returns
+    -------
+    bool
+        True if the client already has the response
+    """
+    if condition == '*':
+        return True
+    etag = etag.removeprefix('W/')
+    return any(tag.strip().removeprefix('W/') == etag for tag in condition.split(','))
+
+
+def cache_control(max_age):
+    """
+    Build the Cache-Control of a response.
+
+    Parameters
+    ----------
+    max_age : int
+        Seconds caches may serve the response without revalidating it
+
+    Returns
+    -------
+    str
+        The Cache-Control value
+    """
+    if max_age <= 0:
+        return 'no-cache'
+    return f'public, max-age={max_age}'
@@ -0,0 +1,378 @@
+"""
+==============
+db_connection.py
+==============
+
+Lifecycle management for the API's MySQL connections. Connections are
+opened on first use, checked before reuse, reopened with backoff when
+they drop, and capped at a per-process budget.
+"""
+
+import contextlib
+import logging
+import random
+import threading
+import time
+
+import pymysql
+
+logger = logging.getLogger()
+
+# MySQL error of a rejected user name or password
+ACCESS_DENIED_ERROR = 1045
+
+
+class ConnectionBudgetExceeded(Exception):
+    """
+    Exception thrown if no connection frees up within the acquire timeout
+    """
+
+
+class SSMSecret:
+    """
+    Password read from an SSM SecureString parameter on first use and cached,
+    so that neither boto3 nor the SSM call delay the import of the API.
+    Pass the instance as the ConnectionManager password, which drops the
+    cached value when MySQL rejects it, so rotated passwords are read again.
+
+    Parameters
+    ----------
+    name : str
+        Name of the SSM parameter
+    fallback : str, optional
+        Password used when the parameter cannot be read
+    ttl : float, optional
+        Seconds the value is cached
+    """
+
+    def __init__(self, name, fallback=None, ttl=3600.0):
+        self.name = name
+        self.fallback = fallback
+        self.ttl = ttl
+        self._value = None
+        self._read_at = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            if self._value is None or time.time() - self._read_at > self.ttl:
+                self._value = self._read()
+                self._read_at = time.time()
+            return self._value
+
+    def _read(self):
+        """Read the parameter, or return the fallback if that fails."""
+        try:
+            import boto3  # pylint: disable=import-outside-toplevel
+
+            parameter = boto3.client('ssm').get_parameter(Name=self.name, WithDecryption=True)
+            return parameter['Parameter']['Value']
+        except Exception:  # pylint: disable=broad-except
+            if self.fallback is None:
+                raise
+            logger.info("Could not read SSM parameter %s, using DB_PASSWORD", self.name)
+            return self.fallback
+
+    def invalidate(self):
+        """Drop the cached value, so the next call reads the parameter again."""
+        with self._lock:
+            self._value = None
+
+
+class ConnectionManager:  # pylint: disable=too-many-instance-attributes
+    """
+    Lazily opened, self healing pool of pymysql connections.
+
+    Parameters
+    ----------
+    host : str
+        MySQL host, or the RDS Proxy endpoint when one is used
+    user : str
+        Database user name
+    password : str or callable
+        Database password, or a callable returning it. Ignored with iam_auth.
+    database : str
+        Database name
+    port : int
+        MySQL port
+    connect_timeout : int
+        Seconds to wait for the server when connecting
+    read_timeout : int, optional
+        Seconds to wait for a query result
+    write_timeout : int, optional
+        Seconds to wait while sending a query
+    max_connections : int
+        Maximum number of connections this process opens at once
+    acquire_timeout : float
+        Seconds to wait for a free connection once the budget is used up
+    ping_interval : float
+        Connections idle for longer than this many seconds are pinged before reuse
+    max_retries : int
+        Number of reconnect attempts after the first connect fails
+    backoff_base : float
+        Delay in seconds before the first retry; doubles on every retry
+    backoff_max : float
+        Upper limit for the delay between retries
+    iam_auth : bool
+        Authenticate with an RDS IAM auth token instead of a password
+    region : str, optional
+        AWS region used to sign IAM auth tokens
+    ssl_ca : str, optional
+        Path to the CA bundle used for TLS. Required with iam_auth.
+    """
+
+    def __init__(self, host, user, password, database, *, port=3306, connect_timeout=10,  # pylint: disable=too-many-arguments
+                 read_timeout=None, write_timeout=None, max_connections=1, acquire_timeout=2.0,
+                 ping_interval=30.0, max_retries=3, backoff_base=0.1, backoff_max=2.0,
+                 iam_auth=False, region=None, ssl_ca=None):
+        if iam_auth and not ssl_ca:
+            raise ValueError("IAM database authentication requires an ssl_ca bundle.")
+        if max_connections < 1:
+            raise ValueError("max_connections must be 1 or greater.")
+
+        self.host = host
+        self.user = user
+        self.password = password
+        self.database = database
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.max_connections = max_connections
+        self.acquire_timeout = acquire_timeout
+        self.ping_interval = ping_interval
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.iam_auth = iam_auth
+        self.region = region
+        self.ssl_ca = ssl_ca
+
+        self._idle = []
+        self._open = 0
+        self._available = threading.Condition()
+        # Runs queries on a second connection, created on first use
+        self._executor = None
+        self._stats = {
+            'connects': 0,
+            'reconnects': 0,
+            'connect_failures': 0,
+            'connect_time_ms': 0.0,
+            'pings': 0,
+            'budget_waits': 0,
+        }
+
+    def stats(self):
+        """
+        Get the connection counters of this process.
+
+        Returns
+        -------
+        dict
+            Counts of connects, reconnects, failed connect attempts, pings and
+            waits for a free connection, and total time spent connecting in ms
+        """
+        with self._available:
+            stats = dict(self._stats)
+            stats['open_connections'] = self._open
+        return stats
+
+    def _get_password(self):
+        """Resolve the password, or sign an IAM auth token for this host."""
+        if self.iam_auth:
+            import boto3  # pylint: disable=import-outside-toplevel
+
+            client = boto3.client('rds', region_name=self.region)
+            return client.generate_db_auth_token(DBHostname=self.host, Port=self.port,
+                                                 DBUsername=self.user)
+        if callable(self.password):
+            return self.password()
+        return self.password
+
+    def _connect(self):
+        """Open a new connection, retrying with exponential backoff and jitter."""
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                kwargs = {}
+                if self.ssl_ca:
+                    kwargs['ssl_ca'] = self.ssl_ca
+                conn = pymysql.connect(
+                    host=self.host, user=self.user, password=self._get_password(), database=self.database,
+                    port=self.port, connect_timeout=self.connect_timeout, read_timeout=self.read_timeout,
+                    write_timeout=self.write_timeout, **kwargs
+                )
+            except pymysql.MySQLError as e:
+                with self._available:
+                    self._stats['connect_failures'] += 1
+                    self._stats['connect_time_ms'] += (time.time() - start) * 1000
+                if e.args and e.args[0] == ACCESS_DENIED_ERROR and hasattr(self.password, 'invalidate'):
+                    self.password.invalidate()
+                if attempt >= self.max_retries:
+                    logger.error("ERROR: Unexpected error: Could not connect to MySql instance.")
+                    logger.error(e)
+                    raise
+                delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                attempt += 1
+                continue
+
+            with self._available:
+                self._stats['connects'] += 1
+                self._stats['connect_time_ms'] += (time.time() - start) * 1000
+            logger.info("SUCCESS: Connection to mysql instance succeeded")
+            return conn
+
+    def _is_alive(self, conn, idle_since):
+        """Ping a connection which has been idle for longer than ping_interval."""
+        if time.time() - idle_since < self.ping_interval:
+            return True
+        with self._available:
+            self._stats['pings'] += 1
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except pymysql.MySQLError:
+            return False
+
+    def acquire(self, timeout=None):
+        """
+        Take a connection from the pool, opening or reopening one if needed.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Seconds to wait for a free connection, acquire_timeout if not
+            given; 0 to not wait
+
+        Returns
+        -------
+        pymysql.connections.Connection
+            A live connection, which must be given back with release()
+        """
+        timeout = self.acquire_timeout if timeout is None else timeout
+        with self._available:
+            if not self._idle and self._open >= self.max_connections:
+                if timeout > 0:
+                    self._stats['budget_waits'] += 1
+                if not self._available.wait_for(lambda: self._idle or self._open < self.max_connections,
+                                                timeout=timeout):
+                    raise ConnectionBudgetExceeded(
+                        f"All {self.max_connections} database connections of this process are in use.")
+            if self._idle:
+                conn, idle_since = self._idle.pop()
+            else:
+                conn, idle_since = None, None
+                self._open += 1
+
+        try:
+            if conn is not None and not self._is_alive(conn, idle_since):
+                logger.info("MySQL connection went away, reconnecting")
+                self._close(conn)
+                conn = None
+                with self._available:
+                    self._stats['reconnects'] += 1
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._available:
+                self._open -= 1
+                self._available.notify()
+            raise
+        return conn
+
+    def release(self, conn, broken=False):
+        """
+        Give a connection back to the pool.
+
+        Parameters
+        ----------
+        conn : pymysql.connections.Connection
+            The connection from acquire()
+        broken : bool
+            Close the connection instead of keeping it for reuse
+        """
+        with self._available:
+            if broken:
+                self._open -= 1
+            else:
+                self._idle.append((conn, time.time()))
+            self._available.notify()
+        if broken:
+            self._close(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Context manager around acquire() and release(). The connection is
+        dropped if the block fails with a connection level error.
+        """
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except (pymysql.OperationalError, pymysql.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def submit(self, func):
+        """
+        Run a query function on another connection from a worker thread,
+        while the caller goes on with its own connection. A connection is
+        only taken if one is free without waiting, so requests which hold
+        the whole budget never wait on each other.
+
+        Parameters
+        ----------
+        func : callable
+            Called with a cursor of the connection
+
+        Returns
+        -------
+        concurrent.futures.Future or None
+            Future of the result of func, or None when no connection is free
+        """
+        if self.max_connections < 2:
+            return None
+        try:
+            conn = self.acquire(timeout=0)
+        except ConnectionBudgetExceeded:
+            return None
+
+        with self._available:
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+                self._executor = ThreadPoolExecutor(max_workers=self.max_connections - 1,
+                                                    thread_name_prefix='fts-db')
+        return self._executor.submit(self._run, conn, func)
+
+    def _run(self, conn, func):
+        """Run func with a cursor of an acquired connection, then release it."""
+        broken = False
+        try:
+            with conn.cursor() as cur:
+                return func(cur)
+        except (pymysql.OperationalError, pymysql.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def close(self):
+        """Close all idle connections."""
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn, _ in idle:
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        """Close a connection, ignoring errors from one that already dropped."""
+        try:
+            conn.close()
+        except Exception:  # pylint: disable=broad-except
+            pass
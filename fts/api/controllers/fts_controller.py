@@ -1,7 +1,7 @@
 # pylint: disable=invalid-name, broad-except, redefined-builtin, unnecessary-comprehension
 # pylint: disable=redefined-outer-name, unused-argument, no-else-return, too-many-branches
 # pylint: disable=too-many-arguments
-# pylint: disable=too-many-statements, too-many-locals
+# pylint: disable=too-many-statements, too-many-locals, too-many-lines, too-many-return-statements
 
 """
 ==============
@@ -9,47 +9,208 @@ fts_controller.py
 ==============
 """
 
+import base64
+import binascii
+import json
 import logging
 import os
-import sys
 import time
+import urllib.parse
 
-import boto3
 import geojson
 import pymysql
 
-try:
-    DB_PASSWORD_SSM_NAME = os.environ['DB_PASSWORD_SSM_NAME']
-    ssm = boto3.client('ssm')
-
-    ssm_fts_user_pass = ssm.get_parameter(Name=DB_PASSWORD_SSM_NAME, WithDecryption=True)
-    DB_PASSWORD = ssm_fts_user_pass['Parameter']['Value']
-except Exception:
-    DB_PASSWORD = os.environ['DB_PASSWORD']
-
-DB_HOST = os.environ['DB_HOST']
-DB_NAME = os.environ['DB_NAME']
-DB_USERNAME = os.environ['DB_USERNAME']
-DB_PORT = 3306
+from fts.api.controllers.compression import accepted_encoding, compressed_response
+from fts.api.controllers.conditional import cache_control, etag_matches, if_none_match, response_etag
+from fts.api.controllers.db_connection import ConnectionManager, SSMSecret
+from fts.api.controllers.geometry_reduction import reduce_geojson
+from fts.api.controllers.huc_index import load_huc_index
+from fts.api.controllers.json_fragments import (JSONFragments, RawJSON, encode_response, response_status,
+                                                with_attributes, with_time)
+from fts.api.controllers.name_search import NAME_TYPES, fold_name, search_query
+from fts.api.controllers.ndjson_stream import collect, dumps_line, iter_batches, iter_rows, stream_page
+from fts.api.controllers.request_metrics import RequestTimer, TimedCursor
+from fts.api.controllers.result_cache import DatasetVersion, ResultCache, normalize_request
+from fts.api.controllers.shared_cache import NegativeResult, SharedCache, create_backend
+from fts.api.controllers.snapshot_backend import SnapshotConnections
+
+# mysql serves from the database, snapshot from a file built by fts/db/build_snapshot.py
+DB_BACKEND = os.environ.get('DB_BACKEND', 'mysql').lower()
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', '')
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-try:
-    conn = pymysql.connect(
-        host=DB_HOST, user=DB_USERNAME, passwd=DB_PASSWORD, db=DB_NAME, connect_timeout=10
+if DB_BACKEND == 'snapshot':
+    # Opened read-only and memory-mapped on the first request
+    connections = SnapshotConnections(SNAPSHOT_PATH)
+else:
+    # Read from SSM on the first connect rather than at import
+    if os.environ.get('DB_PASSWORD_SSM_NAME'):
+        DB_PASSWORD = SSMSecret(os.environ['DB_PASSWORD_SSM_NAME'], fallback=os.environ.get('DB_PASSWORD'))
+    else:
+        DB_PASSWORD = os.environ['DB_PASSWORD']
+
+    DB_HOST = os.environ['DB_HOST']
+    DB_NAME = os.environ['DB_NAME']
+    DB_USERNAME = os.environ['DB_USERNAME']
+    DB_PORT = 3306
+
+    # Optional RDS Proxy endpoint, IAM auth and connection tuning
+    DB_PROXY_HOST = os.environ.get('DB_PROXY_HOST', '')
+    DB_IAM_AUTH = os.environ.get('DB_IAM_AUTH', 'false').lower() == 'true'
+    DB_SSL_CA = os.environ.get('DB_SSL_CA') or None
+    DB_MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', '1'))
+    DB_READ_TIMEOUT = int(os.environ.get('DB_READ_TIMEOUT', '0')) or None
+
+    # The connection is opened on the first request and reopened if it goes away
+    connections = ConnectionManager(
+        host=DB_PROXY_HOST or DB_HOST, user=DB_USERNAME, password=DB_PASSWORD, database=DB_NAME,
+        port=DB_PORT, connect_timeout=10, read_timeout=DB_READ_TIMEOUT,
+        max_connections=DB_MAX_CONNECTIONS, iam_auth=DB_IAM_AUTH,
+        region=os.environ.get('AWS_REGION'), ssl_ca=DB_SSL_CA
     )
 
-except pymysql.MySQLError as e:
-    logger.error("ERROR: Unexpected error: Could not connect to MySql instance.")
-    logger.error(e)
-    sys.exit()
+# Count the hits of a first page on a second pooled connection while the
+# page query runs, which needs DB_MAX_CONNECTIONS of 2 or more
+PARALLEL_COUNT = os.environ.get('PARALLEL_COUNT', 'false').lower() == 'true'
+
+# Responses of the warm container are cached until the loaders stamp a new dataset version
+result_cache = ResultCache(
+    max_entries=int(os.environ.get('RESULT_CACHE_ENTRIES', '256')),
+    ttl=float(os.environ.get('RESULT_CACHE_TTL', '300')),
+    max_bytes=int(os.environ.get('RESULT_CACHE_MAX_MB', '64')) * 1024 * 1024
+)
+dataset_version = DatasetVersion(check_interval=float(os.environ.get('DATASET_VERSION_CHECK_INTERVAL', '60')))
+
+# Responses of at least this many bytes are compressed for clients which
+# send Accept-Encoding gzip or br in the event headers
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '32768'))
+# Request parameters of each resource of proxy integration events, as the
+# request templates of the REST API pass them: fixed parameters, and the
+# parameter of each path parameter
+PROXY_ROUTES = {
+    '/v1/huc/{huc}': ({}, {'huc': 'HUC'}),
+    '/v1/region/{region}': ({}, {'region': 'region'}),
+    '/v1/rivers/{name}': ({}, {'name': 'name'}),
+    '/v1/rivers/reach/{reach}': ({}, {'reach': 'reach'}),
+    '/v1/rivers/node/{node}': ({}, {'node': 'node'}),
+    '/v1/rivers/reach': ({'spatial': 'reach'}, {}),
+    '/v1/rivers/node': ({'spatial': 'node'}, {}),
+    '/v1/huc': ({'lookup': 'huc'}, {}),
+    '/v1/search': ({'search': 'names'}, {}),
+    '/v1/batch/huc': ({'batch': 'HUC'}, {}),
+    '/v1/batch/reaches': ({'batch': 'reach'}, {}),
+    '/v1/batch/nodes': ({'batch': 'node'}, {}),
+}
+# Parameters of POST requests read from their JSON body
+PROXY_BODY_PARAMS = ('points', 'ids')
+
+# Responses carry an ETag of the dataset version and request, answered with
+# 304 when the client has it, and may be cached for CACHE_MAX_AGE seconds
+ETAGS_ENABLED = os.environ.get('ETAGS_ENABLED', 'true').lower() == 'true'
+CACHE_MAX_AGE = int(os.environ.get('CACHE_MAX_AGE', '300'))
+# Endpoints whose responses have no validators: POST batches, and lookups
+# answered from the HUC index rather than the versioned tables
+UNVERSIONED_PARAMS = ('lookup', 'batch')
+
+# Phase timings of each request are logged as CloudWatch embedded metrics
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+# Parameter identifying each endpoint, in the order handle_request checks them, and its metric name
+ENDPOINT_PARAMS = {'lookup': 'lookup', 'batch': 'batch', 'spatial': 'spatial', 'search': 'search', 'HUC': 'huc',
+                   'region': 'region', 'reach': 'reach', 'node': 'node', 'name': 'rivers'}
+
+
+def create_shared_cache():
+    """
+    Create the cache tier shared between Lambda instances from SHARED_CACHE_URL,
+    disabled when the variable is not set or the backend is unavailable.
+    """
+    url = os.environ.get('SHARED_CACHE_URL', '')
+    backend = None
+    if url:
+        try:
+            backend = create_backend(url, timeout=float(os.environ.get('SHARED_CACHE_TIMEOUT', '0.1')))
+        except (ImportError, ValueError) as ex:
+            logger.error("Shared cache disabled: %s", ex)
+    return SharedCache(backend, ttl=float(os.environ.get('SHARED_CACHE_TTL', '3600')),
+                       negative_ttl=float(os.environ.get('SHARED_CACHE_NEGATIVE_TTL', '300')))
+
 
-logger.info("SUCCESS: Connection to mysql instance succeeded")
+shared_cache = create_shared_cache()
 
 MAX_PRECISION = 15
+# Decimal places geojson.loads keeps in river geometries
+DEFAULT_GEOJSON_PRECISION = 6
+COUNT_MODES = ('exact', 'estimate', 'none')
+OUTPUT_FORMATS = ('json', 'ndjson')
+# Rows fetched per round trip when streaming NDJSON
+NDJSON_BATCH_SIZE = int(os.environ.get('NDJSON_BATCH_SIZE', '500'))
+# Read the results pre-rendered by the SWORD loader once it has loaded them
+JSON_FRAGMENTS = os.environ.get('JSON_FRAGMENTS', 'false').lower() == 'true'
+JSON_FRAGMENT_COLUMN = 'json_fragment'
+# Most ids one batch lookup accepts, and ids per IN (...) query
+BATCH_MAX_IDS = int(os.environ.get('BATCH_MAX_IDS', '1000'))
+BATCH_CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', '200'))
+# Table and indexed id column of each batch lookup type
+BATCH_TYPES = {'HUC': ('huc_table', 'HUC'), 'reach': ('reaches', 'reach_id'), 'node': ('nodes', 'node_id')}
+# Reaches and their nodes. Only the reaches side is filtered, so MySQL reads
+# the matching reaches through river_name_idx and their nodes through
+# node_reach_id_idx; nodes share the river_name of their reach
+RIVER_JOIN = "reaches JOIN nodes ON nodes.reach_id = reaches.reach_id"
+# Spatially indexed geometry the SWORD loader adds to reaches and nodes
+SPATIAL_COLUMN = 'geom'
+SPATIAL_TYPES = ('reach', 'node')
+# Indexed BIGINT copies of the SWORD ids which the SWORD loader adds, and
+# the fixed number of digits of the ids
+ID_NUMBER_COLUMNS = {'reach_id': ('reach_num', 11), 'node_id': ('node_num', 14)}
+# Columns the SWORD loader adds which are not part of the results
+HIDDEN_RIVER_COLUMNS = (JSON_FRAGMENT_COLUMN, SPATIAL_COLUMN) + tuple(
+    number_column for number_column, _ in ID_NUMBER_COLUMNS.values())
+# HUC index written by the HUC build, as a path or s3:// URL, and the most
+# points one reverse lookup accepts
+HUC_INDEX_PATH = os.environ.get('HUC_INDEX_PATH', '')
+LOOKUP_MAX_POINTS = int(os.environ.get('LOOKUP_MAX_POINTS', '10000'))
+# Number of digits of the HUC levels, stored in huc_table.huc_level
+HUC_LEVELS = tuple(range(1, 17))
+# Attribute filters of spatial queries: request parameter -> column and comparison
+ATTRIBUTE_FILTERS = {
+    'type': ('type', '='),
+    'lakeflag': ('lakeflag', '='),
+    'min_width': ('width', '>='),
+    'min_facc': ('facc', '>='),
+}
+# Shortest last word of a name search, and the default and largest number of names
+SEARCH_MIN_PREFIX = 2
+SEARCH_DEFAULT_LIMIT = 10
+SEARCH_MAX_LIMIT = 100
+# "MySQL server has gone away" and "Lost connection to MySQL server during query"
+LOST_CONNECTION_ERRORS = (2006, 2013)
 OBJECT_URL = 'https://podaac-feature-translation-service.s3-us-west-2.amazonaws.com/{}.zip'
 SOURCE_URL = 'ftp://rockyftp.cr.usgs.gov/vdelivery/Datasets/Staged/Hydrography/WBD/HU2/Shape/WBD_{}_HU2_Shape.zip'
+# huc_table polygons, in table order: flat column, precomputed GeoJSON column,
+# flat response attribute and GeoJSON feature type
+HUC_POLYGON_COLUMNS = {
+    'convex_hull': ('Polygon Convex Hull', 'GeoJSON Convex Hull', 'Convex Hull Polygon', 'Convex Hull'),
+    'visvalingam': ('Polygon Visvalingam', 'GeoJSON Visvalingam', 'Visvalingam Polygon', 'Visvalingam'),
+    'bbox': ('Bounding Box', 'GeoJSON Bounding Box', 'Bounding Box', 'bbox'),
+}
+HUC_POLYGONS = tuple(HUC_POLYGON_COLUMNS)
+# reaches and nodes columns, as loaded by fts/db/sword/setup_sword.py, besides json_fragment
+REACH_COLUMNS = (
+    'x', 'y', 'reach_id', 'reach_len', 'n_nodes', 'wse', 'wse_var', 'width', 'width_var', 'facc',
+    'n_chan_max', 'n_chan_mod', 'obstr_type', 'grod_id', 'hfalls_id', 'slope', 'dist_out', 'lakeflag',
+    'max_width', 'n_rch_up', 'n_rch_dn', 'swot_orbit', 'swot_obs', 'type', 'river_name', 'geometry',
+    'geojson', 'shp_origin', 'netcdf_origin'
+)
+NODE_COLUMNS = (
+    'x', 'y', 'node_id', 'node_len', 'reach_id', 'wse', 'wse_var', 'width', 'wth_var', 'n_chan_max',
+    'n_chan_mod', 'obstr_type', 'grod_id', 'hfalls_id', 'dist_out', 'type', 'facc', 'lakeflag',
+    'max_width', 'river_name', 'manual_add', 'geometry', 'geojson', 'shp_origin', 'netcdf_origin'
+)
+RIVER_TABLE_COLUMNS = {'reaches': REACH_COLUMNS, 'nodes': NODE_COLUMNS}
+# Columns left out with include_geometry=false
+GEOMETRY_COLUMNS = ('geometry', 'geojson')
 
 
 ###################
@@ -61,6 +222,14 @@ class RequestError(Exception):
     """
 
 
+class ParallelCountError(Exception):
+    """
+    Exception thrown if the connection of a parallel count fails, with the
+    args of the pymysql error. It is not a pymysql error, so the request's
+    own connection is kept.
+    """
+
+
 def create_feature(polygon, type):
     """
     Create a Geojson feature with 'type' property, which in this case
@@ -164,8 +333,168 @@ def convert_flat_list_to_geojson_polygon(exterior_points, interior_points=None):
     return geojson.Polygon(points, precision=MAX_PRECISION)
 
 
+def create_polygon_feature(polygon, text):
+    """
+    Create the GeoJSON feature of a HUC polygon. GeoJSON text precomputed
+    when the HUC table was built is spliced into the response as it is;
+    flat polygons from rows loaded before then are converted point by point.
+
+    Parameters
+    ----------
+    polygon : str
+        'convex_hull', 'visvalingam' or 'bbox'
+    text : str
+        GeoJSON Polygon text, or the flat polygon
+
+    Returns
+    -------
+    dict
+        The feature, with the polygon type in its 'type' property
+    """
+    feature_type = HUC_POLYGON_COLUMNS[polygon][3]
+    if text.startswith('{'):
+        return {"type": "Feature", "geometry": RawJSON(text), "properties": {"type": feature_type}}
+    if polygon == 'bbox':
+        return create_feature(convert_flat_list_bbox_to_geojson_polygon(text), feature_type)
+    return create_feature(convert_flat_list_to_geojson_polygon(text), feature_type)
+
+
+def huc_columns(polygon_format, polygons=HUC_POLYGONS):
+    """
+    Get the huc_table columns to select for a polygon format. GeoJSON
+    requests read the precomputed GeoJSON columns, and fall back to the flat
+    polygons in rows loaded before those columns existed.
+
+    Parameters
+    ----------
+    polygon_format : str
+        geojson, flat, or '' (flat)
+    polygons : tuple, optional
+        The polygons to read, from HUC_POLYGONS
+
+    Returns
+    -------
+    str
+        HUC, Region and the polygon columns, in that order
+    """
+    columns = ["`HUC`", "`Region`"]
+    for polygon in polygons:
+        flat_column, geojson_column, _, _ = HUC_POLYGON_COLUMNS[polygon]
+        if polygon_format and polygon_format.lower() == 'geojson':
+            columns.append(f"COALESCE(`{geojson_column}`, `{flat_column}`)")
+        else:
+            columns.append(f"`{flat_column}`")
+    return ", ".join(columns)
+
+
+def huc_result(elem, polygon_format, polygons=HUC_POLYGONS):
+    """
+    Construct the result for one huc_table row.
+
+    Parameters
+    ----------
+    elem : tuple
+        HUC, Region and polygon columns, as selected by huc_columns
+    polygon_format : str
+        geojson, flat, or '' (flat)
+    polygons : tuple, optional
+        The polygons in elem, from HUC_POLYGONS
+
+    Returns
+    -------
+    dict
+        The result
+    """
+    result_dict = {}
+    huc = elem[0]
+    name = elem[1]
+    values = dict(zip(polygons, elem[2:]))
+
+    result_dict['Region Name'] = name
+    result_dict['HUC'] = huc
+    result_dict['USGS Polygon'] = {
+        'Object URL': OBJECT_URL.format(huc),
+        'Source': SOURCE_URL.format(huc[:2])
+    }
+
+    # Bounding box first, as before fields= existed
+    ordered = [polygon for polygon in ('bbox', 'convex_hull', 'visvalingam') if polygon in values]
+
+    if not polygon_format or polygon_format.lower() == 'flat':
+        for polygon in ordered:
+            result_dict[HUC_POLYGON_COLUMNS[polygon][2]] = values[polygon]
+
+    elif polygon_format.lower() == 'geojson' and ordered:
+        result_dict['geojson'] = {
+            "type": "FeatureCollection",
+            "features": [create_polygon_feature(polygon, values[polygon]) for polygon in ordered]
+        }
+
+    return result_dict
+
+
+def page_metadata(elapsed_time, hits, results_count, count_mode, has_more, offset, search_on):  # pylint: disable=too-many-positional-arguments
+    """
+    Construct the part of a response which describes the page.
+
+    Parameters
+    ----------
+    elapsed_time     : int
+        Number of ms to query DB
+    hits             : int
+        Total number of results that match query result
+    results_count    : int
+        Number of results in this page
+    count_mode       : str
+        'exact', 'estimate' or 'none'
+    has_more         : bool
+        True if the query returned a row past this page
+    offset           : int
+        Number of results that come before this page
+    search_on        : dict
+        The search parameters to echo back
+
+    Returns
+    -------
+    dict
+        Status, time, hits, results_count, has_more and 'search on'
+    """
+    partial_results = is_partial_results(hits, results_count, count_mode, has_more, offset)
+    status = "200 OK"
+    if partial_results:
+        status = "206 PARTIAL CONTENT"
+
+    data = {}
+    data['status'] = status
+    data['time'] = str(elapsed_time) + " ms."
+    data['hits'] = hits
+    if partial_results:
+        data['results_count'] = results_count
+    if count_mode != 'exact':
+        data['has_more'] = has_more
+    data['search on'] = search_on
+
+    return data
+
+
+def check_polygon_format(polygon_format):
+    """
+    Reject an unknown polygon_format.
+
+    Parameters
+    ----------
+    polygon_format : str
+        geojson, flat, or '' (flat)
+    """
+    if polygon_format and (
+            polygon_format.lower() != 'geojson' and polygon_format.lower() != 'flat'):
+        msg = f'400: Invalid polygon_format. Should be \'flat\' or \'geojson\', but ' \
+              f'\'{polygon_format}\' was given.'
+        raise RequestError(msg)
+
+
 def return_json(cur, identifier, name, exact, polygon_format, elapsed_time, hits, page_number,  # pylint: disable=too-many-positional-arguments
-                page_size):
+                page_size, count_mode='exact', offset=0, output_format='json', polygons=HUC_POLYGONS, level=None):
     """
     Get the results of the DB query, and construct the resulting dict
     given the polygon format and identifier.
@@ -191,21 +520,49 @@ def return_json(cur, identifier, name, exact, polygon_format, elapsed_time, hits
         The requested page number when getting partial results
     page_size        : int
         The maximum number of results to return per call
+    count_mode       : str, optional
+        'exact', 'estimate' or 'none'. Unless exact, the query fetched one
+        row more than page_size to tell whether another page follows
+    offset           : int, optional
+        Number of results that come before this page
+    output_format    : str, optional
+        'json', or 'ndjson' to stream the results from a server-side cursor
+    polygons         : tuple, optional
+        The polygons the query selected, from HUC_POLYGONS
+    level            : int, optional
+        The HUC level the query was filtered on
 
     Returns
     -------
-    dict
-        The constructed response
+    dict or iterator
+        The constructed response, or its NDJSON lines
     """
-    results = cur.fetchall()
+    check_polygon_format(polygon_format)
 
-    data = {}
+    search_on = {
+        "parameter": identifier,
+        "exact": exact,
+        "polygon_format": polygon_format,
+        "page_number": page_number,
+        "page_size": page_size,
+        "count": count_mode
+    }
+    if level is not None:
+        search_on["level"] = level
 
-    if polygon_format and (
-            polygon_format.lower() != 'geojson' and polygon_format.lower() != 'flat'):
-        msg = f'400: Invalid polygon_format. Should be \'flat\' or \'geojson\', but ' \
-              f'\'{polygon_format}\' was given.'
-        raise RequestError(msg)
+    if output_format == 'ndjson':
+        def summarize(results_count, last, has_more):
+            if results_count == 0:
+                raise RequestError(f'404: Results with the specified {identifier} {name} were not found.')
+            return page_metadata(elapsed_time, hits, results_count, count_mode, has_more, offset, search_on)
+
+        return stream_page(iter_rows(cur, NDJSON_BATCH_SIZE), page_size,
+                           lambda elem: dumps_line(huc_result(elem, polygon_format, polygons)), summarize)
+
+    results = cur.fetchall()
+
+    has_more = len(results) > page_size
+    results = results[:page_size]
 
     results_count = len(results)
 
@@ -213,67 +570,251 @@ def return_json(cur, identifier, name, exact, polygon_format, elapsed_time, hits
         msg = f'404: Results with the specified {identifier} {name} were not found.'
         raise RequestError(msg)
 
-    partial_results = False
-    status = "200 OK"
-    if hits > results_count:
-        partial_results = True
-        status = "206 PARTIAL CONTENT"
+    data = page_metadata(elapsed_time, hits, results_count, count_mode, has_more, offset, search_on)
+    data['results'] = [huc_result(elem, polygon_format, polygons) for elem in results]
 
-    data['status'] = status
-    data['time'] = str(elapsed_time) + " ms."
-    data['hits'] = hits
-    if partial_results:
-        data['results_count'] = results_count
+    return data
 
-    data['search on'] = {
-        "parameter": identifier,
-        "exact": exact,
-        "polygon_format": polygon_format,
-        "page_number": page_number,
-        "page_size": page_size
-    }
 
-    result_list = []
-    for elem in results:
-        result_dict = {}
-        huc = elem[0]
-        name = elem[1]
-        convex_hull = elem[2]
-        visvalingam = elem[3]
-        bbox = elem[4]
-
-        result_dict['Region Name'] = name
-        result_dict['HUC'] = huc
-        result_dict['USGS Polygon'] = {
-            'Object URL': OBJECT_URL.format(huc),
-            'Source': SOURCE_URL.format(huc[:2])
-        }
+def page_query_key(identifier, *values):
+    """
+    Build the string which ties a next_token to the query it was created for.
+
+    Parameters
+    ----------
+    identifier : str
+        'reach', 'node' or 'name'
+    values     : tuple
+        The search values that define the result set (name, river_name, exact, ...)
+
+    Returns
+    -------
+    str
+        The query key
+    """
+    return "|".join(str(value) for value in (identifier,) + values)
+
+
+def encode_next_token(page_query, last_key, hits, seen):
+    """
+    Encode an opaque keyset pagination cursor.
 
-        if not polygon_format or polygon_format.lower() == 'flat':
-            result_dict['Bounding Box'] = bbox
-            result_dict['Convex Hull Polygon'] = convex_hull
-            result_dict['Visvalingam Polygon'] = visvalingam
+    Parameters
+    ----------
+    page_query : str
+        The query key from page_query_key
+    last_key   : str
+        The reach_id or node_id of the last row on the current page
+    hits       : int
+        Total number of results that match query result, None when not counted
+    seen       : int
+        Number of results returned so far, including the current page
 
-        elif polygon_format.lower() == 'geojson':
-            convex_hull = convert_flat_list_to_geojson_polygon(convex_hull)
-            visvalingam = convert_flat_list_to_geojson_polygon(visvalingam)
-            bbox = convert_flat_list_bbox_to_geojson_polygon(bbox)
+    Returns
+    -------
+    str
+        URL safe cursor to pass back as next_token
+    """
+    payload = json.dumps({'q': page_query, 'k': last_key, 'h': hits, 's': seen},
+                         separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
 
-            feature_collection = geojson.FeatureCollection([
-                create_feature(bbox, 'bbox'),
-                create_feature(convex_hull, 'Convex Hull'),
-                create_feature(visvalingam, 'Visvalingam')
-            ])
-            result_dict['geojson'] = feature_collection
 
-        result_list.append(result_dict)
+def decode_next_token(token, page_query):
+    """
+    Decode a cursor created by encode_next_token and check that it belongs
+    to the current query.
 
-    data['results'] = result_list
+    Parameters
+    ----------
+    token      : str
+        The next_token given in the request
+    page_query : str
+        The query key from page_query_key
 
-    return data
+    Returns
+    -------
+    dict
+        'last' key, total 'hits' and number of results 'seen' so far
+    """
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        hits = None if payload['h'] is None else int(payload['h'])
+        page_token = {'last': str(payload['k']), 'hits': hits, 'seen': int(payload['s'])}
+        matches = payload['q'] == page_query
+    except (ValueError, TypeError, KeyError, binascii.Error) as ex:
+        raise RequestError('400: Invalid next_token.') from ex
+
+    if not matches:
+        raise RequestError('400: next_token does not belong to this query.')
+
+    return page_token
+
+
+def keyset_predicate(column, page_token):
+    """
+    Build the SQL predicate which starts a page after the last key of the
+    previous page.
+
+    Parameters
+    ----------
+    column     : str
+        The column the page is ordered by
+    page_token : dict
+        Decoded next_token, or None for offset based pages
+
+    Returns
+    -------
+    tuple
+        SQL fragment (empty when page_token is None) and its arguments
+    """
+    if not page_token:
+        return "", ()
+    return f" AND {column} > %s", (page_token['last'],)
+
+
+def run_hits_count(cur, query, args, estimate=False):
+    """
+    Run a COUNT(*) query, or ask the optimizer for its row estimate of it.
+
+    Parameters
+    ----------
+    cur        : pymysql.cursor
+        pymysql connection cursor
+    query      : str
+        The COUNT(*) query
+    args       : tuple or str
+        The query arguments
+    estimate   : bool
+        Return the EXPLAIN row estimate instead of counting rows
+
+    Returns
+    -------
+    int
+        Row count
+    """
+    if not estimate:
+        cur.execute(query, args)
+        hits = cur.fetchall()
+        return hits[0][0]
+
+    # Rows examined per table times the share expected to pass the WHERE clause
+    cur.execute("EXPLAIN " + query, args)
+    plan = cur.fetchall()
+    columns = [column[0] for column in cur.description]
+    rows_index = columns.index('rows')
+    filtered_index = columns.index('filtered') if 'filtered' in columns else None
+
+    hits = 1.0
+    for step in plan:
+        filtered = step[filtered_index] if filtered_index is not None else None
+        hits *= float(step[rows_index] or 0) * float(100 if filtered is None else filtered) / 100
+
+    return int(round(hits))
+
+
+def start_hits_count(count, cur, *args, **kwargs):
+    """
+    Start counting the hits of a first page.
+
+    With PARALLEL_COUNT and a free connection in the pool, the count runs
+    on that connection from a worker thread while the caller runs the page
+    query on cur, so the request takes about as long as the slower of the
+    two queries instead of both. Otherwise the count runs on cur first. A
+    connection error of the worker is raised as ParallelCountError.
+
+    Parameters
+    ----------
+    count      : callable
+        run_hits_count or one of the get_*_hits_count functions
+    cur        : pymysql.cursor
+        pymysql connection cursor of the request
+    args, kwargs
+        Arguments of count after the cursor
+
+    Returns
+    -------
+    callable
+        Returns the count, waiting for it if it is still running. Call it
+        after running the page query.
+    """
+    def timed_count(count_cur):
+        started = time.time()
+        return count(count_cur, *args, **kwargs), (time.time() - started) * 1000
+
+    future = connections.submit(timed_count) if PARALLEL_COUNT else None
+    if future is None:
+        hits = count(cur, *args, **kwargs)
+        return lambda: hits
+
+    def wait():
+        try:
+            hits, duration = future.result()
+        except (pymysql.OperationalError, pymysql.InterfaceError) as ex:
+            # The pool has already dropped the worker's connection
+            raise ParallelCountError(*ex.args) from ex
+        if isinstance(cur, TimedCursor):
+            cur.add_concurrent_query('count_query', duration)
+        return hits
+    return wait
+
+
+def is_partial_results(hits, results_count, count_mode, has_more, offset):
+    """
+    Tell whether a page holds only part of the matching results.
+
+    Parameters
+    ----------
+    hits               : int
+        Total number of results, None when not counted
+    results_count      : int
+        Number of results on this page
+    count_mode         : str
+        'exact', 'estimate' or 'none'
+    has_more           : bool
+        True if another page follows
+    offset             : int
+        Number of results that come before this page
+
+    Returns
+    -------
+    bool
+        True if the results are partial
+    """
+    if count_mode == 'exact':
+        return hits > results_count
+    return has_more or offset > 0
+
+
+def huc_level_filter(level, huc=''):
+    """
+    Build the huc_level condition of a partial HUC query.
+
+    With a level, the (huc_level, HUC) index is read as one range. Without
+    one, every level a HUC starting with huc can have is listed, so MySQL
+    reads one range per level in (huc_level, HUC) order and the ORDER BY
+    needs no sort.
+
+    Parameters
+    ----------
+    level      : int
+        Number of HUC digits to return, or None for all levels
+    huc        : str, optional
+        The huc search field
+
+    Returns
+    -------
+    tuple
+        The condition, and its arguments
+    """
+    if level is not None:
+        return "`huc_level` = %s", (level,)
+    levels = tuple(digits for digits in HUC_LEVELS if digits >= len(huc)) or (len(huc),)
+    return f"`huc_level` IN ({', '.join(['%s'] * len(levels))})", levels
 
 
-def get_huc_hits_count(cur, huc):
+def get_huc_hits_count(cur, huc, exact=False, estimate=False, level=None):  # pylint: disable=too-many-positional-arguments
     """
     Get the row/hit count for the given HUC query.
 
@@ -283,20 +824,30 @@ def get_huc_hits_count(cur, huc):
         pymysql connection cursor
     huc        : str
         The huc search field
+    exact      : bool
+        True if an exact HUC should be counted
+    estimate   : bool
+        Return the optimizer row estimate instead of an exact count
+    level      : int, optional
+        Only count HUCs with this many digits
 
     Returns
     -------
     int
         Row count
     """
-    cur.execute("select COUNT(*) from huc_table where `HUC` LIKE %s", huc + "%")
-
-    hits = cur.fetchall()
+    if exact:
+        if level is not None:
+            return run_hits_count(cur, "select COUNT(*) from huc_table where `HUC` = %s AND `huc_level` = %s",
+                                  (huc, level), estimate)
+        return run_hits_count(cur, "select COUNT(*) from huc_table where `HUC` = %s", huc, estimate)
 
-    return hits[0][0]
+    condition, args = huc_level_filter(level, huc)
+    return run_hits_count(cur, f"select COUNT(*) from huc_table where {condition} AND `HUC` LIKE %s",
+                          args + (huc + "%",), estimate)
 
 
-def get_region_hits_count(cur, region):
+def get_region_hits_count(cur, region, exact=False, estimate=False, level=None):  # pylint: disable=too-many-positional-arguments
     """
     Get the row/hit count for the given region query.
 
@@ -306,20 +857,62 @@ def get_region_hits_count(cur, region):
         pymysql connection cursor
     region        : str
         The region search field
+    exact      : bool
+        True if an exact region should be counted
+    estimate   : bool
+        Return the optimizer row estimate instead of an exact count
+    level      : int, optional
+        Only count HUCs with this many digits
 
     Returns
     -------
     int
         Row count
     """
-    cur.execute("select COUNT(*) from huc_table where `Region` LIKE %s", region + "%")
+    condition = "`Region` = %s" if exact else "`Region` LIKE %s"
+    args = (region if exact else region + "%",)
+    if level is not None:
+        condition += " AND `huc_level` = %s"
+        args += (level,)
+    return run_hits_count(cur, f"select COUNT(*) from huc_table where {condition}", args, estimate)
+
+
+def id_prefix_predicate(column, prefix, page_token=None):
+    """
+    Build the SQL predicate of a partial reach or node id query, starting
+    after the last key of the previous page.
+
+    SWORD ids are fixed width digit codes, so the ids starting with a digit
+    prefix are the numbers from the prefix padded with 0s to the prefix
+    padded with 9s: a range on the indexed BIGINT copy of the id, which
+    also orders the same as the id. Other prefixes match the id with LIKE.
 
-    hits = cur.fetchall()
+    Parameters
+    ----------
+    column     : str
+        'reach_id' or 'node_id'
+    prefix     : str
+        The id search field
+    page_token : dict, optional
+        Decoded next_token, or None for offset based pages
+
+    Returns
+    -------
+    tuple
+        SQL fragment, its arguments, and the column to order the page by
+    """
+    number_column, digits = ID_NUMBER_COLUMNS[column]
+    if prefix.isascii() and prefix.isdigit() and len(prefix) <= digits:
+        keyset, keyset_args = keyset_predicate(number_column, page_token)
+        return (f"{number_column} BETWEEN %s AND %s" + keyset,
+                (int(prefix.ljust(digits, '0')), int(prefix.ljust(digits, '9')))
+                + tuple(int(value) for value in keyset_args), number_column)
 
-    return hits[0][0]
+    keyset, keyset_args = keyset_predicate(column, page_token)
+    return f"{column} LIKE %s" + keyset, (prefix + "%",) + keyset_args, column
 
 
-def get_reach_hits_count(cur, reach, river_name):
+def get_reach_hits_count(cur, reach, river_name, exact=False, estimate=False):
     """
     Get the row/hit count for the given reach query.
 
@@ -331,24 +924,29 @@ def get_reach_hits_count(cur, reach, river_name):
         The reach search field
     river_name        : str
         The river_name search field
+    exact      : bool
+        True if an exact reach should be counted
+    estimate   : bool
+        Return the optimizer row estimate instead of an exact count
 
     Returns
     -------
     int
         Row count
     """
-    if river_name:
-        args = (reach + "%", river_name + "%")
-        cur.execute("SELECT COUNT(*) FROM reaches WHERE reach_id LIKE %s AND river_name LIKE %s", args)
+    if exact:
+        condition, args = "reach_id = %s", (reach,)
     else:
-        cur.execute("SELECT COUNT(*) FROM reaches WHERE reach_id LIKE %s", reach + "%")
+        condition, args, _ = id_prefix_predicate("reach_id", reach)
 
-    hits = cur.fetchall()
+    if river_name:
+        return run_hits_count(cur, f"SELECT COUNT(*) FROM reaches WHERE {condition} AND river_name LIKE %s",
+                              args + (river_name + "%",), estimate)
 
-    return hits[0][0]
+    return run_hits_count(cur, f"SELECT COUNT(*) FROM reaches WHERE {condition}", args, estimate)
 
 
-def get_river_name_hits_count(cur, name, include_reaches, include_nodes):
+def get_river_name_hits_count(cur, name, include_reaches, include_nodes, estimate=False, exact=False):  # pylint: disable=too-many-positional-arguments
     """
     Get the row/hit count for the given river query.
 
@@ -362,29 +960,30 @@ def get_river_name_hits_count(cur, name, include_reaches, include_nodes):
         Include reaches in results if True, otherwise exclude reaches in result
     include_nodes      : bool
         Include nodes in results if True, otherwise exclude reaches in result
+    estimate   : bool
+        Return the optimizer row estimate instead of an exact count
+    exact      : bool
+        True if an exact river name should be counted
 
     Returns
     -------
     int
         Row count
     """
+    condition = "river_name = %s" if exact else "river_name LIKE %s"
+    value = name if exact else name + "%"
     if include_nodes and include_reaches:
-        args = (name + "%", name + "%")
-        cur.execute("SELECT COUNT(*) FROM reaches, nodes WHERE reaches.reach_id = nodes.reach_id AND reaches.river_name LIKE %s AND nodes.river_name LIKE %s", args)
-    elif include_nodes:
-        cur.execute("SELECT COUNT(*) FROM nodes WHERE river_name LIKE %s", name)
-    elif include_reaches:
-        cur.execute("SELECT COUNT(*) FROM reaches WHERE river_name LIKE %s", name)
-    else:
-        msg = '400: Both reaches and nodes are false.  At least one must be set to true.'
-        raise RequestError(msg)
+        return run_hits_count(cur, f"SELECT COUNT(*) FROM {RIVER_JOIN} WHERE reaches.{condition}", value, estimate)
+    if include_nodes:
+        return run_hits_count(cur, f"SELECT COUNT(*) FROM nodes WHERE {condition}", value, estimate)
+    if include_reaches:
+        return run_hits_count(cur, f"SELECT COUNT(*) FROM reaches WHERE {condition}", value, estimate)
 
-    hits = cur.fetchall()
+    msg = '400: Both reaches and nodes are false.  At least one must be set to true.'
+    raise RequestError(msg)
 
-    return hits[0][0]
 
-
-def get_node_hits_count(cur, node, river_name):
+def get_node_hits_count(cur, node, river_name, exact=False, estimate=False):
     """
     Get the row/hit count for the given node query.
 
@@ -396,148 +995,1178 @@ def get_node_hits_count(cur, node, river_name):
         The node search field
     river_name        : str
         The river_name search field
+    exact      : bool
+        True if an exact node should be counted
+    estimate   : bool
+        Return the optimizer row estimate instead of an exact count
 
     Returns
     -------
     int
         Row count
     """
-    if river_name:
-        args = (node + "%", river_name + "%")
-        cur.execute("SELECT COUNT(*) FROM nodes WHERE node_id LIKE %s AND river_name LIKE %s", args)
+    if exact:
+        condition, args = "node_id = %s", (node,)
     else:
-        cur.execute("SELECT COUNT(*) FROM nodes WHERE node_id LIKE %s", node + "%")
+        condition, args, _ = id_prefix_predicate("node_id", node)
 
-    hits = cur.fetchall()
+    if river_name:
+        return run_hits_count(cur, f"SELECT COUNT(*) FROM nodes WHERE {condition} AND river_name LIKE %s",
+                              args + (river_name + "%",), estimate)
 
-    return hits[0][0]
+    return run_hits_count(cur, f"SELECT COUNT(*) FROM nodes WHERE {condition}", args, estimate)
 
 
-def lambda_handler(event, context):
+def get_count_mode(body):
     """
-    This function queries the HUC database for relevant results
-    """
-    with conn.cursor() as cur:
+    Read the count and count_only request parameters.
 
-        # Start a timer to measure query time.
-        start = time.time()
-
-        # Default inputs
-        polygon_format = ''
-        page_number = 1
-        page_size = 100
-        exact = False
-        hits = 1
+    Parameters
+    ----------
+    body       : dict
+        The request body
 
-        if 'polygon_format' in event['body']:
-            polygon_format = event['body']['polygon_format'].lower()
+    Returns
+    -------
+    tuple
+        count mode ('exact', 'estimate' or 'none') and the count_only flag
+    """
+    count_mode = 'exact'
+    count_only = False
 
-        if 'page_number' in event['body'] and event['body']['page_number'] != '':
-            try:
-                page_number = int(event['body']['page_number'])
-                if page_number < 1:
-                    raise ValueError
-            except ValueError as ex:
-                raise ValueError("400: page_number must be a number, 1 or greater.") from ex
+    if 'count' in body and body['count'] != '':
+        count_mode = body['count'].lower()
+        if count_mode not in COUNT_MODES:
+            msg = f'400: Invalid count. Should be one of {", ".join(COUNT_MODES)}, but \'{body["count"]}\' was given.'
+            raise RequestError(msg)
 
-        if 'page_size' in event['body'] and event['body']['page_size'] != '':
-            try:
-                page_size = int(event['body']['page_size'])
-                if page_size < 1:
-                    raise ValueError
-            except ValueError as ex:
-                raise ValueError("400: page_size must be a number, 1 or greater.") from ex
+    if 'count_only' in body and body['count_only'].lower() == "true":
+        count_only = True
+        if count_mode == 'none':
+            raise RequestError('400: count_only cannot be combined with count=none.')
 
-        if 'exact' in event['body'] and event['body']['exact'].lower() == "true":
-            exact = True
+    return count_mode, count_only
 
-        offset = page_size * (page_number - 1)
 
-        # Entered if the user queries by HUC
-        if "HUC" in event['body']:
+def get_output_format(body):
+    """
+    Parse the format parameter.
 
-            huc = event['body']['HUC']
+    Parameters
+    ----------
+    body : dict
+        The request parameters
 
-            # User queries an exact HUC
-            if exact:
-                cur.execute("select * from huc_table where `HUC` = %s", huc)
-            # User queries partial HUC
-            else:
-                hits = get_huc_hits_count(cur, huc)
+    Returns
+    -------
+    str
+        'json' or 'ndjson'
+    """
+    output_format = body.get('format', '').lower() or 'json'
+    if output_format not in OUTPUT_FORMATS:
+        msg = f'400: Invalid format. Should be \'json\' or \'ndjson\', but \'{body["format"]}\' was given.'
+        raise RequestError(msg)
+    return output_format
 
-                args = (huc + "%", offset, page_size)
 
-                cur.execute("select * from huc_table"
-                            " where `HUC` LIKE %s ORDER BY CHAR_LENGTH(HUC), HUC LIMIT %s,%s",
-                            args)
+def get_fields(body):
+    """
+    Parse the fields and include_geometry parameters.
 
-            elapsed_time = round((time.time() - start) * 1000, 3)
-            return return_json(cur, "HUC", huc, exact, polygon_format, elapsed_time, hits,
-                               page_number, page_size)
+    Parameters
+    ----------
+    body : dict
+        The request parameters
 
-        # Similar process for region
-        elif "region" in event['body']:
+    Returns
+    -------
+    tuple
+        The requested fields, or None for all of them, and whether
+        geometries are included
+    """
+    fields = None
+    if body.get('fields', '').strip():
+        fields = []
+        for field in body['fields'].split(','):
+            field = field.strip()
+            if field and field not in fields:
+                fields.append(field)
+        fields = tuple(fields)
 
-            # Handle spaces in request
-            region = " ".join(event['body']['region'].split("%20"))
+    include_geometry = body.get('include_geometry', '').lower() != 'false'
+    return fields, include_geometry
 
-            # User queries exact region
-            if exact:
-                cur.execute("select * from huc_table where `Region` = %s", region)
-            # User queries partial region match
-            else:
-                hits = get_region_hits_count(cur, region)
 
-                args = (region + "%", offset, page_size)
-                cur.execute("select * from huc_table"
-                            " where `Region` LIKE %s ORDER BY CHAR_LENGTH(HUC), HUC LIMIT %s,%s",
-                            args)
+def get_geometry_reduction(body):
+    """
+    Parse the precision and simplify parameters.
 
-            elapsed_time = round((time.time() - start) * 1000, 3)
-            return return_json(cur, "region", region, exact, polygon_format, elapsed_time, hits,
-                               page_number, page_size)
+    Parameters
+    ----------
+    body : dict
+        The request parameters
 
-        # Similar process for reach
-        elif "reach" in event['body']:
+    Returns
+    -------
+    tuple
+        Decimal places and simplification tolerance in metres, each None
+        when not requested
+    """
+    precision = None
+    simplify = None
 
-            # Handle spaces in request
-            reach = " ".join(event['body']['reach'].split("%20"))
-            river_name = " ".join(event['body']['river_name'].split("%20"))
+    if body.get('precision', '') != '':
+        try:
+            precision = int(body['precision'])
+            if not 0 <= precision <= MAX_PRECISION:
+                raise ValueError
+        except ValueError as ex:
+            raise RequestError(f"400: precision must be a number from 0 to {MAX_PRECISION}.") from ex
 
-            return process_reach(reach, river_name, exact, cur, start, page_number, page_size)
-        # Similar process for node
-        elif "node" in event['body']:
+    if body.get('simplify', '') != '':
+        try:
+            simplify = float(body['simplify'])
+            if not 0 < simplify < float('inf'):
+                raise ValueError
+        except ValueError as ex:
+            raise RequestError("400: simplify must be a number of metres, greater than 0.") from ex
 
-            # Handle spaces in request
-            node = " ".join(event['body']['node'].split("%20"))
-            river_name = " ".join(event['body']['river_name'].split("%20"))
+    return precision, simplify
 
-            return process_node(node, river_name, exact, cur, start, page_number, page_size)
-        # process for rivers name
-        elif "name" in event['body']:
 
-            # Handle spaces in request
-            river_name = " ".join(event['body']['name'].split("%20"))
-            #   path = context['path']
+def huc_polygons(fields, include_geometry):
+    """
+    Get the HUC polygons a request asks for.
 
-            include_reaches = True
-            include_nodes = True
+    Parameters
+    ----------
+    fields : tuple
+        Requested polygons, or None for all of them
+    include_geometry : bool
+        False to leave out all polygons
 
-            if 'nodes' in event['body'] and event['body']['nodes'].lower() == "false":
-                include_nodes = False
+    Returns
+    -------
+    tuple
+        The polygons, in HUC_POLYGONS order
+    """
+    if not include_geometry:
+        return ()
+    if fields is None:
+        return HUC_POLYGONS
+
+    invalid = [field for field in fields if field not in HUC_POLYGON_COLUMNS]
+    if invalid:
+        msg = f'400: Invalid fields: {", ".join(invalid)}. Valid fields are: {", ".join(HUC_POLYGONS)}.'
+        raise RequestError(msg)
+    return tuple(polygon for polygon in HUC_POLYGONS if polygon in fields)
 
-            if 'reaches' in event['body'] and event['body']['reaches'].lower() == "false":
-                include_reaches = False
 
-            return process_river(river_name, exact, cur, start, include_reaches, include_nodes, page_number,
-                                 page_size)
-        else:
-            # Return 400 error assuming path is incorrect.
-            msg = "400: The specified URL is invalid (does not exist)."
+def river_columns(tables, key_column, fields=None, include_geometry=True, fragment=False):  # pylint: disable=too-many-positional-arguments
+    """
+    Build the select list of a reaches and/or nodes query, so only the
+    requested columns are read.
+
+    Parameters
+    ----------
+    tables : tuple
+        ('reaches',), ('nodes',) or ('reaches', 'nodes') for the join
+    key_column : str
+        Column the results are keyed and paged on; always selected
+    fields : tuple, optional
+        Requested columns, or None for all of them
+    include_geometry : bool, optional
+        False to leave out the geometry and geojson columns
+    fragment : bool, optional
+        True to read the pre-rendered result of each row when all its
+        columns are requested from a single table
+
+    Returns
+    -------
+    str
+        The select list
+    """
+    if fields is None and include_geometry:
+        if fragment and len(tables) == 1:
+            return f"`{key_column}`, `{JSON_FRAGMENT_COLUMN}`"
+        return ", ".join(f"{table}.*" for table in tables) if len(tables) > 1 else "*"
+
+    # Columns of the joined tables which share a name are read from the last
+    # table, the same value SELECT reaches.*, nodes.* results end up with
+    owners = {}
+    for table in tables:
+        for column in RIVER_TABLE_COLUMNS[table]:
+            owners[column] = table
+
+    if fields is None:
+        fields = tuple(owners)
+    invalid = [field for field in fields if field not in owners]
+    if invalid:
+        msg = f'400: Invalid fields: {", ".join(invalid)}. Valid fields are: {", ".join(owners)}.'
+        raise RequestError(msg)
+
+    selected = [key_column] + [field for field in fields if field != key_column]
+    if not include_geometry:
+        selected = [column for column in selected if column not in GEOMETRY_COLUMNS]
+
+    if len(tables) > 1:
+        return ", ".join(f"{owners[column]}.`{column}`" for column in selected)
+    return ", ".join(f"`{column}`" for column in selected)
+
+
+def get_batch_ids(body):
+    """
+    Parse the ids of a batch lookup.
+
+    Parameters
+    ----------
+    body : dict
+        The request parameters; 'ids' is a list, or a comma separated string
+
+    Returns
+    -------
+    list
+        The distinct ids, in request order
+    """
+    ids = body.get('ids')
+    if isinstance(ids, str):
+        ids = ids.split(',')
+    if not isinstance(ids, list):
+        raise RequestError('400: ids must be a list of ids.')
+
+    ids = list(dict.fromkeys(str(value).strip() for value in ids if str(value).strip()))
+    if not ids:
+        raise RequestError('400: ids must be a list of ids.')
+    if len(ids) > BATCH_MAX_IDS:
+        raise RequestError(f'400: At most {BATCH_MAX_IDS} ids can be looked up at once, but {len(ids)} were given.')
+    return ids
+
+
+def drop_hidden_columns(res):
+    """
+    Remove the columns which SELECT * reads but results leave out.
+
+    Parameters
+    ----------
+    res : dict
+        A reaches and/or nodes row, changed in place
+    """
+    for column in HIDDEN_RIVER_COLUMNS:
+        res.pop(column, None)
+
+
+def parse_coordinates(text, msg):
+    """
+    Parse a comma delimited list of longitude, latitude pairs.
+
+    Parameters
+    ----------
+    text : str
+        lon,lat,lon,lat,... in degrees
+    msg  : str
+        Error message if the list is not valid
+
+    Returns
+    -------
+    list
+        (lon, lat) tuples
+    """
+    try:
+        values = [float(value) for value in text.split(',')]
+    except ValueError as ex:
+        raise RequestError(msg) from ex
+    points = list(zip(values[::2], values[1::2]))
+    if len(values) % 2 or not all(-180 <= lon <= 180 and -90 <= lat <= 90 for lon, lat in points):
+        raise RequestError(msg)
+    return points
+
+
+def parse_polygon(text):
+    """
+    Parse a polygon given as the lon,lat points of its exterior ring.
+
+    Parameters
+    ----------
+    text : str
+        lon,lat,lon,lat,... in degrees, closed or not
+
+    Returns
+    -------
+    list
+        (lon, lat) tuples of the ring, without the closing point
+    """
+    msg = '400: polygon must be at least 3 lon,lat points in degrees.'
+    points = parse_coordinates(text, msg)
+    if points and points[0] == points[-1]:
+        points = points[:-1]
+    if len(points) < 3:
+        raise RequestError(msg)
+    return points
+
+
+def get_spatial_area(body):
+    """
+    Parse the area of a spatial query.
+
+    Parameters
+    ----------
+    body : dict
+        The request parameters, with either 'bbox' (west,south,east,north)
+        or 'polygon' (lon,lat,lon,lat,... of its exterior ring)
+
+    Returns
+    -------
+    tuple
+        'bbox' or 'polygon', the parameter value and the area as WKT
+    """
+    bbox = str(body.get('bbox', '')).strip()
+    polygon = str(body.get('polygon', '')).strip()
+    if bool(bbox) == bool(polygon):
+        raise RequestError('400: Exactly one of bbox and polygon must be given.')
+
+    if bbox:
+        msg = '400: bbox must be west,south,east,north in degrees, with west <= east and south <= north.'
+        points = parse_coordinates(bbox, msg)
+        if len(points) != 2 or points[0][0] > points[1][0] or points[0][1] > points[1][1]:
+            raise RequestError(msg)
+        (west, south), (east, north) = points
+        points = [(west, south), (east, south), (east, north), (west, north)]
+        identifier, value = 'bbox', bbox
+    else:
+        points = parse_polygon(polygon)
+        identifier, value = 'polygon', polygon
+
+    ring = ", ".join(f"{lon!r} {lat!r}" for lon, lat in points + points[:1])
+    return identifier, value, f"POLYGON(({ring}))"
+
+
+def get_attribute_filters(body):
+    """
+    Parse the attribute filters of a spatial query.
+
+    Parameters
+    ----------
+    body : dict
+        The request parameters
+
+    Returns
+    -------
+    tuple
+        SQL fragment (empty without filters) and its arguments
+    """
+    sql, args = "", ()
+    for param, (column, operator) in ATTRIBUTE_FILTERS.items():
+        value = str(body.get(param, '')).strip()
+        if not value:
+            continue
+        try:
+            number = float(value)
+            if not -float('inf') < number < float('inf'):
+                raise ValueError
+        except ValueError as ex:
+            raise RequestError(f'400: {param} must be a number.') from ex
+        sql += f" AND `{column}` {operator} %s"
+        args += (number,)
+    return sql, args
+
+
+def use_json_fragments(output_format, precision, simplify):
+    """
+    Tell whether results can be read pre-rendered. The fragments hold the
+    JSON results with geojson at its default precision, so NDJSON, which
+    passes the stored geojson through, and reduced geometries are built from
+    the columns.
+
+    Parameters
+    ----------
+    output_format : str
+        'json' or 'ndjson'
+    precision     : int
+        Requested geojson precision, or None
+    simplify      : float
+        Requested simplification tolerance, or None
+
+    Returns
+    -------
+    bool
+        True if the fragments are loaded and give the requested results
+    """
+    return JSON_FRAGMENTS and output_format == 'json' and precision is None and simplify is None
+
+
+def return_count_json(identifier, name, exact, elapsed_time, hits, count_mode):  # pylint: disable=too-many-positional-arguments
+    """
+    Construct the response for a count_only request, which has no results.
+
+    Parameters
+    ----------
+    identifier : str
+        'HUC', 'region', 'reach', 'node' or 'name'
+    name       : str
+        The searched value
+    exact      : bool
+        True if an exact match was counted
+    elapsed_time       : int
+        Number of ms to query DB
+    hits               : int
+        Total number of results that match query result
+    count_mode         : str
+        'exact' or 'estimate'
+
+    Returns
+    -------
+    dict
+        The constructed response
+    """
+    return {
+        'status': "200 OK",
+        'time': str(elapsed_time) + " ms.",
+        'hits': hits,
+        'search on': {
+            "parameter": identifier,
+            "value": name,
+            "exact": exact,
+            "count": count_mode,
+            "count_only": True
+        }
+    }
+
+
+def lambda_handler(event, context):
+    """
+    This function queries the HUC database for relevant results
+    """
+    start = time.time()
+    timer = RequestTimer(start)
+    status = '500'
+    event = proxy_request(event)
+    proxy = 'headers' in event
+    try:
+        body = get_response(event, start, timer)
+        timer.bytes = len(body)
+        timer.lap('serialize')
+        if event['body'].get('debug_timing', '').lower() == 'true':
+            body = with_attributes(body, {'debug_timing': dict(
+                timer.summary(), source=timer.source, connections=connections.stats(), cache=result_cache.stats())})
+        headers = validator_headers(event, normalize_request(event['body']))
+        if headers and not proxy:
+            # The REST API response templates set the headers from these
+            body = with_attributes(body, {'etag': headers['ETag'], 'cache_control': headers['Cache-Control']})
+        response = http_response(body, accepted_encoding(event.get('headers')),
+                                 206 if response_status(body).startswith('206') else 200,
+                                 headers if proxy else None)
+        status = '200'
+        return response
+    except RequestError as ex:
+        status = str(ex)[:3]
+        if not proxy:
+            # Mapped to a status by the integration responses of the REST API
+            raise
+        return error_response(event, ex)
+    finally:
+        if METRICS_ENABLED:
+            timer.lap('serialize')
+            timer.emit(request_dimensions(event['body']), {'status': status, 'source': timer.source})
+
+
+def proxy_request(event):
+    """
+    Turn a proxy integration event into the event the request templates of
+    the REST API build: the request parameters in 'body', from the query
+    string, the path and a JSON body, with the request headers.
+
+    Parameters
+    ----------
+    event : dict
+        The lambda event
+
+    Returns
+    -------
+    dict
+        The event with the request parameters in 'body', and 'headers' if
+        the response is returned to a proxy integration
+    """
+    if isinstance(event.get('body'), dict):
+        return event
+    (fixed, path_params), path = proxy_route(event)
+    params = {'river_name': ''}
+    params.update(event.get('queryStringParameters') or {})
+
+    body = event.get('body') or ''
+    try:
+        if event.get('isBase64Encoded'):
+            body = base64.b64decode(body).decode('utf-8')
+        body = json.loads(body) if body else {}
+    except ValueError:
+        # Left to the request checks, as a body without the parameters
+        body = {}
+    if isinstance(body, dict):
+        params.update({name: body[name] for name in PROXY_BODY_PARAMS if name in body})
+
+    params.update({param: path[name] for name, param in path_params.items() if name in path})
+    params.update(fixed)
+    return {'body': params, 'headers': event.get('headers') or {}}
+
+
+def proxy_route(event):
+    """
+    Find the resource of a proxy integration event in PROXY_ROUTES.
+
+    Parameters
+    ----------
+    event : dict
+        The lambda event
+
+    Returns
+    -------
+    tuple
+        The fixed and path parameters of the resource, empty if it is not
+        one of PROXY_ROUTES, and the path parameters of the request
+    """
+    # REST API events name the resource, HTTP API events the method and route
+    resource = event.get('resource') or event.get('routeKey', '').partition(' ')[2]
+    if resource in PROXY_ROUTES:
+        return PROXY_ROUTES[resource], event.get('pathParameters') or {}
+
+    # Function URL and load balancer events only have the path
+    parts = (event.get('rawPath') or event.get('path') or '').strip('/').split('/')
+    for route, params in PROXY_ROUTES.items():
+        segments = route.strip('/').split('/')
+        if len(segments) == len(parts) and all(
+                segment == part or segment.startswith('{') for segment, part in zip(segments, parts)):
+            return params, {segment[1:-1]: urllib.parse.unquote(part)
+                            for segment, part in zip(segments, parts) if segment.startswith('{')}
+    return ({}, {}), {}
+
+
+def error_response(event, error):
+    """
+    Build the proxy integration response of a request error, as the
+    integration responses of the REST API do.
+
+    Parameters
+    ----------
+    event : dict
+        The lambda event, with the request parameters in 'body'
+    error : RequestError
+        The error, its message starting with the HTTP status
+
+    Returns
+    -------
+    dict
+        The response
+    """
+    message = str(error)
+    if message.startswith('304'):
+        return {'statusCode': 304, 'headers': validator_headers(event, normalize_request(event['body'])),
+                'body': ''}
+    status_code = int(message[:3]) if message[:3].isdigit() and message[0] in '45' else 500
+    return {'statusCode': status_code, 'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': message})}
+
+
+def validator_headers(event, cache_key):
+    """
+    Build the ETag and Cache-Control of a response.
+
+    Parameters
+    ----------
+    event      : dict
+        The lambda event, with the request parameters in 'body'
+    cache_key  : tuple
+        The normalized request
+
+    Returns
+    -------
+    dict
+        ETag and Cache-Control headers, empty if the response has no
+        validators or no loader stamped a dataset version yet
+    """
+    if not ETAGS_ENABLED or dataset_version.value is None or any(
+            param in event['body'] for param in UNVERSIONED_PARAMS):
+        return {}
+    return {'ETag': response_etag(dataset_version.value, cache_key), 'Cache-Control': cache_control(CACHE_MAX_AGE)}
+
+
+def check_not_modified(event, cache_key, timer):
+    """
+    Answer a request with 304 Not Modified if its If-None-Match holds the
+    ETag of the response, which needs no query as the ETag only depends
+    on the dataset version and the request.
+
+    Parameters
+    ----------
+    event      : dict
+        The lambda event, with the request parameters in 'body'
+    cache_key  : tuple
+        The normalized request
+    timer      : RequestTimer
+        Phase timer of the request
+
+    Raises
+    ------
+    RequestError
+        304 when the client has the response
+    """
+    condition = if_none_match(event)
+    if not condition:
+        return
+    etag = validator_headers(event, cache_key).get('ETag')
+    if etag is not None and etag_matches(condition, etag):
+        timer.source = 'not_modified'
+        raise RequestError(f'304: Not Modified {etag}')
+
+
+def http_response(body, encoding, status_code, headers=None):
+    """
+    Compress a response of at least COMPRESSION_MIN_BYTES, and add the
+    headers of proxy integration responses.
+
+    Parameters
+    ----------
+    body       : bytes
+        The response as JSON
+    encoding   : str
+        'br' or 'gzip' from the Accept-Encoding header, or None
+    status_code : int
+        HTTP status of the response
+    headers    : dict, optional
+        Headers to send with the response, for proxy integration events
+
+    Returns
+    -------
+    dict or bytes
+        The response, compressed into a binary response if it is large
+        enough, with the headers if given, or else the JSON which the
+        Lambda runtime passes through
+    """
+    if encoding is not None and len(body) >= COMPRESSION_MIN_BYTES:
+        return compressed_response(body, encoding, status_code, headers)
+    if headers is not None:
+        return {'statusCode': status_code, 'headers': {**headers, 'Content-Type': 'application/json'},
+                'body': body.decode('utf-8')}
+    return body
+
+
+def get_response(event, start, timer):
+    """
+    Answer a request from the HUC index, the caches or the database.
+
+    Parameters
+    ----------
+    event      : dict
+        The lambda event, with the request parameters in 'body'
+    start      : float
+        Time the request started
+    timer      : RequestTimer
+        Phase timer of the request
+
+    Returns
+    -------
+    bytes
+        The response as JSON
+    """
+    if 'lookup' in event['body']:
+        # Answered from the in-memory HUC index, without the database
+        timer.lap('parse')
+        response = lookup_huc(event['body'], start)
+        timer.source = 'huc_index'
+        timer.lap('page_query')
+        return encode_response(response)
+
+    cache_key = normalize_request(event['body'])
+    # NDJSON pages can be many MB, and are built line by line rather than cached
+    cacheable = get_output_format(event['body']) != 'ndjson'
+    timer.lap('parse')
+
+    if not dataset_version.is_stale():
+        check_not_modified(event, cache_key, timer)
+        response = get_cached_response(cache_key, start) if cacheable else None
+        if response is not None:
+            timer.source = 'cache'
+            timer.lap('fetch')
+            return response
+
+    try:
+        response = query_database(event, cache_key, start, timer)
+    except (pymysql.OperationalError, ParallelCountError) as ex:
+        # Queries are read only, so retry once on a fresh connection if the
+        # server dropped this one, or the parallel count's, mid request
+        if ex.args[0] not in LOST_CONNECTION_ERRORS:
+            raise
+        logger.info("MySQL connection lost during request, retrying: %s", ex)
+        response = query_database(event, cache_key, start, timer)
+    return response
+
+
+def request_dimensions(body):
+    """
+    Get the metric dimensions of a request.
+
+    Parameters
+    ----------
+    body : dict
+        The request parameters
+
+    Returns
+    -------
+    dict
+        The endpoint, whether the match is exact, and the output format
+    """
+    endpoint = next((param for param in ENDPOINT_PARAMS if param in body), 'unknown')
+    return {
+        'endpoint': ENDPOINT_PARAMS.get(endpoint, endpoint),
+        'exact': str(str(body.get('exact', '')).lower() == 'true').lower(),
+        'format': str(body.get('format', '')).lower() or 'json',
+    }
+
+
+def get_huc_level(body):
+    """
+    Parse the HUC level filter of a HUC, region or reverse lookup query.
+
+    Parameters
+    ----------
+    body : dict
+        The request parameters
+
+    Returns
+    -------
+    int
+        Number of HUC digits to return, or None for all levels
+    """
+    level = str(body.get('level', '')).strip()
+    if not level:
+        return None
+    if not level.isdigit() or int(level) not in HUC_LEVELS:
+        raise RequestError('400: level must be a number of HUC digits from 1 to 16.')
+    return int(level)
+
+
+def get_lookup_points(points):
+    """
+    Parse the points of a batch reverse lookup.
+
+    Parameters
+    ----------
+    points : list
+        [lon, lat] pairs in degrees
+
+    Returns
+    -------
+    list
+        (lon, lat) tuples
+    """
+    msg = f'400: points must be a list of 1 to {LOOKUP_MAX_POINTS} [lon, lat] pairs in degrees.'
+    if not isinstance(points, list) or not 0 < len(points) <= LOOKUP_MAX_POINTS:
+        raise RequestError(msg)
+    parsed = []
+    for point in points:
+        if not isinstance(point, (list, tuple)) or len(point) != 2:
             raise RequestError(msg)
+        parsed.extend(parse_coordinates(",".join(str(value) for value in point), msg))
+    return parsed
+
+
+def lookup_huc(body, start):
+    """
+    Find the HUCs which contain a point, intersect a polygon, or contain
+    each of many points, in the HUC index loaded at HUC_INDEX_PATH.
+
+    Parameters
+    ----------
+    body       : dict
+        The request parameters: 'point' (lon,lat), 'polygon' (lon,lat,...)
+        or 'points' (list of [lon, lat]), and optionally 'level'
+    start      : float
+        Time the request started
+
+    Returns
+    -------
+    dict
+        The constructed response. Batch results hold the HUCs of each point,
+        in request order
+    """
+    if not HUC_INDEX_PATH:
+        raise RequestError('501: HUC lookup is not available on this deployment: HUC_INDEX_PATH is not set.')
+    level = get_huc_level(body)
+    point = str(body.get('point', '')).strip()
+    polygon = str(body.get('polygon', '')).strip()
+    points = body.get('points')
+
+    if sum(1 for value in (point, polygon, points) if value) != 1:
+        raise RequestError('400: Exactly one of point, polygon and points must be given.')
+
+    index = load_huc_index(HUC_INDEX_PATH)
+    search_on = {"parameter": "points" if points else "point" if point else "polygon", "level": level}
+
+    if points:
+        points = get_lookup_points(points)
+        found = index.lookup_points(points, level)
+        results = [{"point": list(xy), "results": [huc_result(huc, '', ()) for huc in hucs]}
+                   for xy, hucs in zip(points, found)]
+        hits = sum(1 for hucs in found if hucs)
+        search_on['points'] = len(points)
+    else:
+        if point:
+            coordinates = parse_coordinates(point, '400: point must be lon,lat in degrees.')
+            if len(coordinates) != 1:
+                raise RequestError('400: point must be lon,lat in degrees.')
+            hucs = index.lookup_points(coordinates, level)[0]
+        else:
+            hucs = index.lookup_polygon(parse_polygon(polygon), level)
+        if not hucs:
+            raise RequestError(f'404: No HUC was found at the specified {search_on["parameter"]} {point or polygon}.')
+        search_on['value'] = point or polygon
+        results = [huc_result(huc, '', ()) for huc in hucs]
+        hits = len(results)
+
+    elapsed_time = round((time.time() - start) * 1000, 3)
+    return {
+        'status': "200 OK",
+        'time': str(elapsed_time) + " ms.",
+        'hits': hits,
+        'search on': search_on,
+        'results': results
+    }
+
+
+def process_search(body, cur, start):
+    """
+    Autocomplete river and HUC region names from the name index.
+
+    Parameters
+    ----------
+    body       : dict
+        The request parameters: 'q', and optionally 'type' and 'limit'
+    cur        : pymysql.cursor
+        pymysql connection cursor
+    start      : float
+        Time the request started
+
+    Returns
+    -------
+    dict
+        The constructed response, with the names ranked best first
+    """
+    q = " ".join(str(body.get('q', '')).split("%20")).strip()
+    words = fold_name(q).split()
+    if not words or len(words[-1]) < SEARCH_MIN_PREFIX:
+        raise RequestError(f'400: q must end with a word of at least {SEARCH_MIN_PREFIX} letters.')
+
+    name_type = str(body.get('type', '')).strip().lower() or None
+    if name_type is not None and name_type not in NAME_TYPES:
+        raise RequestError(f'400: type must be one of {", ".join(NAME_TYPES)}.')
+
+    limit = str(body.get('limit', '')).strip() or str(SEARCH_DEFAULT_LIMIT)
+    if not limit.isdigit() or not 1 <= int(limit) <= SEARCH_MAX_LIMIT:
+        raise RequestError(f'400: limit must be a number from 1 to {SEARCH_MAX_LIMIT}.')
+
+    cur.execute(*search_query(words, name_type, int(limit)))
+    results = [{"name": name, "type": found_type, "hits": hits} for name, found_type, hits, _ in cur.fetchall()]
+    if not results:
+        raise RequestError(f'404: No names matching {q} were found.')
+
+    elapsed_time = round((time.time() - start) * 1000, 3)
+    return {
+        'status': "200 OK",
+        'time': str(elapsed_time) + " ms.",
+        'hits': len(results),
+        'search on': {"parameter": "search", "q": q, "type": name_type, "limit": int(limit)},
+        'results': results
+    }
+
+
+def get_cached_response(cache_key, start):
+    """
+    Look up a response in the in-process cache, then in the shared cache.
+
+    Parameters
+    ----------
+    cache_key  : tuple
+        The normalized request
+    start      : float
+        Time the request started
+
+    Returns
+    -------
+    bytes
+        The cached response with an updated 'time', or None
+    """
+    body = result_cache.get(cache_key)
+    if body is None:
+        body = shared_cache.get(cache_key, result_cache.version)
+        if isinstance(body, NegativeResult):
+            raise RequestError(body.message)
+        if body is None:
+            return None
+        result_cache.put(cache_key, body, size=len(body))
+    return with_time(body, round((time.time() - start) * 1000, 3))
+
+
+def query_database(event, cache_key, start, timer=None):
+    """
+    Answer a request from the database and cache the response.
+
+    Parameters
+    ----------
+    event      : dict
+        The lambda event, with the request parameters in 'body'
+    cache_key  : tuple
+        The normalized request
+    start      : float
+        Time the request started
+    timer      : RequestTimer, optional
+        Phase timer of the request
 
+    Returns
+    -------
+    bytes
+        The response as JSON
+    """
+    ndjson = get_output_format(event['body']) == 'ndjson'
+    versioned = result_cache.enabled or shared_cache.enabled or ETAGS_ENABLED
+    # NDJSON pages are read in batches from an unbuffered server-side cursor, and not cached
+    caching = (result_cache.enabled or shared_cache.enabled) and not ndjson
+    cursor_class = pymysql.cursors.SSCursor if ndjson else None
+
+    if timer is None:
+        timer = RequestTimer(start)
+    timer.lap('parse')
+
+    with connections.connection() as conn, conn.cursor(cursor_class) as cur:
+        if versioned and dataset_version.is_stale():
+            result_cache.set_version(dataset_version.refresh(cur))
+            check_not_modified(event, cache_key, timer)
+            response = get_cached_response(cache_key, start) if caching else None
+            if response is not None:
+                timer.source = 'cache'
+                timer.lap('connect')
+                return response
+        timer.lap('connect')
+        timer.source = 'database'
+
+        try:
+            response = handle_request(event, TimedCursor(cur, timer))
+            if not isinstance(response, dict):
+                # The API Gateway integration cannot stream, so the lines are joined
+                response = collect(response)
+        except RequestError as ex:
+            if caching and str(ex).startswith('404'):
+                shared_cache.put_not_found(cache_key, result_cache.version, str(ex))
+            raise
+
+    # Serialized once: the same bytes are cached and returned
+    body = encode_response(response)
+    timer.lap('serialize')
+    if caching:
+        result_cache.put(cache_key, body, size=len(body))
+        if shared_cache.enabled:
+            shared_cache.put(cache_key, result_cache.version, body)
+    return body
+
+
+def handle_request(event, cur):
+    """
+    Parse the request and run the query for the requested endpoint.
 
-def process_river(river_name, exact, cur, start, include_reaches, include_nodes, page_number, page_size):  # pylint: disable=too-many-positional-arguments
+    Parameters
+    ----------
+    event      : dict
+        The lambda event, with the request parameters in 'body'
+    cur        : pymysql.cursor
+        pymysql connection cursor
+
+    Returns
+    -------
+    dict or iterator
+        The constructed response, or its NDJSON lines for format=ndjson
+    """
+
+    # Start a timer to measure query time.
+    start = time.time()
+
+    # Default inputs
+    polygon_format = ''
+    page_number = 1
+    page_size = 100
+    exact = False
+    hits = 1
+    next_token = ''
+
+    if 'polygon_format' in event['body']:
+        polygon_format = event['body']['polygon_format'].lower()
+
+    if 'page_number' in event['body'] and event['body']['page_number'] != '':
+        try:
+            page_number = int(event['body']['page_number'])
+            if page_number < 1:
+                raise ValueError
+        except ValueError as ex:
+            raise RequestError("400: page_number must be a number, 1 or greater.") from ex
+
+    if 'page_size' in event['body'] and event['body']['page_size'] != '':
+        try:
+            page_size = int(event['body']['page_size'])
+            if page_size < 1:
+                raise ValueError
+        except ValueError as ex:
+            raise RequestError("400: page_size must be a number, 1 or greater.") from ex
+
+    if 'exact' in event['body'] and event['body']['exact'].lower() == "true":
+        exact = True
+
+    if 'next_token' in event['body']:
+        next_token = event['body']['next_token']
+
+    count_mode, count_only = get_count_mode(event['body'])
+    output_format = get_output_format(event['body'])
+    fields, include_geometry = get_fields(event['body'])
+    precision, simplify = get_geometry_reduction(event['body'])
+
+    offset = page_size * (page_number - 1)
+    # Without an exact count, one extra row tells whether another page follows
+    fetch_size = page_size if count_mode == 'exact' else page_size + 1
+
+    # Many HUCs, reaches or nodes looked up by id
+    if "batch" in event['body']:
+        if output_format != 'json':
+            raise RequestError('400: Batch lookups only support format=json.')
+        ids = get_batch_ids(event['body'])
+        return process_batch(event['body']['batch'], ids, cur, start, polygon_format, fields, include_geometry)
+
+    # Reaches or nodes in a bbox or polygon
+    elif "spatial" in event['body']:
+        area = get_spatial_area(event['body'])
+        filters = get_attribute_filters(event['body'])
+        river_name = " ".join(event['body'].get('river_name', '').split("%20"))
+
+        return process_spatial(event['body']['spatial'], area, river_name, filters, cur, start, page_number,
+                               page_size, next_token, count_mode, count_only, output_format, fields,
+                               include_geometry, precision, simplify)
+
+    # Name autocomplete
+    elif "search" in event['body']:
+        return process_search(event['body'], cur, start)
+
+    # Entered if the user queries by HUC
+    elif "HUC" in event['body']:
+
+        huc = event['body']['HUC']
+        level = get_huc_level(event['body'])
+        polygons = huc_polygons(fields, include_geometry)
+
+        if count_only:
+            hits = get_huc_hits_count(cur, huc, exact, count_mode == 'estimate', level)
+            elapsed_time = round((time.time() - start) * 1000, 3)
+            return return_count_json("HUC", huc, exact, elapsed_time, hits, count_mode)
+
+        # User queries an exact HUC
+        if exact:
+            condition, args = "`HUC` = %s", (huc,)
+            if level is not None:
+                condition, args = condition + " AND `huc_level` = %s", args + (level,)
+        # User queries partial HUC
+        else:
+            condition, args = huc_level_filter(level, huc)
+            condition, args = condition + " AND `HUC` LIKE %s", args + (huc + "%",)
+
+        hits = None
+        count = None
+        if count_mode != 'none':
+            count = start_hits_count(get_huc_hits_count, cur, huc, exact=exact, estimate=count_mode == 'estimate',
+                                     level=level)
+        cur.execute(f"select {huc_columns(polygon_format, polygons)} from huc_table"
+                    f" where {condition} ORDER BY `huc_level`, `HUC` LIMIT %s,%s", args + (offset, fetch_size))
+        if count is not None:
+            hits = count()
+
+        elapsed_time = round((time.time() - start) * 1000, 3)
+        return return_json(cur, "HUC", huc, exact, polygon_format, elapsed_time, hits,
+                           page_number, page_size, count_mode, offset, output_format, polygons, level)
+
+    # Similar process for region
+    elif "region" in event['body']:
+
+        # Handle spaces in request
+        region = " ".join(event['body']['region'].split("%20"))
+        level = get_huc_level(event['body'])
+        polygons = huc_polygons(fields, include_geometry)
+        level_condition = " AND `huc_level` = %s" if level is not None else ""
+        level_args = (level,) if level is not None else ()
+
+        if count_only:
+            hits = get_region_hits_count(cur, region, exact, count_mode == 'estimate', level)
+            elapsed_time = round((time.time() - start) * 1000, 3)
+            return return_count_json("region", region, exact, elapsed_time, hits, count_mode)
+
+        # User queries an exact region, or a partial region match
+        condition = "`Region` = %s" if exact else "`Region` LIKE %s"
+        args = (region if exact else region + "%",) + level_args
+
+        hits = None
+        count = None
+        if count_mode != 'none':
+            count = start_hits_count(get_region_hits_count, cur, region, exact=exact,
+                                     estimate=count_mode == 'estimate', level=level)
+        cur.execute(f"select {huc_columns(polygon_format, polygons)} from huc_table"
+                    f" where {condition}{level_condition} ORDER BY `huc_level`, `HUC` LIMIT %s,%s",
+                    args + (offset, fetch_size))
+        if count is not None:
+            hits = count()
+
+        elapsed_time = round((time.time() - start) * 1000, 3)
+        return return_json(cur, "region", region, exact, polygon_format, elapsed_time, hits,
+                           page_number, page_size, count_mode, offset, output_format, polygons, level)
+
+    # Similar process for reach
+    elif "reach" in event['body']:
+
+        # Handle spaces in request
+        reach = " ".join(event['body']['reach'].split("%20"))
+        river_name = " ".join(event['body']['river_name'].split("%20"))
+
+        return process_reach(reach, river_name, exact, cur, start, page_number, page_size, next_token,
+                             count_mode, count_only, output_format, fields, include_geometry,
+                             precision, simplify)
+    # Similar process for node
+    elif "node" in event['body']:
+
+        # Handle spaces in request
+        node = " ".join(event['body']['node'].split("%20"))
+        river_name = " ".join(event['body']['river_name'].split("%20"))
+
+        return process_node(node, river_name, exact, cur, start, page_number, page_size, next_token,
+                            count_mode, count_only, output_format, fields, include_geometry,
+                            precision, simplify)
+    # process for rivers name
+    elif "name" in event['body']:
+
+        # Handle spaces in request
+        river_name = " ".join(event['body']['name'].split("%20"))
+        #   path = context['path']
+
+        include_reaches = True
+        include_nodes = True
+
+        if 'nodes' in event['body'] and event['body']['nodes'].lower() == "false":
+            include_nodes = False
+
+        if 'reaches' in event['body'] and event['body']['reaches'].lower() == "false":
+            include_reaches = False
+
+        return process_river(river_name, exact, cur, start, include_reaches, include_nodes, page_number,
+                             page_size, next_token, count_mode, count_only, output_format, fields,
+                             include_geometry, precision, simplify)
+    else:
+        # Return 400 error assuming path is incorrect.
+        msg = "400: The specified URL is invalid (does not exist)."
+        raise RequestError(msg)
+
+
+def process_river(river_name, exact, cur, start, include_reaches, include_nodes, page_number, page_size,  # pylint: disable=too-many-positional-arguments
+                  next_token='', count_mode='exact', count_only=False, output_format='json', fields=None,
+                  include_geometry=True, precision=None, simplify=None):
     """
     Submits a river_name query to the DB, and passes that result to the return_json_passthrough to get
     the output reaches and nodes results.
@@ -560,68 +2189,124 @@ def process_river(river_name, exact, cur, start, include_reaches, include_nodes,
         The requested page number when getting partial results
     page_size        : int
         The maximum number of results to return per call
+    next_token       : str
+        Cursor returned by the previous page; takes precedence over page_number
+    count_mode       : str
+        'exact', 'estimate' or 'none' hits count
+    count_only       : bool
+        Return only the hits count without fetching any results
+    output_format    : str
+        'json', or 'ndjson' to stream the results from a server-side cursor
+    fields           : tuple
+        Columns to return, or None for all of them
+    include_geometry : bool
+        False to leave out the geometry and geojson columns
+    precision        : int
+        Decimal places kept in the geojson coordinates
+    simplify         : float
+        Topology preserving simplification tolerance of the geojson, in metres
 
     Returns
     -------
-    dict
-        The constructed response
+    dict or iterator
+        The constructed response, or its NDJSON lines
     """
 
     offset = page_size * (page_number - 1)
+    page_query = page_query_key("name", river_name, exact, include_reaches, include_nodes, count_mode)
+    page_token = decode_next_token(next_token, page_query) if next_token else None
+
+    if include_nodes:
+        key_column = "node_id"
+    else:
+        key_column = "reach_id"
+    keyset, keyset_args = keyset_predicate(key_column, page_token)
+
+    fragment = use_json_fragments(output_format, precision, simplify)
+    if include_nodes and include_reaches:
+        columns = river_columns(('reaches', 'nodes'), key_column, fields, include_geometry)
+    elif include_nodes:
+        columns = river_columns(('nodes',), key_column, fields, include_geometry, fragment)
+    else:
+        columns = river_columns(('reaches',), key_column, fields, include_geometry, fragment)
+
+    # Without an exact count, one extra row tells whether another page follows
+    fetch_size = page_size if count_mode == 'exact' else page_size + 1
+
+    count = None
+    if page_token:
+        # Follow-up page: hits were counted on the first page
+        hits = page_token['hits']
+        offset = page_token['seen']
+        limit_args = (0, fetch_size)
+    else:
+        hits = None
+        if count_mode != 'none':
+            count = start_hits_count(get_river_name_hits_count, cur, river_name, include_reaches, include_nodes,
+                                     count_mode == 'estimate', exact)
+        limit_args = (offset, fetch_size)
+
+    if count_only:
+        if count is not None:
+            hits = count()
+        elapsed_time = round((time.time() - start) * 1000, 3)
+        return return_count_json("name", river_name, exact, elapsed_time, hits, count_mode)
 
     # User queries exact river_name
     if exact:
-        hits = get_river_name_hits_count(cur, river_name, include_reaches, include_nodes)
-
         if include_nodes and include_reaches:
-            args = (river_name, river_name, offset, page_size)
+            args = (river_name,) + keyset_args + limit_args
 
-            cur.execute("SELECT reaches.*, nodes.* FROM reaches, nodes WHERE reaches.reach_id = nodes.reach_id AND reaches.river_name = %s AND nodes.river_name = %s"
-                        " ORDER BY node_id LIMIT %s,%s", args)
+            cur.execute(f"SELECT {columns} FROM {RIVER_JOIN} WHERE reaches.river_name = %s"
+                        + keyset + " ORDER BY node_id LIMIT %s,%s", args)
         elif include_nodes:
             # Include only nodes
-            args = (river_name, offset, page_size)
+            args = (river_name,) + keyset_args + limit_args
 
-            cur.execute("SELECT * FROM nodes WHERE river_name = %s ORDER BY node_id LIMIT %s,%s", args)
+            cur.execute(f"SELECT {columns} FROM nodes WHERE river_name = %s" + keyset + " ORDER BY node_id LIMIT %s,%s", args)
         elif include_reaches:
             # Include only reaches
-            args = (river_name, offset, page_size)
+            args = (river_name,) + keyset_args + limit_args
 
-            cur.execute("SELECT * FROM reaches WHERE river_name = %s ORDER BY reach_id LIMIT %s,%s", args)
+            cur.execute(f"SELECT {columns} FROM reaches WHERE river_name = %s" + keyset + " ORDER BY reach_id LIMIT %s,%s", args)
         else:
             msg = '400: Both reaches and nodes are false.  At least one must be set to true.'
             raise RequestError(msg)
 
     # User queries partial river_name match
     else:
-        hits = get_river_name_hits_count(cur, river_name, include_reaches, include_nodes)
-
         if include_nodes and include_reaches:
-            args = (river_name + "%", river_name + "%", offset, page_size)
+            args = (river_name + "%",) + keyset_args + limit_args
 
-            cur.execute("SELECT reaches.*, nodes.* FROM reaches, nodes WHERE reaches.reach_id = nodes.reach_id AND reaches.river_name LIKE %s AND nodes.river_name LIKE %s"
-                        " ORDER BY node_id LIMIT %s,%s", args)
+            cur.execute(f"SELECT {columns} FROM {RIVER_JOIN} WHERE reaches.river_name LIKE %s"
+                        + keyset + " ORDER BY node_id LIMIT %s,%s", args)
         elif include_nodes:
             # Include only nodes
-            args = (river_name + "%", offset, page_size)
+            args = (river_name + "%",) + keyset_args + limit_args
 
-            cur.execute("SELECT * FROM nodes WHERE river_name LIKE %s ORDER BY node_id LIMIT %s,%s", args)
+            cur.execute(f"SELECT {columns} FROM nodes WHERE river_name LIKE %s" + keyset + " ORDER BY node_id LIMIT %s,%s", args)
         elif include_reaches:
             # Include only reaches
-            args = (river_name + "%", offset, page_size)
+            args = (river_name + "%",) + keyset_args + limit_args
 
-            cur.execute("SELECT * FROM reaches WHERE river_name LIKE %s ORDER BY reach_id LIMIT %s,%s", args)
+            cur.execute(f"SELECT {columns} FROM reaches WHERE river_name LIKE %s" + keyset + " ORDER BY reach_id LIMIT %s,%s", args)
         else:
             msg = '400: Both reaches and nodes are false.  At least one must be set to true.'
             raise RequestError(msg)
 
+    if count is not None:
+        hits = count()
+
     elapsed_time = round((time.time() - start) * 1000, 3)
 
     return return_json_pass_through(cur, "name", river_name, river_name, exact, elapsed_time, hits,
-                                    page_number, page_size)
+                                    page_number, page_size, key_column, offset, page_query, count_mode, output_format,
+                                    precision, simplify)
 
 
-def process_reach(reach, river_name, exact, cur, start, page_number, page_size):  # pylint: disable=too-many-positional-arguments
+def process_reach(reach, river_name, exact, cur, start, page_number, page_size, next_token='',  # pylint: disable=too-many-positional-arguments
+                  count_mode='exact', count_only=False, output_format='json', fields=None, include_geometry=True,
+                  precision=None, simplify=None):
     """
     Submits a reach query to the DB, and passes that result to the return_json_passthrough to get
     the output reach results.
@@ -642,43 +2327,88 @@ def process_reach(reach, river_name, exact, cur, start, page_number, page_size):
         The requested page number when getting partial results
     page_size        : int
         The maximum number of results to return per call
+    next_token       : str
+        Cursor returned by the previous page; takes precedence over page_number
+    count_mode       : str
+        'exact', 'estimate' or 'none' hits count
+    count_only       : bool
+        Return only the hits count without fetching any results
+    output_format    : str
+        'json', or 'ndjson' to stream the results from a server-side cursor
+    fields           : tuple
+        Columns to return, or None for all of them
+    include_geometry : bool
+        False to leave out the geometry and geojson columns
+    precision        : int
+        Decimal places kept in the geojson coordinates
+    simplify         : float
+        Topology preserving simplification tolerance of the geojson, in metres
 
     Returns
     -------
-    dict
-        The constructed response
+    dict or iterator
+        The constructed response, or its NDJSON lines
     """
 
     hits = 1
     offset = page_size * (page_number - 1)
+    page_query = page_query_key("reach", reach, river_name, exact, count_mode)
+    columns = river_columns(('reaches',), "reach_id", fields, include_geometry,
+                            use_json_fragments(output_format, precision, simplify))
+
+    if count_only:
+        hits = get_reach_hits_count(cur, reach, river_name, exact, count_mode == 'estimate')
+        elapsed_time = round((time.time() - start) * 1000, 3)
+        return return_count_json("reach", reach, exact, elapsed_time, hits, count_mode)
 
     # User queries exact reach
     if exact:
         if river_name:
             args = (reach, river_name + "%")
 
-            cur.execute("SELECT * FROM reaches WHERE reach_id = %s AND river_name LIKE %s", args)
+            cur.execute(f"SELECT {columns} FROM reaches WHERE reach_id = %s AND river_name LIKE %s", args)
         else:
-            cur.execute("SELECT * FROM reaches WHERE reach_id = %s", reach)
+            cur.execute(f"SELECT {columns} FROM reaches WHERE reach_id = %s", reach)
     # User queries partial region match
     else:
-        hits = get_reach_hits_count(cur, reach, river_name)
+        page_token = decode_next_token(next_token, page_query) if next_token else None
+        condition, condition_args, order_column = id_prefix_predicate("reach_id", reach, page_token)
+
+        # Without an exact count, one extra row tells whether another page follows
+        fetch_size = page_size if count_mode == 'exact' else page_size + 1
+
+        count = None
+        if page_token:
+            # Follow-up page: hits were counted on the first page
+            hits = page_token['hits']
+            offset = page_token['seen']
+            limit_args = (0, fetch_size)
+        else:
+            hits = None
+            if count_mode != 'none':
+                count = start_hits_count(get_reach_hits_count, cur, reach, river_name, estimate=count_mode == 'estimate')
+            limit_args = (offset, fetch_size)
 
         if river_name:
-            args = (reach + "%", river_name + "%", offset, page_size)
+            args = condition_args + (river_name + "%",) + limit_args
 
-            cur.execute("SELECT * FROM reaches WHERE reach_id LIKE %s AND river_name LIKE %s ORDER BY reach_id LIMIT %s,%s", args)
+            cur.execute(f"SELECT {columns} FROM reaches WHERE {condition} AND river_name LIKE %s ORDER BY {order_column} LIMIT %s,%s", args)
         else:
-            args = (reach + "%", offset, page_size)
+            args = condition_args + limit_args
 
-            cur.execute("SELECT * FROM reaches WHERE reach_id LIKE %s ORDER BY reach_id LIMIT %s,%s", args)
+            cur.execute(f"SELECT {columns} FROM reaches WHERE {condition} ORDER BY {order_column} LIMIT %s,%s", args)
+        if count is not None:
+            hits = count()
 
     elapsed_time = round((time.time() - start) * 1000, 3)
     return return_json_pass_through(cur, "reach", reach, river_name, exact, elapsed_time, hits,
-                                    page_number, page_size)
+                                    page_number, page_size, "reach_id", offset, page_query, count_mode, output_format,
+                                    precision, simplify)
 
 
-def process_node(node, river_name, exact, cur, start, page_number, page_size):  # pylint: disable=too-many-positional-arguments
+def process_node(node, river_name, exact, cur, start, page_number, page_size, next_token='',  # pylint: disable=too-many-positional-arguments
+                 count_mode='exact', count_only=False, output_format='json', fields=None, include_geometry=True,
+                 precision=None, simplify=None):
     """
     Submits a node query to the DB, and passes that result to the return_json_passthrough to get
     the output node results.
@@ -699,44 +2429,277 @@ def process_node(node, river_name, exact, cur, start, page_number, page_size):
         The requested page number when getting partial results
     page_size        : int
         The maximum number of results to return per call
+    next_token       : str
+        Cursor returned by the previous page; takes precedence over page_number
+    count_mode       : str
+        'exact', 'estimate' or 'none' hits count
+    count_only       : bool
+        Return only the hits count without fetching any results
+    output_format    : str
+        'json', or 'ndjson' to stream the results from a server-side cursor
+    fields           : tuple
+        Columns to return, or None for all of them
+    include_geometry : bool
+        False to leave out the geometry and geojson columns
+    precision        : int
+        Decimal places kept in the geojson coordinates
+    simplify         : float
+        Topology preserving simplification tolerance of the geojson, in metres
 
     Returns
     -------
-    dict
-        The constructed response
+    dict or iterator
+        The constructed response, or its NDJSON lines
     """
 
     hits = 1
     offset = page_size * (page_number - 1)
+    page_query = page_query_key("node", node, river_name, exact, count_mode)
+    columns = river_columns(('nodes',), "node_id", fields, include_geometry,
+                            use_json_fragments(output_format, precision, simplify))
+
+    if count_only:
+        hits = get_node_hits_count(cur, node, river_name, exact, count_mode == 'estimate')
+        elapsed_time = round((time.time() - start) * 1000, 3)
+        return return_count_json("node", node, exact, elapsed_time, hits, count_mode)
 
     # User queries exact node
     if exact:
         if river_name:
             args = (node, river_name + "%")
 
-            cur.execute("SELECT * FROM nodes WHERE node_id = %s AND river_name LIKE %s", args)
+            cur.execute(f"SELECT {columns} FROM nodes WHERE node_id = %s AND river_name LIKE %s", args)
         else:
-            cur.execute("SELECT * FROM nodes WHERE node_id = %s", node)
+            cur.execute(f"SELECT {columns} FROM nodes WHERE node_id = %s", node)
 
     # User queries partial region match
     else:
-        hits = get_node_hits_count(cur, node, river_name)
+        page_token = decode_next_token(next_token, page_query) if next_token else None
+        condition, condition_args, order_column = id_prefix_predicate("node_id", node, page_token)
+
+        # Without an exact count, one extra row tells whether another page follows
+        fetch_size = page_size if count_mode == 'exact' else page_size + 1
+
+        count = None
+        if page_token:
+            # Follow-up page: hits were counted on the first page
+            hits = page_token['hits']
+            offset = page_token['seen']
+            limit_args = (0, fetch_size)
+        else:
+            hits = None
+            if count_mode != 'none':
+                count = start_hits_count(get_node_hits_count, cur, node, river_name, estimate=count_mode == 'estimate')
+            limit_args = (offset, fetch_size)
 
         if river_name:
-            args = (node + "%", river_name + "%", offset, page_size)
+            args = condition_args + (river_name + "%",) + limit_args
 
-            cur.execute("SELECT * FROM nodes WHERE node_id LIKE %s AND river_name LIKE %s ORDER BY node_id LIMIT %s,%s", args)
+            cur.execute(f"SELECT {columns} FROM nodes WHERE {condition} AND river_name LIKE %s ORDER BY {order_column} LIMIT %s,%s", args)
         else:
-            args = (node + "%", offset, page_size)
+            args = condition_args + limit_args
 
-            cur.execute("SELECT * FROM nodes WHERE node_id LIKE %s ORDER BY node_id LIMIT %s,%s", args)
+            cur.execute(f"SELECT {columns} FROM nodes WHERE {condition} ORDER BY {order_column} LIMIT %s,%s", args)
+        if count is not None:
+            hits = count()
 
     elapsed_time = round((time.time() - start) * 1000, 3)
     return return_json_pass_through(cur, "node", node, river_name, exact, elapsed_time, hits,
-                                    page_number, page_size)
+                                    page_number, page_size, "node_id", offset, page_query, count_mode, output_format,
+                                    precision, simplify)
+
+
+def process_batch(batch_type, ids, cur, start, polygon_format='', fields=None,  # pylint: disable=too-many-positional-arguments,too-many-locals
+                  include_geometry=True):
+    """
+    Look up many HUCs, reaches or nodes by id with IN (...) queries on the
+    indexed id column, BATCH_CHUNK_SIZE ids at a time.
 
+    Parameters
+    ----------
+    batch_type       : str
+        'HUC', 'reach' or 'node'
+    ids              : list
+        Distinct ids from get_batch_ids
+    cur              : pymysql.cursor
+        pymysql connection cursor
+    start            : int
+        start time to measure query duration
+    polygon_format   : str
+        geojson, flat, or '' (flat); HUC lookups only
+    fields           : tuple
+        Columns or HUC polygons to return, or None for all of them
+    include_geometry : bool
+        False to leave out the geometries
 
-def return_json_pass_through(cur, identifier, name, river_name, exact, elapsed_time, hits, page_number, page_size):  # pylint: disable=too-many-positional-arguments
+    Returns
+    -------
+    dict
+        The constructed response. Results are keyed by id, with null and an
+        entry in not_found for the ids which do not exist
+    """
+    if batch_type not in BATCH_TYPES:
+        msg = f'400: Invalid batch type \'{batch_type}\'. Should be one of {", ".join(BATCH_TYPES)}.'
+        raise RequestError(msg)
+    table, id_column = BATCH_TYPES[batch_type]
+
+    if batch_type == 'HUC':
+        check_polygon_format(polygon_format)
+        polygons = huc_polygons(fields, include_geometry)
+        columns = huc_columns(polygon_format, polygons)
+    else:
+        columns = river_columns((table,), id_column, fields, include_geometry)
+
+    found = {}
+    for index in range(0, len(ids), BATCH_CHUNK_SIZE):
+        chunk = tuple(ids[index:index + BATCH_CHUNK_SIZE])
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cur.execute(f"SELECT {columns} FROM {table} WHERE `{id_column}` IN ({placeholders})", chunk)
+        rows = cur.fetchall()
+
+        if batch_type == 'HUC':
+            for row in rows:
+                found[str(row[0])] = huc_result(row, polygon_format, polygons)
+            continue
+
+        names = [column[0] for column in cur.description]
+        for row in rows:
+            res = dict(zip(names, row))
+            drop_hidden_columns(res)
+            if res.get('geojson'):
+                res['geojson'] = geojson.loads(res['geojson'])
+            found[str(res[id_column])] = res
+
+    not_found = [value for value in ids if value not in found]
+    elapsed_time = round((time.time() - start) * 1000, 3)
+
+    search_on = {
+        "parameter": batch_type,
+        "batch": True,
+        "ids": len(ids)
+    }
+    if batch_type == 'HUC':
+        search_on['polygon_format'] = polygon_format
+
+    return {
+        'status': "200 OK",
+        'time': str(elapsed_time) + " ms.",
+        'hits': len(ids) - len(not_found),
+        'search on': search_on,
+        'results': {value: found.get(value) for value in ids},
+        'not_found': not_found
+    }
+
+
+def process_spatial(spatial_type, area, river_name, filters, cur, start, page_number, page_size,  # pylint: disable=too-many-positional-arguments,too-many-locals
+                    next_token='', count_mode='exact', count_only=False, output_format='json', fields=None,
+                    include_geometry=True, precision=None, simplify=None):
+    """
+    Submits a bbox or polygon query for reaches or nodes to the DB, and passes that result to the
+    return_json_passthrough to get the output results. The SPATIAL index on geom finds the rows whose
+    bounding rectangle intersects the area; polygon queries then keep those which intersect the polygon.
+
+    Parameters
+    ----------
+    spatial_type     : str
+        'reach' or 'node'
+    area             : tuple
+        Identifier, value and WKT from get_spatial_area
+    river_name       : str
+        Only return results whose river_name starts with this, if given
+    filters          : tuple
+        SQL fragment and arguments from get_attribute_filters
+    cur              : pymysql.cursor
+        pymysql connection cursor
+    start            : int
+        start time to measure query duration
+    page_number      : int
+        The requested page number when getting partial results
+    page_size        : int
+        The maximum number of results to return per call
+    next_token       : str
+        Cursor returned by the previous page; takes precedence over page_number
+    count_mode       : str
+        'exact', 'estimate' or 'none' hits count
+    count_only       : bool
+        Return only the hits count without fetching any results
+    output_format    : str
+        'json', or 'ndjson' to stream the results from a server-side cursor
+    fields           : tuple
+        Columns to return, or None for all of them
+    include_geometry : bool
+        False to leave out the geometry and geojson columns
+    precision        : int
+        Decimal places kept in the geojson coordinates
+    simplify         : float
+        Topology preserving simplification tolerance of the geojson, in metres
+
+    Returns
+    -------
+    dict or iterator
+        The constructed response, or its NDJSON lines
+    """
+    if spatial_type not in SPATIAL_TYPES:
+        msg = f'400: Invalid spatial query type \'{spatial_type}\'. Should be one of {", ".join(SPATIAL_TYPES)}.'
+        raise RequestError(msg)
+    table, key_column = BATCH_TYPES[spatial_type]
+    identifier, value, wkt = area
+    filter_sql, filter_args = filters
+
+    offset = page_size * (page_number - 1)
+    page_query = page_query_key(identifier, spatial_type, value, river_name, filter_args, count_mode)
+    page_token = decode_next_token(next_token, page_query) if next_token else None
+    keyset, keyset_args = keyset_predicate(key_column, page_token)
+
+    where = f"MBRIntersects(`{SPATIAL_COLUMN}`, ST_GeomFromText(%s))"
+    args = (wkt,)
+    if identifier == 'polygon':
+        where += f" AND ST_Intersects(`{SPATIAL_COLUMN}`, ST_GeomFromText(%s))"
+        args += (wkt,)
+    if river_name:
+        where += " AND river_name LIKE %s"
+        args += (river_name + "%",)
+    where += filter_sql
+    args += filter_args
+
+    # Without an exact count, one extra row tells whether another page follows
+    fetch_size = page_size if count_mode == 'exact' else page_size + 1
+
+    count = None
+    if page_token:
+        # Follow-up page: hits were counted on the first page
+        hits = page_token['hits']
+        offset = page_token['seen']
+        limit_args = (0, fetch_size)
+    else:
+        hits = None
+        if count_mode != 'none':
+            count = start_hits_count(run_hits_count, cur, f"SELECT COUNT(*) FROM {table} WHERE {where}", args,
+                                     count_mode == 'estimate')
+        limit_args = (offset, fetch_size)
+
+    if count_only:
+        if count is not None:
+            hits = count()
+        elapsed_time = round((time.time() - start) * 1000, 3)
+        return return_count_json(identifier, value, False, elapsed_time, hits, count_mode)
+
+    columns = river_columns((table,), key_column, fields, include_geometry,
+                            use_json_fragments(output_format, precision, simplify))
+    cur.execute(f"SELECT {columns} FROM {table} WHERE {where}" + keyset + f" ORDER BY {key_column} LIMIT %s,%s",
+                args + keyset_args + limit_args)
+    if count is not None:
+        hits = count()
+
+    elapsed_time = round((time.time() - start) * 1000, 3)
+    return return_json_pass_through(cur, identifier, value, river_name, False, elapsed_time, hits,
+                                    page_number, page_size, key_column, offset, page_query, count_mode, output_format,
+                                    precision, simplify)
+
+
+def return_json_pass_through(cur, identifier, name, river_name, exact, elapsed_time, hits, page_number, page_size,  # pylint: disable=too-many-positional-arguments
+                             key_column=None, offset=0, page_query=None, count_mode='exact', output_format='json',
+                             precision=None, simplify=None):
     """
     Get the results of the DB query, and construct the resulting dict given the identifier, name.
 
@@ -760,51 +2723,121 @@ def return_json_pass_through(cur, identifier, name, river_name, exact, elapsed_t
         The requested page number when getting partial results
     page_size        : int
         The maximum number of results to return per call
+    key_column       : str, optional
+        Column the page is ordered by; enables next_token when given
+    offset           : int, optional
+        Number of results that come before this page
+    page_query       : str, optional
+        The query key from page_query_key that next_token is tied to
+    count_mode       : str, optional
+        'exact', 'estimate' or 'none'. Unless exact, the query fetched one
+        row more than page_size to tell whether another page follows
+    output_format    : str, optional
+        'json', or 'ndjson' to stream the results from a server-side cursor
+    precision        : int, optional
+        Decimal places kept in the geojson coordinates
+    simplify         : float, optional
+        Topology preserving simplification tolerance of the geojson, in metres
 
     Returns
     -------
-    dict
-        The constructed response
+    dict or iterator
+        The constructed response, or its NDJSON lines
     """
-    results = cur.fetchall()
-
-    data = {}
-
-    results_count = len(results)
-
-    if results_count == 0:
-        msg = f'404: Results with the specified {identifier} {name} were not found.'
-        raise RequestError(msg)
-
-    partial_results = False
-    status = "200 OK"
-    if hits > results_count:
-        partial_results = True
-        status = "206 PARTIAL CONTENT"
-
-    data['status'] = status
-    data['time'] = str(elapsed_time) + " ms."
-    data['hits'] = hits
-    if partial_results:
-        data['results_count'] = results_count
-
-    data['search on'] = {
+    search_on = {
         "parameter": identifier,
         "river_name": river_name,
         "exact": exact,
         "page_number": page_number,
-        "page_size": page_size
+        "page_size": page_size,
+        "count": count_mode
     }
-    data['results'] = []
+    reducing = precision is not None or simplify is not None
+    if reducing:
+        search_on['precision'] = precision
+        search_on['simplify'] = simplify
+    bytes_saved = [0]
+
+    def summarize(results_count, last, has_more):
+        if results_count == 0:
+            msg = f'404: Results with the specified {identifier} {name} were not found.'
+            raise RequestError(msg)
+
+        data = page_metadata(elapsed_time, hits, results_count, count_mode, has_more, offset, search_on)
+        if reducing:
+            data['bytes_saved'] = bytes_saved[0]
+
+        # Hand out a cursor to the next page while results remain
+        seen = offset + results_count
+        if count_mode == 'exact':
+            has_more = seen < hits
+        if key_column and has_more:
+            data['next_token'] = encode_next_token(page_query, last[key_column], hits, seen)
+        return data
+
+    if output_format == 'ndjson':
+        # Column names are known once the first batch is fetched
+        columns = []
+
+        def reduced_rows():
+            for batch in iter_batches(cur, NDJSON_BATCH_SIZE):
+                if not columns:
+                    columns.extend(column[0] for column in cur.description)
+                if not reducing or 'geojson' not in columns:
+                    yield from ((row, 0) for row in batch)
+                    continue
+                # A join has geojson twice; results keep the last one
+                index = len(columns) - 1 - columns[::-1].index('geojson')
+                texts, saved = reduce_geojson([row[index] for row in batch], precision, simplify)
+                for row, text, row_saved in zip(batch, texts, saved):
+                    row = list(row)
+                    row[index] = text
+                    yield row, row_saved
+
+        def render(item):
+            row, row_saved = item
+            bytes_saved[0] += row_saved
+            res = dict(zip(columns, row))
+            drop_hidden_columns(res)
+            # The stored GeoJSON text goes out as is
+            raw = {'geojson': res.pop('geojson')} if 'geojson' in res else None
+            return dumps_line(res, raw)
+
+        return stream_page(reduced_rows(), page_size, render,
+                           lambda count, last, has_more: summarize(count, dict(zip(columns, last[0] if last else ())), has_more))
+
+    results = cur.fetchall()
 
-    columns = cur.description
-    result = [{columns[index][0]: column for index, column in enumerate(value)} for value in
+    has_more = len(results) > page_size
+    results = results[:page_size]
+
+    columns = [column[0] for column in cur.description]
+    if columns == [key_column, JSON_FRAGMENT_COLUMN]:
+        # Pre-rendered results go into the response without being parsed
+        data = summarize(len(results), {key_column: results[-1][0]} if results else None, has_more)
+        data['results'] = JSONFragments(row[1] for row in results)
+        return data
+
+    result = [{columns[index]: column for index, column in enumerate(value)} for value in
               results]
+    for res in result:
+        drop_hidden_columns(res)
+
+    if reducing and 'geojson' in columns:
+        # One vectorized pass over the geometries of the page
+        texts, saved = reduce_geojson([res['geojson'] for res in result],
+                                      precision if precision is not None else DEFAULT_GEOJSON_PRECISION, simplify)
+        bytes_saved[0] = sum(saved)
+        for res, text in zip(result, texts):
+            res['geojson'] = json.loads(text) if text else text
+
+    data = summarize(len(result), result[-1] if result else None, has_more)
 
     # Reformat results
-    for res in result:
-        if 'geojson' in res:
-            res['geojson'] = geojson.loads(res['geojson'])
+    if not reducing:
+        for res in result:
+            if 'geojson' in res:
+                res['geojson'] = geojson.loads(res['geojson'])
     data['results'] = result
 
     return data
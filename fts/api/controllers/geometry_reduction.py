@@ -0,0 +1,53 @@
+"""
+==============
+geometry_reduction.py
+==============
+
+Coordinate precision and simplification of the GeoJSON geometries in a
+page of river results. All geometries of the page go through shapely's
+vectorized functions together; shapely is imported on first use so that
+requests without these options do not pay for loading it.
+"""
+
+# Metres per degree of latitude. Tolerances converted with it are never
+# larger than requested, also along longitude.
+METRES_PER_DEGREE = 111320.0
+
+
+def reduce_geojson(texts, precision=None, simplify=None):
+    """
+    Simplify and round GeoJSON geometries.
+
+    Parameters
+    ----------
+    texts : list
+        GeoJSON geometry strings; empty entries are passed through
+    precision : int, optional
+        Decimal places kept in the coordinates
+    simplify : float, optional
+        Topology preserving simplification tolerance in metres
+
+    Returns
+    -------
+    tuple
+        The reduced GeoJSON strings, and the bytes saved on each of them
+    """
+    reduced = list(texts)
+    saved = [0] * len(reduced)
+    indexes = [index for index, text in enumerate(reduced) if text]
+    if (precision is None and simplify is None) or not indexes:
+        return reduced, saved
+
+    import numpy  # pylint: disable=import-outside-toplevel,import-error
+    import shapely  # pylint: disable=import-outside-toplevel,import-error
+
+    geometries = shapely.from_geojson([reduced[index] for index in indexes])
+    if simplify is not None:
+        geometries = shapely.simplify(geometries, simplify / METRES_PER_DEGREE, preserve_topology=True)
+    if precision is not None:
+        geometries = shapely.transform(geometries, lambda coordinates: numpy.round(coordinates, precision))
+
+    for index, text in zip(indexes, shapely.to_geojson(geometries)):
+        saved[index] = len(reduced[index]) - len(text)
+        reduced[index] = text
+    return reduced, saved
@@ -0,0 +1,139 @@
+"""
+==============
+huc_index.py
+==============
+
+In-memory HUC index for point and polygon lookups. The HUC build writes
+the HUC, region and Visvalingam polygon of every HUC to a compressed numpy
+archive (see fts/db/huc/simplify_huc.py); the API loads it once per warm
+container into a shapely STRtree, whose bounding box candidates are
+refined with an exact intersects test. Lookups do not touch MySQL.
+"""
+
+import functools
+import os
+
+# Where a HUC index downloaded from S3 is kept
+DOWNLOAD_DIR = '/tmp'
+
+
+class HucIndex:
+    """
+    STRtree over the HUC polygons.
+
+    Parameters
+    ----------
+    hucs : list
+        HUC codes
+    regions : list
+        Region names, in the same order
+    polygons : numpy.ndarray
+        shapely Polygons, in the same order
+    """
+
+    def __init__(self, hucs, regions, polygons):
+        import shapely  # pylint: disable=import-outside-toplevel,import-error
+
+        self.hucs = list(hucs)
+        self.regions = list(regions)
+        self.tree = shapely.STRtree(polygons)
+
+    def __len__(self):
+        return len(self.hucs)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index written by the HUC build.
+
+        Parameters
+        ----------
+        path : str
+            Path of the .npz archive
+
+        Returns
+        -------
+        HucIndex
+            The index
+        """
+        import numpy  # pylint: disable=import-outside-toplevel,import-error
+        import shapely  # pylint: disable=import-outside-toplevel,import-error
+
+        with numpy.load(path, allow_pickle=False) as data:
+            polygons = shapely.from_ragged_array(shapely.GeometryType.POLYGON, data['coords'],
+                                                 (data['ring_offsets'], data['polygon_offsets']))
+            return cls(data['huc'].tolist(), data['region'].tolist(), polygons)  # pylint: disable=no-member
+
+    def _lookup(self, geometries, level):
+        inputs, matches = self.tree.query(geometries, predicate='intersects')
+        found = [[] for _ in range(len(geometries))]
+        for geometry, match in zip(inputs.tolist(), matches.tolist()):
+            if level is None or len(self.hucs[match]) == level:
+                found[geometry].append((self.hucs[match], self.regions[match]))
+        # Largest HUCs first
+        return [sorted(hucs, key=lambda huc: (len(huc[0]), huc[0])) for hucs in found]
+
+    def lookup_points(self, points, level=None):
+        """
+        Find the HUCs which contain each point.
+
+        Parameters
+        ----------
+        points : list
+            (lon, lat) tuples
+        level : int, optional
+            Only return HUCs with this many digits
+
+        Returns
+        -------
+        list
+            (HUC, region) tuples of each point, largest HUCs first
+        """
+        import shapely  # pylint: disable=import-outside-toplevel,import-error
+
+        return self._lookup(shapely.points(points), level)
+
+    def lookup_polygon(self, ring, level=None):
+        """
+        Find the HUCs which intersect a polygon.
+
+        Parameters
+        ----------
+        ring : list
+            (lon, lat) tuples of the exterior ring
+        level : int, optional
+            Only return HUCs with this many digits
+
+        Returns
+        -------
+        list
+            (HUC, region) tuples, largest HUCs first
+        """
+        import shapely  # pylint: disable=import-outside-toplevel,import-error
+
+        return self._lookup([shapely.Polygon(ring)], level)[0]
+
+
+@functools.lru_cache(maxsize=1)
+def load_huc_index(location):
+    """
+    Load the HUC index once per container.
+
+    Parameters
+    ----------
+    location : str
+        Local path, or s3://bucket/key which is downloaded first
+
+    Returns
+    -------
+    HucIndex
+        The index
+    """
+    path = location
+    if location.startswith('s3://'):
+        import boto3  # pylint: disable=import-outside-toplevel,import-error
+
+        bucket, key = location[len('s3://'):].split('/', 1)
+        path = os.path.join(DOWNLOAD_DIR, os.path.basename(key))
+        boto3.client('s3').download_file(bucket, key, path)
+    return HucIndex.load(path)
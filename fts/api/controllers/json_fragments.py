@@ -0,0 +1,183 @@
+"""
+==============
+json_fragments.py
+==============
+
+Responses holding JSON text rendered when the tables were loaded: the
+SWORD loader's reach and node results, and the HUC build's GeoJSON. Only
+the rest of the response is serialized per request; the stored text is
+spliced in as it is, without being parsed.
+"""
+
+import itertools
+import json
+
+# Leading attributes of an encoded response, as page_metadata orders them
+STATUS_KEY = b'{"status": "'
+TIME_KEY = b'"time": "'
+# Stands in for RawJSON values while the rest of a response is serialized
+RAW_PLACEHOLDER = '\ufdd0'
+RAW_TOKEN = json.dumps(RAW_PLACEHOLDER)
+
+
+class JSONFragments(list):
+    """
+    Results which are already serialized, one JSON object string each.
+    """
+
+
+class RawJSON:  # pylint: disable=too-few-public-methods
+    """
+    A value which is already serialized, such as stored GeoJSON.
+
+    Parameters
+    ----------
+    text : str
+        The JSON text
+    """
+
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+
+def dumps(obj, default=None):
+    """
+    Serialize a value, splicing in its RawJSON values as they are.
+
+    Parameters
+    ----------
+    obj : object
+        The value to serialize
+    default : callable, optional
+        Called with other values json cannot serialize, as in json.dumps
+
+    Returns
+    -------
+    str
+        The value as JSON
+    """
+    raw = []
+
+    def placeholder(value):
+        if isinstance(value, RawJSON):
+            raw.append(value.text)
+            return RAW_PLACEHOLDER
+        if default is None:
+            raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+        return default(value)
+
+    text = json.dumps(obj, default=placeholder)
+    if not raw:
+        return text
+    parts = text.split(RAW_TOKEN)
+    if len(parts) != len(raw) + 1:
+        # A string of the value is the placeholder itself, so parse the raw values instead
+        return json.dumps(obj, default=lambda value: json.loads(value.text) if isinstance(value, RawJSON)
+                          else placeholder(value))
+    return ''.join(itertools.chain.from_iterable(zip(parts, raw))) + parts[-1]
+
+
+def serialize_response(response):
+    """
+    Serialize a response, splicing in pre-rendered results as they are.
+
+    Parameters
+    ----------
+    response : dict
+        The constructed response
+
+    Returns
+    -------
+    str
+        The response as JSON
+    """
+    results = response.get('results')
+    if isinstance(results, JSONFragments):
+        response = dict(response, results=RawJSON('[' + ', '.join(results) + ']'))
+    return dumps(response)
+
+
+def encode_response(response):
+    """
+    Serialize a response once into the bytes the Lambda returns, which the
+    runtime passes through unchanged and the result caches store.
+
+    Parameters
+    ----------
+    response : dict or bytes
+        The constructed response, or one already encoded
+
+    Returns
+    -------
+    bytes
+        The response as JSON
+    """
+    if isinstance(response, bytes):
+        return response
+    return serialize_response(response).encode('utf-8')
+
+
+def response_status(body):
+    """
+    Read the status of an encoded response, which is its first attribute.
+
+    Parameters
+    ----------
+    body : bytes
+        The response as JSON
+
+    Returns
+    -------
+    str
+        The status, such as '200 OK', or '' if the response has none
+    """
+    head = body[:64]
+    if not head.startswith(STATUS_KEY):
+        return ''
+    return head[len(STATUS_KEY):head.find(b'"', len(STATUS_KEY))].decode('utf-8')
+
+
+def with_time(body, elapsed_time):
+    """
+    Replace the 'time' of an encoded response, which follows its status,
+    without serializing it again.
+
+    Parameters
+    ----------
+    body : bytes
+        The response as JSON
+    elapsed_time : float
+        Number of ms to answer the request
+
+    Returns
+    -------
+    bytes
+        The response with the new time, or unchanged if it has no time
+    """
+    start = body.find(TIME_KEY, 0, 64)
+    if start < 0:
+        return body
+    start += len(TIME_KEY)
+    end = body.index(b'"', start)
+    return body[:start] + f'{elapsed_time} ms.'.encode('utf-8') + body[end:]
+
+
+def with_attributes(body, attributes):
+    """
+    Add attributes to the end of an encoded response.
+
+    Parameters
+    ----------
+    body : bytes
+        The response as JSON
+    attributes : dict
+        The attributes to add
+
+    Returns
+    -------
+    bytes
+        The response with the attributes
+    """
+    return body[:-1] + b', ' + json.dumps(attributes).encode('utf-8')[1:]
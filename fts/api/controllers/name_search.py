@@ -0,0 +1,77 @@
+"""
+==============
+name_search.py
+==============
+
+Autocomplete over the river and HUC region names, read from the token
+index the SWORD and HUC loads write (see fts/db/name_index.py). The last
+word of the query is matched as a prefix of an indexed token, which is a
+range scan on the token index; the other words must be words of the name.
+"""
+
+import re
+import unicodedata
+
+# Table of the index
+NAME_INDEX_TABLE = 'name_index'
+# Longest token stored by the loads
+TOKEN_LENGTH = 64
+# Name types in the index
+NAME_TYPES = ('reach', 'node', 'region')
+
+
+def fold_name(name):
+    """
+    Fold a name for searching: lower case, without diacritics, and with
+    punctuation turned into single spaces. Must match the folding of the
+    loads.
+
+    Parameters
+    ----------
+    name : str
+        The name
+
+    Returns
+    -------
+    str
+        The folded words, separated by spaces
+    """
+    decomposed = unicodedata.normalize('NFKD', name)
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(re.findall(r'[^\W_]+', stripped.casefold()))
+
+
+def search_query(words, name_type=None, limit=10):
+    """
+    Build the query of an autocomplete search. Names which are the query
+    come first, then names starting with it, then the names with the most
+    reaches, nodes or HUCs.
+
+    Parameters
+    ----------
+    words : list
+        The folded words of the query
+    name_type : str, optional
+        Only search names of this type
+    limit : int, optional
+        Most names returned
+
+    Returns
+    -------
+    tuple
+        The query, and its arguments
+    """
+    conditions = ["`token` LIKE %s"]
+    args = [words[-1][:TOKEN_LENGTH] + '%']
+    if name_type is not None:
+        conditions.append("`name_type` = %s")
+        args.append(name_type)
+    for word in words[:-1]:
+        conditions.append("CONCAT(' ', `folded`, ' ') LIKE %s")
+        args.append(f'% {word} %')
+
+    folded = ' '.join(words)
+    args += [folded, folded + '%', limit]
+    return (f"SELECT DISTINCT `name`, `name_type`, `hits`, `folded` FROM {NAME_INDEX_TABLE}"
+            f" WHERE {' AND '.join(conditions)}"
+            " ORDER BY `folded` = %s DESC, `folded` LIKE %s DESC, `hits` DESC, `name` LIMIT %s", tuple(args))
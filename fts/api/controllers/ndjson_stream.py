@@ -0,0 +1,137 @@
+"""
+==============
+ndjson_stream.py
+==============
+
+Newline delimited JSON output for large pages. Rows are read in batches
+from an unbuffered server-side cursor and written one result per line,
+so the rows and result dicts of a page are never all held at once; only
+the text of the page, which the API Gateway integration needs in one
+piece, grows with the page size. The last line of a page is its summary:
+status, hits, next_token and the search parameters.
+"""
+
+import json
+
+from fts.api.controllers.json_fragments import dumps
+
+CONTENT_TYPE = 'application/x-ndjson'
+
+
+def iter_batches(cur, batch_size):
+    """
+    Iterate over the rows of the last query in batches.
+
+    Parameters
+    ----------
+    cur : pymysql.cursors.SSCursor
+        Cursor which executed the query
+    batch_size : int
+        Rows fetched per round trip
+
+    Returns
+    -------
+    iterator
+        Lists of up to batch_size rows
+    """
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+
+def iter_rows(cur, batch_size):
+    """
+    Iterate over the rows of the last query, fetching batch_size at a time.
+
+    Parameters
+    ----------
+    cur : pymysql.cursors.SSCursor
+        Cursor which executed the query
+    batch_size : int
+        Rows fetched per round trip
+
+    Returns
+    -------
+    iterator
+        The rows
+    """
+    for rows in iter_batches(cur, batch_size):
+        yield from rows
+
+
+def dumps_line(obj, raw=None):
+    """
+    Serialize one line.
+
+    Parameters
+    ----------
+    obj : dict
+        Values to serialize
+    raw : dict, optional
+        Keys mapped to JSON text which is spliced in without parsing
+
+    Returns
+    -------
+    str
+        The JSON object followed by a newline
+    """
+    line = dumps(obj, default=str)
+    if raw:
+        spliced = ', '.join(f'{json.dumps(key)}: {"null" if value is None else value}' for key, value in raw.items())
+        line = line[:-1] + (', ' if obj else '') + spliced + '}'
+    return line + '\n'
+
+
+def stream_page(rows, page_size, render, summarize):
+    """
+    Write a page of rows followed by its summary.
+
+    Parameters
+    ----------
+    rows : iterator
+        The rows of the page query, which may hold one row more than page_size
+    page_size : int
+        Maximum number of rows written
+    render : callable
+        Called with a row, returns its line
+    summarize : callable
+        Called with the number of rows written, the last row written and
+        whether more rows followed; returns the summary dict
+
+    Returns
+    -------
+    iterator
+        Lines of the page
+    """
+    count = 0
+    last = None
+    has_more = False
+    for row in rows:
+        if count == page_size:
+            has_more = True
+            break
+        yield render(row)
+        count += 1
+        last = row
+    yield dumps_line(summarize(count, last, has_more))
+
+
+def collect(lines):
+    """
+    Join a streamed page for integrations which cannot stream.
+
+    Parameters
+    ----------
+    lines : iterator
+        Lines from stream_page
+
+    Returns
+    -------
+    dict
+        The page status, the format and the NDJSON text
+    """
+    body = ''.join(lines)
+    summary = json.loads(body[body.rfind('\n', 0, len(body) - 1) + 1:])
+    return {'status': summary['status'], 'format': 'ndjson', 'ndjson': body}
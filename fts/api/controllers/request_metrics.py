@@ -0,0 +1,212 @@
+"""
+==============
+request_metrics.py
+==============
+
+Per-request phase timing for the API. The time of a request is split into
+parsing, getting a connection, count queries, page queries, fetching rows
+and building and serializing the response, and is written to the log as
+a CloudWatch Embedded Metric Format (EMF) line, which CloudWatch turns
+into metrics without a metrics API call. Queries and fetches are timed by
+wrapping the cursor, so the request handlers are not changed.
+"""
+
+import json
+import sys
+import time
+
+# Phases of a request, in the order they happen
+PHASES = ('parse', 'connect', 'count_query', 'page_query', 'fetch', 'serialize')
+# CloudWatch namespace and dimensions of the metrics
+METRICS_NAMESPACE = 'FTS'
+METRICS_DIMENSIONS = ('endpoint', 'exact', 'format')
+
+
+def is_count_query(query):
+    """
+    Tell count queries, and the EXPLAIN of count=estimate, from page queries.
+
+    Parameters
+    ----------
+    query : str
+        The query
+
+    Returns
+    -------
+    bool
+        True for a count query
+    """
+    return query.startswith('EXPLAIN ') or query.upper().startswith('SELECT COUNT(')
+
+
+class RequestTimer:
+    """
+    Durations of the phases of one request. Time is measured in laps: each
+    call to lap() adds the time since the previous one to a phase.
+
+    Parameters
+    ----------
+    start : float
+        Time the request started, from time.time()
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self._mark = start
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.rows = 0
+        self.bytes = 0
+        self.queries = 0
+        # Where the response came from: database, cache or huc_index
+        self.source = None
+
+    def lap(self, phase):
+        """
+        Add the time since the previous lap to a phase.
+
+        Parameters
+        ----------
+        phase : str
+            One of PHASES
+        """
+        now = time.time()
+        self.phases[phase] += (now - self._mark) * 1000
+        self._mark = now
+
+    def summary(self):
+        """
+        Get the phase durations and counts.
+
+        Returns
+        -------
+        dict
+            Duration of each phase and of the request in ms, and the number
+            of queries, rows fetched and response bytes
+        """
+        summary = {f'{phase}_ms': round(duration, 3) for phase, duration in self.phases.items()}
+        summary['total_ms'] = round((time.time() - self.start) * 1000, 3)
+        summary['queries'] = self.queries
+        summary['rows'] = self.rows
+        summary['bytes'] = self.bytes
+        return summary
+
+    def emf(self, dimensions, properties=None):
+        """
+        Build the Embedded Metric Format record of the request.
+
+        Parameters
+        ----------
+        dimensions : dict
+            Value of each of METRICS_DIMENSIONS
+        properties : dict, optional
+            Other values logged with the metrics, which are not metrics
+
+        Returns
+        -------
+        dict
+            The EMF record
+        """
+        summary = self.summary()
+        metrics = [{'Name': name, 'Unit': 'Milliseconds' if name.endswith('_ms') else
+                    'Bytes' if name == 'bytes' else 'Count'} for name in summary]
+        record = {
+            '_aws': {
+                'Timestamp': int(self.start * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [list(METRICS_DIMENSIONS)],
+                    'Metrics': metrics,
+                }],
+            },
+        }
+        record.update(properties or {})
+        record.update({name: str(dimensions.get(name)) for name in METRICS_DIMENSIONS})
+        record.update(summary)
+        return record
+
+    def emit(self, dimensions, properties=None):
+        """
+        Write the EMF record as a line of its own on stdout, where the Lambda
+        runtime sends it to CloudWatch Logs.
+
+        Parameters
+        ----------
+        dimensions : dict
+            Value of each of METRICS_DIMENSIONS
+        properties : dict, optional
+            Other values logged with the metrics
+        """
+        sys.stdout.write(json.dumps(self.emf(dimensions, properties)) + '\n')
+        sys.stdout.flush()
+
+
+class TimedCursor:
+    """
+    Cursor wrapper which adds the time of queries and fetches to a timer.
+    Time between the calls is request handling: parsing before the first
+    query, building the results after it.
+
+    Parameters
+    ----------
+    cursor : pymysql.cursor
+        The cursor
+    timer : RequestTimer
+        The timer of the request
+    """
+
+    def __init__(self, cursor, timer):
+        self._cursor = cursor
+        self._timer = timer
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _handling_lap(self):
+        self._timer.lap('parse' if self._timer.queries == 0 else 'serialize')
+
+    def execute(self, query, args=None):
+        """Run a query, timed as a count or page query"""
+        self._handling_lap()
+        try:
+            return self._cursor.execute(query, args)
+        finally:
+            self._timer.queries += 1
+            self._timer.lap('count_query' if is_count_query(query) else 'page_query')
+
+    def add_concurrent_query(self, phase, duration):
+        """
+        Add a query which ran on another connection at the same time as
+        this cursor's queries. Its time is added to the phase without a
+        lap, so the phases of the request can add up to more than its total.
+
+        Parameters
+        ----------
+        phase : str
+            One of PHASES
+        duration : float
+            Time of the query in ms
+        """
+        self._timer.phases[phase] += duration
+        self._timer.queries += 1
+
+    def _fetch(self, rows):
+        self._timer.rows += len(rows)
+        self._timer.lap('fetch')
+        return rows
+
+    def fetchall(self):
+        """Fetch the remaining rows"""
+        self._handling_lap()
+        return self._fetch(self._cursor.fetchall())
+
+    def fetchmany(self, size=1):
+        """Fetch up to size rows"""
+        self._handling_lap()
+        return self._fetch(self._cursor.fetchmany(size))
+
+    def fetchone(self):
+        """Fetch the next row, or None"""
+        self._handling_lap()
+        row = self._cursor.fetchone()
+        self._fetch([] if row is None else [row])
+        return row
@@ -0,0 +1,283 @@
+"""
+==============
+result_cache.py
+==============
+
+Bounded LRU/TTL cache of API responses which lives in the warm Lambda
+container, keyed on the normalized request and invalidated when the
+loaders stamp a new dataset version.
+"""
+
+import collections
+import threading
+import time
+
+import pymysql
+
+# Request parameters whose case does not change the result
+CASE_INSENSITIVE_PARAMS = ('exact', 'polygon_format', 'reaches', 'nodes', 'count', 'count_only', 'format',
+                           'include_geometry')
+# Request parameters which can contain %20 encoded spaces
+SPACE_ENCODED_PARAMS = ('region', 'reach', 'node', 'name', 'river_name')
+# Values which are the same as leaving the parameter out
+DEFAULT_PARAMS = {
+    'exact': 'false',
+    'page_number': '1',
+    'page_size': '100',
+    'reaches': 'true',
+    'nodes': 'true',
+    'count': 'exact',
+    'count_only': 'false',
+    'format': 'json',
+    'include_geometry': 'true',
+}
+# Parameters which do not change the result
+IGNORED_PARAMS = ('debug_timing', 'if_none_match')
+# Table the loaders write dataset versions to
+METADATA_TABLE = 'fts_metadata'
+
+
+def normalize_request(body):
+    """
+    Build the cache key for a request, so that requests which give the same
+    result share a key.
+
+    Parameters
+    ----------
+    body : dict
+        The request parameters
+
+    Returns
+    -------
+    tuple
+        Sorted (parameter, value) pairs, without empty and default values
+    """
+    normalized = []
+    for param, value in body.items():
+        if param in IGNORED_PARAMS:
+            continue
+        value = str(value).strip()
+        if param in CASE_INSENSITIVE_PARAMS:
+            value = value.lower()
+        if param in SPACE_ENCODED_PARAMS:
+            value = " ".join(value.split("%20"))
+        if param in ('page_number', 'page_size') and value.isdigit():
+            value = str(int(value))
+        if value == '' or DEFAULT_PARAMS.get(param) == value:
+            continue
+        normalized.append((param, value))
+    return tuple(sorted(normalized))
+
+
+def read_dataset_version(cur):
+    """
+    Read the dataset versions stamped by the HUC and SWORD loaders.
+
+    Parameters
+    ----------
+    cur : pymysql.cursor
+        pymysql connection cursor
+
+    Returns
+    -------
+    str
+        Combined version of all datasets, or None if no loader stamped one yet
+    """
+    try:
+        cur.execute(f"SELECT dataset, version FROM {METADATA_TABLE} ORDER BY dataset")
+    except pymysql.ProgrammingError:
+        return None
+    rows = cur.fetchall()
+    if not rows:
+        return None
+    return ";".join(f"{dataset}={version}" for dataset, version in rows)
+
+
+class DatasetVersion:
+    """
+    Last known dataset version, read from the database at most once per
+    check_interval seconds.
+
+    Parameters
+    ----------
+    check_interval : float
+        Seconds a version read stays valid
+    """
+
+    def __init__(self, check_interval=60.0):
+        self.check_interval = check_interval
+        self.value = None
+        self._checked = None
+
+    def is_stale(self):
+        """
+        Tell whether the version should be read again.
+
+        Returns
+        -------
+        bool
+            True if the version was never read or the last read is too old
+        """
+        return self._checked is None or time.time() - self._checked >= self.check_interval
+
+    def refresh(self, cur):
+        """
+        Read the version from the database.
+
+        Parameters
+        ----------
+        cur : pymysql.cursor
+            pymysql connection cursor
+
+        Returns
+        -------
+        str
+            The current dataset version
+        """
+        self.value = read_dataset_version(cur)
+        self._checked = time.time()
+        return self.value
+
+
+class ResultCache:  # pylint: disable=too-many-instance-attributes
+    """
+    Thread safe LRU cache with a per entry TTL and a cap on the total size
+    of the cached responses.
+
+    Parameters
+    ----------
+    max_entries : int
+        Maximum number of cached responses. 0 disables the cache.
+    ttl : float
+        Seconds a response stays in the cache
+    max_bytes : int
+        Maximum total size of the cached responses, measured as JSON
+    max_entry_bytes : int, optional
+        Responses larger than this are not cached. Defaults to a quarter of max_bytes.
+    """
+
+    def __init__(self, max_entries=256, ttl=300.0, max_bytes=64 * 1024 * 1024, max_entry_bytes=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes // 4
+        self.version = None
+
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0,
+            'oversize': 0,
+        }
+
+    @property
+    def enabled(self):
+        """True if responses are cached"""
+        return self.max_entries > 0
+
+    def stats(self):
+        """
+        Get the cache counters.
+
+        Returns
+        -------
+        dict
+            Hits, misses, LRU evictions, TTL expirations, version
+            invalidations, responses too large to cache, and the current
+            number of entries and bytes
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        return stats
+
+    def set_version(self, version):
+        """
+        Set the dataset version; all entries are dropped when it changes.
+
+        Parameters
+        ----------
+        version : str
+            The current dataset version
+        """
+        with self._lock:
+            if version != self.version:
+                if self._entries:
+                    self._stats['invalidations'] += 1
+                self._entries.clear()
+                self._bytes = 0
+                self.version = version
+
+    def get(self, key):
+        """
+        Look up a cached response.
+
+        Parameters
+        ----------
+        key : tuple
+            The key from normalize_request
+
+        Returns
+        -------
+        bytes
+            The cached response as JSON, or None
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            value, size, expires = entry
+            if time.time() >= expires:
+                del self._entries[key]
+                self._bytes -= size
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return value
+
+    def put(self, key, value, size=None):
+        """
+        Cache a response, evicting the least recently used entries as needed.
+
+        Parameters
+        ----------
+        key : tuple
+            The key from normalize_request
+        value : bytes
+            The response as JSON
+        size : int, optional
+            Size of the response in bytes, len(value) when not given
+        """
+        if not self.enabled:
+            return
+        if size is None:
+            size = len(value)
+        with self._lock:
+            if size > self.max_entry_bytes:
+                self._stats['oversize'] += 1
+                return
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size, time.time() + self.ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._stats['evictions'] += 1
+
+    def clear(self):
+        """Drop all entries."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
@@ -0,0 +1,319 @@
+"""
+==============
+shared_cache.py
+==============
+
+Optional result cache tier shared by all Lambda instances, kept in a
+Redis or memcached server. Responses are stored as compressed JSON under
+dataset versioned keys, and 404 results are cached for a shorter time.
+A pure Python in-memory backend stands in for the server in tests and
+local runs.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+import zlib
+from urllib.parse import urlparse
+
+logger = logging.getLogger()
+
+# Payload prefixes: raw JSON, zlib compressed JSON, cached 404 message
+RAW = b'j'
+COMPRESSED = b'z'
+NOT_FOUND = b'n'
+
+
+class NegativeResult:  # pylint: disable=too-few-public-methods
+    """
+    A cached 404 result
+
+    Parameters
+    ----------
+    message : str
+        The error message of the original request
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+class InMemoryBackend:
+    """
+    Pure Python stand-in for a shared key-value server, with per key expiry.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value stored at key, or None if missing or expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if time.time() >= expires:
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl):
+        """Store value at key for ttl seconds."""
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl)
+
+
+class RedisBackend:
+    """
+    Redis backend. Requires the redis package.
+
+    Parameters
+    ----------
+    url : str
+        redis:// or rediss:// URL of the server
+    timeout : float
+        Socket timeout in seconds
+    """
+
+    def __init__(self, url, timeout):
+        import redis  # pylint: disable=import-outside-toplevel,import-error
+
+        self._client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+
+    def get(self, key):
+        """Return the value stored at key, or None."""
+        return self._client.get(key)
+
+    def set(self, key, value, ttl):
+        """Store value at key for ttl seconds."""
+        self._client.set(key, value, ex=max(1, int(ttl)))
+
+
+class MemcachedBackend:
+    """
+    Memcached backend. Requires the pymemcache package.
+
+    Parameters
+    ----------
+    url : str
+        memcached://host:port URL of the server
+    timeout : float
+        Socket timeout in seconds
+    """
+
+    def __init__(self, url, timeout):
+        from pymemcache.client.base import Client  # pylint: disable=import-outside-toplevel,import-error
+
+        parsed = urlparse(url)
+        self._client = Client((parsed.hostname, parsed.port or 11211), connect_timeout=timeout,
+                              timeout=timeout)
+
+    def get(self, key):
+        """Return the value stored at key, or None."""
+        return self._client.get(key)
+
+    def set(self, key, value, ttl):
+        """Store value at key for ttl seconds."""
+        self._client.set(key, value, expire=max(1, int(ttl)))
+
+
+def create_backend(url, timeout=0.1):
+    """
+    Create the backend for a SHARED_CACHE_URL.
+
+    Parameters
+    ----------
+    url : str
+        redis://, rediss://, memcached:// or memory:// URL
+    timeout : float
+        Socket timeout in seconds for server backends
+
+    Returns
+    -------
+    object
+        Backend with get(key) and set(key, value, ttl) methods
+    """
+    scheme = urlparse(url).scheme
+    if scheme in ('redis', 'rediss'):
+        return RedisBackend(url, timeout)
+    if scheme == 'memcached':
+        return MemcachedBackend(url, timeout)
+    if scheme == 'memory':
+        return InMemoryBackend()
+    raise ValueError(f"Unsupported shared cache URL scheme '{scheme}'.")
+
+
+class SharedCache:
+    """
+    Versioned, compressed response cache on top of a shared backend. Errors
+    from the backend are logged and counted, and never fail a request.
+
+    Parameters
+    ----------
+    backend : object
+        Backend with get(key) and set(key, value, ttl) methods, or None to disable
+    ttl : float
+        Seconds a response stays in the cache
+    negative_ttl : float
+        Seconds a 404 result stays in the cache
+    compress_min_bytes : int
+        Responses smaller than this are stored uncompressed
+    prefix : str
+        Prefix of all keys
+    """
+
+    def __init__(self, backend=None, ttl=3600.0, negative_ttl=300.0, compress_min_bytes=1024, prefix='fts'):
+        self.backend = backend
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.compress_min_bytes = compress_min_bytes
+        self.prefix = prefix
+
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'negative_hits': 0,
+            'misses': 0,
+            'sets': 0,
+            'errors': 0,
+            'bytes_written': 0,
+        }
+
+    @property
+    def enabled(self):
+        """True if a backend is configured"""
+        return self.backend is not None
+
+    def stats(self):
+        """
+        Get the cache counters.
+
+        Returns
+        -------
+        dict
+            Hits, cached 404 hits, misses, writes, backend errors and
+            compressed bytes written
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, stat, amount=1):
+        with self._lock:
+            self._stats[stat] += amount
+
+    def make_key(self, cache_key, version):
+        """
+        Build the backend key for a request.
+
+        Parameters
+        ----------
+        cache_key : tuple
+            The normalized request
+        version : str
+            The dataset version
+
+        Returns
+        -------
+        str
+            The key, which changes with the dataset version
+        """
+        digest = hashlib.sha256(json.dumps([version, cache_key]).encode('utf-8')).hexdigest()
+        return f"{self.prefix}:{digest}"
+
+    def get(self, cache_key, version):
+        """
+        Look up a cached response.
+
+        Parameters
+        ----------
+        cache_key : tuple
+            The normalized request
+        version : str
+            The dataset version
+
+        Returns
+        -------
+        bytes or NegativeResult
+            The cached response as JSON, a NegativeResult for a cached 404, or None
+        """
+        if not self.enabled:
+            return None
+        try:
+            payload = self.backend.get(self.make_key(cache_key, version))
+        except Exception as ex:  # pylint: disable=broad-except
+            logger.warning("Shared cache get failed: %s", ex)
+            self._count('errors')
+            return None
+
+        if payload is None:
+            self._count('misses')
+            return None
+
+        kind, data = payload[:1], payload[1:]
+        try:
+            if kind == NOT_FOUND:
+                result = NegativeResult(data.decode('utf-8'))
+            elif kind in (RAW, COMPRESSED):
+                result = zlib.decompress(data) if kind == COMPRESSED else data
+                # Served as it is, so check it is a whole JSON object without parsing it
+                if not (result.startswith(b'{') and result.endswith(b'}')):
+                    raise ValueError('not a JSON object')
+            else:
+                raise ValueError(f'unknown payload type {kind!r}')
+        except (ValueError, zlib.error) as ex:
+            # A truncated value, or one written by something else under the key
+            logger.warning("Shared cache value could not be decoded: %s", ex)
+            self._count('errors')
+            return None
+        self._count('negative_hits' if isinstance(result, NegativeResult) else 'hits')
+        return result
+
+    def put(self, cache_key, version, body):
+        """
+        Store a response.
+
+        Parameters
+        ----------
+        cache_key : tuple
+            The normalized request
+        version : str
+            The dataset version
+        body : bytes
+            The response serialized as JSON
+        """
+        if len(body) >= self.compress_min_bytes:
+            payload = COMPRESSED + zlib.compress(body, 6)
+        else:
+            payload = RAW + body
+        self._set(self.make_key(cache_key, version), payload, self.ttl)
+
+    def put_not_found(self, cache_key, version, message):
+        """
+        Store a 404 result.
+
+        Parameters
+        ----------
+        cache_key : tuple
+            The normalized request
+        version : str
+            The dataset version
+        message : str
+            The error message
+        """
+        self._set(self.make_key(cache_key, version), NOT_FOUND + message.encode('utf-8'), self.negative_ttl)
+
+    def _set(self, key, payload, ttl):
+        if not self.enabled:
+            return
+        try:
+            self.backend.set(key, payload, ttl)
+        except Exception as ex:  # pylint: disable=broad-except
+            logger.warning("Shared cache set failed: %s", ex)
+            self._count('errors')
+            return
+        self._count('sets')
+        self._count('bytes_written', len(payload))
@@ -0,0 +1,325 @@
+"""
+==============
+snapshot_backend.py
+==============
+
+Read-only SQLite snapshot of the FTS database (see fts/db/build_snapshot.py)
+which the API can serve from instead of MySQL, with DB_BACKEND=snapshot.
+The file is opened immutable and memory-mapped, from a Lambda layer, a
+local path, or an s3:// URL downloaded to /tmp on first use.
+
+Cursors take the API's MySQL queries unchanged: %s placeholders become ?,
+the geometry functions of the spatial queries are provided as SQL
+functions, and EXPLAIN row estimates are answered with the exact count.
+MBRIntersects on the geometry of a table is read from the R*Tree of its
+bounding boxes, as MySQL reads it from the SPATIAL index, so only the
+rows whose box intersects the area's are checked.
+Text columns are NOCASE, matching MySQL's case insensitive comparisons.
+"""
+
+import contextlib
+import functools
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# Where a snapshot downloaded from S3 is kept
+DOWNLOAD_DIR = '/tmp'
+# Bytes of the snapshot SQLite memory-maps
+MMAP_SIZE = 1024 * 1024 * 1024
+# R*Tree of the geometry bounding boxes of each table, and the id number
+# column its ids are
+SPATIAL_INDEXES = {'reaches': ('reaches_geom_rtree', 'reach_num'), 'nodes': ('nodes_geom_rtree', 'node_num')}
+# Bounding box condition of the spatial queries, and its table
+MBR_CONDITION = re.compile(r"FROM (\w+) WHERE (MBRIntersects\(`geom`, ST_GeomFromText\(%s\)\))")
+
+
+@functools.lru_cache(maxsize=32)
+def _query_geometry(value):
+    import shapely  # pylint: disable=import-outside-toplevel,import-error
+
+    return shapely.from_wkb(value)
+
+
+def _row_geometry(value):
+    import shapely  # pylint: disable=import-outside-toplevel,import-error
+
+    return shapely.from_wkb(value)
+
+
+def st_geomfromtext(wkt, srid=0):  # pylint: disable=unused-argument
+    """ST_GeomFromText: WKT to the WKB the snapshot stores geometries as"""
+    import shapely  # pylint: disable=import-outside-toplevel,import-error
+
+    return shapely.to_wkb(shapely.from_wkt(wkt))
+
+
+def mbr_intersects(geom, area):
+    """MBRIntersects: 1 if the bounding boxes of two WKB geometries intersect"""
+    if geom is None or area is None:
+        return None
+    min_x, min_y, max_x, max_y = _row_geometry(geom).bounds
+    area_min_x, area_min_y, area_max_x, area_max_y = _query_geometry(area).bounds
+    return int(min_x <= area_max_x and area_min_x <= max_x and min_y <= area_max_y and area_min_y <= max_y)
+
+
+def mbr_bound(area, index):
+    """MBRBound: min_x, min_y, max_x or max_y, by index, of a WKB geometry"""
+    if area is None:
+        return None
+    return _query_geometry(area).bounds[index]
+
+
+def spatial_prefilter(query, args, spatial_indexes):
+    """
+    Read the MBRIntersects condition of a query from the R*Tree of its
+    table, keeping the condition for the rows the R*Tree finds.
+
+    Parameters
+    ----------
+    query : str
+        The query, with %s placeholders
+    args : tuple
+        The query arguments
+    spatial_indexes : frozenset
+        Tables of the snapshot which have an R*Tree
+
+    Returns
+    -------
+    tuple
+        The query and its arguments
+    """
+    match = MBR_CONDITION.search(query)
+    if match is None or match.group(1) not in spatial_indexes:
+        return query, args
+    rtree, number_column = SPATIAL_INDEXES[match.group(1)]
+    area = "ST_GeomFromText(%s)"
+    prefilter = (f"`{number_column}` IN (SELECT id FROM {rtree} WHERE min_x <= MBRBound({area}, 2)"
+                 f" AND max_x >= MBRBound({area}, 0) AND min_y <= MBRBound({area}, 3)"
+                 f" AND max_y >= MBRBound({area}, 1)) AND ")
+    position = query[:match.start(2)].count('%s')
+    query = query[:match.start(2)] + prefilter + query[match.start(2):]
+    return query, args[:position] + (args[position],) * 4 + args[position:]
+
+
+def st_intersects(geom, area):
+    """ST_Intersects: 1 if two WKB geometries intersect"""
+    if geom is None or area is None:
+        return None
+    return int(_row_geometry(geom).intersects(_query_geometry(area)))
+
+
+def concat(*values):
+    """CONCAT, which SQLite only has built in from 3.44"""
+    if any(value is None for value in values):
+        return None
+    return ''.join(str(value) for value in values)
+
+
+class SnapshotCursor:
+    """
+    DB-API cursor which runs the API's MySQL queries on the snapshot.
+
+    Parameters
+    ----------
+    cursor : sqlite3.Cursor
+        Cursor of the snapshot connection
+    spatial_indexes : frozenset, optional
+        Tables of the snapshot which have an R*Tree
+    """
+
+    def __init__(self, cursor, spatial_indexes=frozenset()):
+        self._cursor = cursor
+        self._spatial_indexes = spatial_indexes
+        self._rows = None
+        self.description = None
+
+    def execute(self, query, args=None):
+        """
+        Run a query.
+
+        Parameters
+        ----------
+        query : str
+            The query, with %s placeholders
+        args : tuple or str, optional
+            The query arguments
+
+        Returns
+        -------
+        int
+            -1, as the row count is not known before fetching
+        """
+        if args is None:
+            args = ()
+        elif not isinstance(args, (tuple, list)):
+            args = (args,)
+        query, args = spatial_prefilter(query, tuple(args), self._spatial_indexes)
+        query = query.replace('%s', '?')
+        self._rows = None
+
+        if query[:len('EXPLAIN SELECT ')].upper() == 'EXPLAIN SELECT ':
+            # No optimizer row estimate; the exact count of a COUNT(*) query stands in
+            self._cursor.execute(query[len('EXPLAIN '):], tuple(args))
+            self._rows = [(self._cursor.fetchone()[0], 100.0)]
+            self.description = (('rows',) + (None,) * 6, ('filtered',) + (None,) * 6)
+            return -1
+
+        self._cursor.execute(query, tuple(args))
+        self.description = self._cursor.description
+        return -1
+
+    def fetchone(self):
+        """Fetch the next row, or None"""
+        if self._rows is not None:
+            return self._rows.pop(0) if self._rows else None
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=1):
+        """Fetch up to size rows"""
+        if self._rows is not None:
+            rows, self._rows = self._rows[:size], self._rows[size:]
+            return rows
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self):
+        """Fetch the remaining rows"""
+        if self._rows is not None:
+            rows, self._rows = self._rows, []
+            return rows
+        return self._cursor.fetchall()
+
+    def close(self):
+        """Close the cursor"""
+        self._cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SnapshotConnection:  # pylint: disable=too-few-public-methods
+    """
+    Connection handed out by SnapshotConnections.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        The open snapshot
+    spatial_indexes : frozenset, optional
+        Tables of the snapshot which have an R*Tree
+    """
+
+    def __init__(self, connection, spatial_indexes=frozenset()):
+        self._connection = connection
+        self._spatial_indexes = spatial_indexes
+
+    def cursor(self, cursor_class=None):  # pylint: disable=unused-argument
+        """
+        Open a cursor. SQLite cursors already read rows as they are fetched,
+        so the pymysql cursor class is ignored.
+
+        Returns
+        -------
+        SnapshotCursor
+            The cursor
+        """
+        return SnapshotCursor(self._connection.cursor(), self._spatial_indexes)
+
+
+class SnapshotConnections:
+    """
+    Drop-in for ConnectionManager which serves from a snapshot file. The
+    snapshot is opened on first use and shared, as it is never written.
+
+    Parameters
+    ----------
+    location : str
+        Local path, or s3://bucket/key which is downloaded first
+    """
+
+    def __init__(self, location):
+        self.location = location
+        self._connection = None
+        self._spatial_indexes = frozenset()
+        self._lock = threading.Lock()
+        self._stats = {'connects': 0, 'connect_ms': 0.0}
+
+    def stats(self):
+        """
+        Get the connection counters of this process.
+
+        Returns
+        -------
+        dict
+            Number of times the snapshot was opened, time spent opening it in
+            ms, and the number of open connections
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['open_connections'] = int(self._connection is not None)
+        return stats
+
+    def _open(self):
+        started = time.time()
+        path = self.location
+        if not path:
+            raise RuntimeError('DB_BACKEND is snapshot, but SNAPSHOT_PATH is not set.')
+        if path.startswith('s3://'):
+            import boto3  # pylint: disable=import-outside-toplevel,import-error
+
+            bucket, key = path[len('s3://'):].split('/', 1)
+            path = os.path.join(DOWNLOAD_DIR, os.path.basename(key))
+            if not os.path.exists(path):
+                boto3.client('s3').download_file(bucket, key, path)
+
+        connection = sqlite3.connect(f'file:{path}?mode=ro&immutable=1', uri=True, check_same_thread=False)
+        connection.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+        connection.create_function('ST_GeomFromText', -1, st_geomfromtext, deterministic=True)
+        connection.create_function('MBRIntersects', 2, mbr_intersects, deterministic=True)
+        connection.create_function('ST_Intersects', 2, st_intersects, deterministic=True)
+        connection.create_function('MBRBound', 2, mbr_bound, deterministic=True)
+        # Snapshots built before the R*Tree was added are scanned
+        names = {name for name, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        self._spatial_indexes = frozenset(table for table, (rtree, _) in SPATIAL_INDEXES.items() if rtree in names)
+        if sqlite3.sqlite_version_info < (3, 44):
+            connection.create_function('CONCAT', -1, concat, deterministic=True)
+
+        self._stats['connects'] += 1
+        self._stats['connect_ms'] += (time.time() - started) * 1000
+        return connection
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Context manager which yields the snapshot connection, opening it
+        on first use.
+        """
+        with self._lock:
+            if self._connection is None:
+                self._connection = self._open()
+            connection = self._connection
+        yield SnapshotConnection(connection, self._spatial_indexes)
+
+    @staticmethod
+    def submit(func):  # pylint: disable=unused-argument
+        """
+        Queries are not run on a second connection: the snapshot has one,
+        shared connection, and its queries are local.
+
+        Returns
+        -------
+        None
+        """
+        return None
+
+    def close(self):
+        """Close the snapshot."""
+        with self._lock:
+            connection, self._connection = self._connection, None
+        if connection is not None:
+            connection.close()
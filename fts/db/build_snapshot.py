@@ -0,0 +1,266 @@
+"""
+==============
+build_snapshot.py
+==============
+
+Export the FTS database into a single read-only SQLite file, with the
+indexes the API's queries need, which the API serves from with
+DB_BACKEND=snapshot and SNAPSHOT_PATH set to the file (shipped in a Lambda
+layer, or an s3:// URL downloaded to /tmp). See
+fts/api/controllers/snapshot_backend.py.
+
+Text columns are NOCASE, matching MySQL's case insensitive comparisons,
+which also lets SQLite read LIKE 'prefix%' from their indexes. The native
+MySQL geometry is replaced by WKB built from the WKT geometry of each row,
+and its bounding box is indexed in an R*Tree keyed on the reach_num or
+node_num id number, which spatial queries are prefiltered with. The id
+numbers are added when the source does not have them.
+
+Run with the DB_HOST, DB_NAME, DB_USER and DB_PASS of the source database:
+
+    python -m fts.db.build_snapshot --output fts_snapshot.sqlite
+"""
+
+import argparse
+import logging
+import math
+import os
+import sqlite3
+
+from sqlalchemy import create_engine, inspect, select, table, column
+from sqlalchemy.types import Float, Integer, LargeBinary, Numeric
+import shapely
+
+from fts.api.controllers.snapshot_backend import SPATIAL_INDEXES
+
+# Tables exported, when the source has them
+SNAPSHOT_TABLES = ('huc_table', 'reaches', 'nodes', 'name_index', 'fts_metadata')
+# Snapshot geometry column, WKB of the WKT column of the same row
+SPATIAL_COLUMN = 'geom'
+WKT_COLUMN = 'geometry'
+GEOMETRY_TABLES = ('reaches', 'nodes')
+# Integer copies of the ids, which id prefix searches are read from as ranges
+ID_NUMBER_COLUMNS = {'reaches': ('reach_id', 'reach_num'), 'nodes': ('node_id', 'node_num')}
+# Indexes of the API's queries, created when the table has the columns
+SNAPSHOT_INDEXES = {
+    'huc_table': [('HUC',), ('huc_level', 'HUC'), ('Region', 'huc_level', 'HUC')],
+    'reaches': [('reach_id',), ('river_name',), ('reach_num',)],
+    'nodes': [('node_id',), ('river_name',), ('reach_id',), ('node_num',)],
+    'name_index': [('token', 'name_type')],
+    'fts_metadata': [('dataset',)],
+}
+# Rows read from the source per batch
+BATCH_SIZE = 5000
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def snapshot_type(sqla_type):
+    """
+    Map a source column type to the snapshot column type.
+
+    Parameters
+    ----------
+    sqla_type : sqlalchemy.types.TypeEngine
+        Type of the source column
+
+    Returns
+    -------
+    str
+        SQLite column type
+    """
+    if isinstance(sqla_type, Integer):
+        return 'INTEGER'
+    if isinstance(sqla_type, (Float, Numeric)):
+        return 'REAL'
+    if isinstance(sqla_type, LargeBinary):
+        return 'BLOB'
+    return 'TEXT COLLATE NOCASE'
+
+
+def wkb_geometries(values):
+    """
+    Build the WKB geometries and bounding boxes of a batch of WKT geometries.
+
+    Parameters
+    ----------
+    values : list
+        WKT geometries, or None
+
+    Returns
+    -------
+    list
+        (WKB, (min_x, min_y, max_x, max_y)) of each geometry, None where
+        the WKT is missing
+    """
+    geometries = shapely.from_wkt(values)
+    return [None if value is None else (bytes(wkb), tuple(bounds))
+            for value, wkb, bounds in zip(values, shapely.to_wkb(geometries), shapely.bounds(geometries))]
+
+
+def index_boxes(snapshot, table_name, numbers, geometries):
+    """
+    Add the bounding boxes of a batch of rows to the R*Tree of their table.
+
+    Parameters
+    ----------
+    snapshot : sqlite3.Connection
+        Snapshot being built
+    table_name : str
+        Table of the rows
+    numbers : list
+        Id number of each row
+    geometries : list
+        WKB and bounding box of each row, from wkb_geometries
+    """
+    # Missing and empty geometries have no bounding box, and no row in the R*Tree
+    boxes = [(number, geometry[1]) for number, geometry in zip(numbers, geometries)
+             if geometry is not None and not math.isnan(geometry[1][0])]
+    snapshot.executemany(f'INSERT INTO "{SPATIAL_INDEXES[table_name][0]}" VALUES (?, ?, ?, ?, ?)',
+                         [(number, min_x, max_x, min_y, max_y) for number, (min_x, min_y, max_x, max_y) in boxes])
+
+
+def copy_table(source, snapshot, table_name):  # pylint: disable=too-many-locals
+    """
+    Create a table in the snapshot and copy the rows of the source table.
+
+    Parameters
+    ----------
+    source : sqlalchemy.engine.Engine
+        Source database
+    snapshot : sqlite3.Connection
+        Snapshot being built
+    table_name : str
+        Table to copy
+
+    Returns
+    -------
+    int
+        Number of rows copied
+    """
+    columns = [col for col in inspect(source).get_columns(table_name) if col['name'] != SPATIAL_COLUMN]
+    names = [col['name'] for col in columns]
+    definitions = [f'"{col["name"]}" {snapshot_type(col["type"])}' for col in columns]
+
+    with_geometry = table_name in GEOMETRY_TABLES and WKT_COLUMN in names
+    if with_geometry:
+        definitions.append(f'"{SPATIAL_COLUMN}" BLOB')
+    id_column, number_column = ID_NUMBER_COLUMNS.get(table_name, (None, None))
+    add_number = id_column in names and number_column not in names
+    if add_number:
+        definitions.append(f'"{number_column}" INTEGER')
+
+    snapshot.execute(f'CREATE TABLE "{table_name}" ({", ".join(definitions)})')
+    insert = f'INSERT INTO "{table_name}" VALUES ({", ".join("?" * len(definitions))})'
+
+    spatial_index = with_geometry and id_column in names
+    if spatial_index:
+        snapshot.execute(f'CREATE VIRTUAL TABLE "{SPATIAL_INDEXES[table_name][0]}" '
+                         'USING rtree(id, min_x, max_x, min_y, max_y)')
+
+    copied = 0
+    query = select(*[column(name) for name in names]).select_from(table(table_name))
+    with source.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        while rows := result.fetchmany(BATCH_SIZE):
+            rows = [list(row) for row in rows]
+            geometries = wkb_geometries([row[names.index(WKT_COLUMN)] for row in rows]) if with_geometry else []
+            for row, geometry in zip(rows, geometries):
+                row.append(None if geometry is None else geometry[0])
+            numbers = [int(row[names.index(id_column)]) for row in rows] if id_column in names else []
+            if add_number:
+                for row, number in zip(rows, numbers):
+                    row.append(number)
+            if spatial_index:
+                index_boxes(snapshot, table_name, numbers, geometries)
+            snapshot.executemany(insert, rows)
+            copied += len(rows)
+    logger.info("Copied %s rows of %s", copied, table_name)
+    return copied
+
+
+def index_table(snapshot, table_name):
+    """
+    Create the indexes of a snapshot table whose columns it has.
+
+    Parameters
+    ----------
+    snapshot : sqlite3.Connection
+        Snapshot being built
+    table_name : str
+        Table to index
+    """
+    names = {row[1] for row in snapshot.execute(f'PRAGMA table_info("{table_name}")')}
+    for columns in SNAPSHOT_INDEXES.get(table_name, []):
+        if set(columns) <= names:
+            index_name = f'{table_name}_{"_".join(columns)}_idx'.lower()
+            quoted = ', '.join(f'"{name}"' for name in columns)
+            snapshot.execute(f'CREATE INDEX "{index_name}" ON "{table_name}" ({quoted})')
+
+
+def build_snapshot(source, path):
+    """
+    Build a snapshot of the source database. The file is written next to
+    path and moved into place when complete.
+
+    Parameters
+    ----------
+    source : sqlalchemy.engine.Engine
+        Source database
+    path : str
+        Snapshot file to write
+
+    Returns
+    -------
+    dict
+        Number of rows copied per table
+    """
+    building = path + '.building'
+    if os.path.exists(building):
+        os.remove(building)
+
+    existing = set(inspect(source).get_table_names())
+    copied = {}
+    snapshot = sqlite3.connect(building)
+    try:
+        snapshot.execute('PRAGMA journal_mode = OFF')
+        snapshot.execute('PRAGMA synchronous = OFF')
+        for table_name in SNAPSHOT_TABLES:
+            if table_name not in existing:
+                logger.info("No %s table, skipping", table_name)
+                continue
+            copied[table_name] = copy_table(source, snapshot, table_name)
+            index_table(snapshot, table_name)
+            snapshot.commit()
+        if 'fts_metadata' not in copied:
+            # The API reads its dataset version from here
+            snapshot.execute('CREATE TABLE fts_metadata (dataset TEXT, version TEXT, updated_at TEXT)')
+            index_table(snapshot, 'fts_metadata')
+        snapshot.execute('ANALYZE')
+        snapshot.commit()
+        snapshot.execute('VACUUM')
+    finally:
+        snapshot.close()
+    os.replace(building, path)
+    return copied
+
+
+def main():
+    """
+    Entry point to build a snapshot of the FTS database.
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='fts_snapshot.sqlite')
+    args = parser.parse_args()
+
+    engine = create_engine(
+        'mysql+pymysql://' + os.environ['DB_USER'] + ':' + os.environ['DB_PASS'] + '@'
+        + os.environ['DB_HOST'] + '/' + os.environ['DB_NAME']
+    )
+    copied = build_snapshot(engine, args.output)
+    logger.info("Wrote %s: %s", args.output, copied)
+
+
+if __name__ == '__main__':
+    main()
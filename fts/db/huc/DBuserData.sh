@@ -11,6 +11,7 @@ dnf update -y
 dnf install -y mariadb105
 #get HUC database dump from S3
 aws s3 cp s3://podaac-services-${tf_venue}-deploy/internal/HUC_Data.csv HUC_Data.csv
+aws s3 cp s3://podaac-services-${tf_venue}-deploy/internal/Name_Index.csv Name_Index.csv
 
 # Get Admin username, User username, Host, and Database name from SSM.
 FTS_ADMIN=$(aws ssm get-parameter \
@@ -61,7 +62,7 @@ set -x
 #drop table
 mysql -e 'DROP TABLE IF EXISTS `huc_table`'
 #create table
-mysql -e 'CREATE TABLE IF NOT EXISTS `huc_table` (`HUC` varchar(50) DEFAULT NULL, `Region` varchar(500) DEFAULT NULL, `Polygon Convex Hull` text, `Polygon Visvalingam` text, `Bounding Box` varchar(255) DEFAULT NULL, KEY `Region` (`Region`) USING HASH,KEY `HUC` (`HUC`) USING HASH)'
+mysql -e 'CREATE TABLE IF NOT EXISTS `huc_table` (`HUC` varchar(50) DEFAULT NULL, `Region` varchar(500) DEFAULT NULL, `Polygon Convex Hull` text, `Polygon Visvalingam` text, `Bounding Box` varchar(255) DEFAULT NULL, `GeoJSON Convex Hull` text, `GeoJSON Visvalingam` text, `GeoJSON Bounding Box` text, `huc_level` tinyint AS (CHAR_LENGTH(`HUC`)) STORED, KEY `HUC` (`HUC`) USING BTREE, KEY `huc_level_huc` (`huc_level`, `HUC`) USING BTREE, KEY `region_level_huc` (`Region`, `huc_level`, `HUC`) USING BTREE)'
 
 #create a user for the lambda functions
 # Retrieve user password from SSM. Do not echo command itself because that would display the password in the logs
@@ -76,7 +77,17 @@ mysql -e "grant SELECT, INSERT, DROP, UPDATE, INDEX, CREATE on ${FTS_RDS_DBNAME}
 set -x
 
 #add data to the table
-mysql -e "LOAD DATA LOCAL INFILE 'HUC_Data.csv' INTO TABLE ${FTS_RDS_DBNAME}.huc_table FIELDS TERMINATED BY ',' ENCLOSED BY '\"' IGNORE 1 LINES"
+#huc_level is generated from HUC, so the CSV columns are listed
+mysql -e "LOAD DATA LOCAL INFILE 'HUC_Data.csv' INTO TABLE ${FTS_RDS_DBNAME}.huc_table FIELDS TERMINATED BY ',' ENCLOSED BY '\"' IGNORE 1 LINES (\`HUC\`, \`Region\`, \`Polygon Convex Hull\`, \`Polygon Visvalingam\`, \`Bounding Box\`, \`GeoJSON Convex Hull\`, \`GeoJSON Visvalingam\`, \`GeoJSON Bounding Box\`)"
+
+#replace the region rows of the name search index, which the SWORD load shares
+mysql -e 'CREATE TABLE IF NOT EXISTS `name_index` (`token` varchar(64) NOT NULL, `name` text NOT NULL, `name_type` varchar(16) NOT NULL, `folded` text NOT NULL, `hits` int NOT NULL, KEY `name_index_token_idx` (`token`, `name_type`))'
+mysql -e "DELETE FROM name_index WHERE name_type = 'region'"
+mysql -e "LOAD DATA LOCAL INFILE 'Name_Index.csv' INTO TABLE ${FTS_RDS_DBNAME}.name_index FIELDS TERMINATED BY ',' ENCLOSED BY '\"' IGNORE 1 LINES (\`token\`, \`name\`, \`name_type\`, \`folded\`, \`hits\`)"
+
+#stamp the new dataset version so the API drops its cached responses
+mysql -e 'CREATE TABLE IF NOT EXISTS `fts_metadata` (`dataset` varchar(32) NOT NULL PRIMARY KEY, `version` varchar(64) NOT NULL, `updated_at` varchar(32) NOT NULL)'
+mysql -e "REPLACE INTO fts_metadata (dataset, version, updated_at) VALUES ('huc', '$(date -u +%Y%m%dT%H%M%SZ)-$(head -c 4 /dev/urandom | od -An -tx1 | tr -d ' \n')', '$(date -u +%Y-%m-%dT%H:%M:%S+00:00)')"
 
 #shutdown the instance
 shutdown
@@ -5,6 +5,7 @@
 Group of functions that performs the simplification algorithms, converts the
    results to a CMR queryable string, and writes individual HUCs to shapefiles
 """
+import json
 import os
 import re
 import shutil
@@ -14,13 +15,19 @@ import zipfile
 
 import geopandas as gpd
 import numpy as np
+import pandas as pd
 import shapely
 import visvalingamwyatt as vw
 from shapely.geometry import Polygon
 from tqdm import tqdm
 
+from fts.db.name_index import name_index_rows
+
 warnings.filterwarnings('ignore')
 
+# Decimal places kept in the precomputed GeoJSON, same as the API
+GEOJSON_PRECISION = 15
+
 
 def format_polygon(polygon):
     """
@@ -44,6 +51,99 @@ def format_polygon(polygon):
     return cmr_polygon
 
 
+def flat_to_geojson_polygon(flat_polygon):
+    """
+    Function that converts a CMR queryable polygon string to GeoJSON Polygon
+       text, so the API can return it without parsing coordinates
+
+    Parameters
+    ----------
+    flat_polygon
+        Comma delimited lon,lat pairs
+
+    Returns
+    -------
+    str
+        GeoJSON Polygon with a closed exterior ring
+    """
+    values = [round(float(value), GEOJSON_PRECISION) for value in flat_polygon.split(',')]
+    ring = [[lon, lat] for lon, lat in zip(values[::2], values[1::2])]
+    ring.append(ring[0])
+
+    return json.dumps({"type": "Polygon", "coordinates": [ring]})
+
+
+def flat_bbox_to_geojson_polygon(flat_bbox):
+    """
+    Function that converts a CMR queryable bbox string (west, south, east,
+       north) to GeoJSON Polygon text of its corners
+
+    Parameters
+    ----------
+    flat_bbox
+        Comma delimited west,south,east,north
+
+    Returns
+    -------
+    str
+        GeoJSON Polygon with a closed exterior ring
+    """
+    west, south, east, north = [round(float(value), GEOJSON_PRECISION) for value in flat_bbox.split(',')]
+    ring = [[west, south], [west, north], [east, north], [east, south], [west, south]]
+
+    return json.dumps({"type": "Polygon", "coordinates": [ring]})
+
+
+def write_huc_index(full_df, path):
+    """
+    Function that writes the index the API's point and polygon HUC lookup is
+       built from: the HUC, region and Visvalingam polygon of each HUC, as
+       ragged coordinate arrays in a compressed numpy archive
+
+    Parameters
+    ----------
+    full_df
+        HUCs with their 'Polygon Visvalingam' flat polygons
+    path
+        Output .npz file
+
+    Returns
+    -------
+
+    """
+    polygons = []
+    for flat_polygon in full_df['Polygon Visvalingam']:
+        values = [float(value) for value in flat_polygon.split(',')]
+        polygons.append(Polygon(list(zip(values[::2], values[1::2]))))
+    _, coords, (ring_offsets, polygon_offsets) = shapely.to_ragged_array(polygons)
+
+    np.savez_compressed(path,
+                        huc=np.array(full_df['HUC'], dtype=str),
+                        region=np.array(full_df['Region'], dtype=str),
+                        coords=coords, ring_offsets=ring_offsets, polygon_offsets=polygon_offsets)
+
+
+def write_name_index(full_df, path):
+    """
+    Function that writes the region rows of the API's name search index:
+       one row per word of each region name, with the number of HUCs
+       which have the name
+
+    Parameters
+    ----------
+    full_df
+        HUCs with their 'Region' names
+    path
+        Output .csv file
+
+    Returns
+    -------
+
+    """
+    rows = name_index_rows(full_df['Region'].value_counts().items(), 'region')
+    pd.DataFrame(rows, columns=['token', 'name', 'name_type', 'folded', 'hits']).to_csv(path, index=False)
+
+
 def write_to_shapefiles(multi_geometry, huc, shapefile_location):
     """
     Write all unsimplified geometries to shapefile with name as HUC
@@ -172,8 +272,20 @@ def create_resolutions_and_combine(full_df, out_dir, max_vertices):
                                                                    int(max_vertices)),
                                                           axis=1))
 
+    # Ready to emit GeoJSON, so the API does not reparse the flat strings
+    print("Precomputing GeoJSON...")
+    full_df['GeoJSON Convex Hull'] = full_df['Polygon Convex Hull'].apply(flat_to_geojson_polygon)
+    full_df['GeoJSON Visvalingam'] = full_df['Polygon Visvalingam'].apply(flat_to_geojson_polygon)
+    full_df['GeoJSON Bounding Box'] = full_df['Bounding Box'].apply(flat_bbox_to_geojson_polygon)
+
     full_df.drop(['Geo_Without_Multipolygons', 'len', 'Geometry'], inplace=True, axis=1)
 
+    print("Writing HUC index...")
+    write_huc_index(full_df, out_dir + 'HUC_Index.npz')
+
+    print("Writing name index...")
+    write_name_index(full_df, out_dir + 'Name_Index.csv')
+
     print("Writing to file.")
     full_df.to_csv(out_dir + 'HUC_Data.csv', index=False)
     print("Done!")
@@ -0,0 +1,76 @@
+"""
+==============
+name_index.py
+==============
+
+Token index over the river and HUC region names, read by the API's /search
+autocomplete. Names are folded (case and diacritics) and split into words,
+and every word of a name is one row, so that a prefix of any word is a
+range on the indexed token column. The SWORD load indexes the reach and
+node river names, the HUC load the region names.
+
+The folding must match fold_name in fts/api/controllers/name_search.py.
+"""
+
+import re
+import unicodedata
+
+# Table of the index
+NAME_INDEX_TABLE = 'name_index'
+# Longest token stored; the prefixes of longer words still match
+TOKEN_LENGTH = 64
+# River name SWORD gives reaches and nodes without a name
+NO_NAME = 'NODATA'
+
+
+def fold_name(name):
+    """
+    Fold a name for searching: lower case, without diacritics, and with
+    punctuation turned into single spaces.
+
+    Parameters
+    ----------
+    name : str
+        The name
+
+    Returns
+    -------
+    str
+        The folded words, separated by spaces
+    """
+    decomposed = unicodedata.normalize('NFKD', name)
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(re.findall(r'[^\W_]+', stripped.casefold()))
+
+
+def name_index_rows(counts, name_type):
+    """
+    Build the index rows of a set of names.
+
+    Parameters
+    ----------
+    counts : iterable
+        (name, hits) pairs, hits being the number of features with the name
+    name_type : str
+        'reach', 'node' or 'region'
+
+    Returns
+    -------
+    list
+        One dict per distinct word of each name, with the token, name,
+        name_type, folded name and hits
+    """
+    rows = []
+    for name, hits in counts:
+        if not name or name == NO_NAME:
+            continue
+        folded = fold_name(name)
+        for token in dict.fromkeys(folded.split()):
+            rows.append({
+                'token': token[:TOKEN_LENGTH],
+                'name': name,
+                'name_type': name_type,
+                'folded': folded,
+                'hits': int(hits),
+            })
+    return rows
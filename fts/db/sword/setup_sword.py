@@ -11,22 +11,26 @@ Test calls to setup_sword.py
 import logging
 import io
 import os
+import uuid
+from datetime import datetime, timezone
 from os import walk
 from pathlib import Path
 import json
 import boto3
+import geojson
 import pandas as pd
 from sqlalchemy.exc import OperationalError, NoSuchTableError
 from sqlalchemy import \
     create_engine, MetaData, Table, Text, Integer, \
-    Float, select
+    Float, select, Column, Index, String
 from sqlalchemy.sql import text as text_query
-from sqlalchemy.dialects.mysql import VARCHAR
+from sqlalchemy.dialects.mysql import MEDIUMTEXT, VARCHAR
 from tqdm import tqdm
 import fiona
 import shapely.wkt
 import shapely.geometry
 import geopandas
+from fts.db.name_index import NAME_INDEX_TABLE, TOKEN_LENGTH, name_index_rows
 
 DB_HOST = os.environ['DB_HOST']
 DB_NAME = os.environ['DB_NAME']
@@ -44,6 +48,20 @@ NETCDF_FS = [
     "af_apriori_rivers"
 ]
 
+# Column holding each row rendered as its API result
+JSON_FRAGMENT_COLUMN = 'json_fragment'
+JSON_FRAGMENT_TYPE = Text().with_variant(MEDIUMTEXT(), 'mysql')
+# Significant digits MySQL returns the values of FLOAT columns with
+FLOAT_DIGITS = 6
+# Native geometry column with a SPATIAL index, and its type per table
+SPATIAL_COLUMN = 'geom'
+SPATIAL_TYPES = {'reaches': 'GEOMETRY', 'nodes': 'POINT'}
+# Indexed BIGINT copy of each table's id, which the API reads id prefix
+# searches from as ranges
+ID_NUMBER_COLUMNS = {'reaches': ('reach_id', 'reach_num'), 'nodes': ('node_id', 'node_num')}
+# Tables whose river names go into the name search index, and their name type
+NAME_INDEX_TYPES = {'reaches': 'reach', 'nodes': 'node'}
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -119,6 +137,47 @@ def insert_into_db(data_frame, tbl_name, engine, datatype):
     insert_with_progress(data_frame, tbl_name, engine, datatype)
 
 
+def render_json_fragments(data_frame, sqla_types):
+    """
+    Render each row as the JSON object the API returns for it, so pages of
+    results are written out without parsing and re-serializing the rows.
+    Values are rendered the way the API reads them back: FLOAT columns to
+    6 significant digits, missing values as null, and geojson as an object
+    with the coordinates rounded by geojson.loads.
+
+    Parameters
+    ----------
+    data_frame : pandas.DataFrame
+        Rows with the columns being loaded
+    sqla_types : dict
+        SQLAlchemy types of the columns
+
+    Returns
+    -------
+    list
+        The JSON text of each row
+    """
+    float_columns = {column for column, sqla_type in sqla_types.items() if sqla_type is Float}
+
+    def render_value(column, value):
+        if hasattr(value, 'item'):
+            value = value.item()
+        if value is None or pd.isna(value):
+            return None
+        if column == 'geojson':
+            return geojson.loads(value)
+        if column in float_columns:
+            return float(f"{value:.{FLOAT_DIGITS}g}")
+        if isinstance(value, bool):
+            return int(value)
+        return value
+
+    return [
+        json.dumps({column: render_value(column, value) for column, value in record.items()})
+        for record in data_frame.to_dict('records')
+    ]
+
+
 def drop_reach_table(sqla_engine):
     """
     Drop reach table
@@ -357,6 +416,8 @@ def load_reaches(engine, sword_shp_path):
             ]
 
             reach_sqla_types_dict = dict(zip(reach_headers, reach_sqla_types))
+            dframe[JSON_FRAGMENT_COLUMN] = render_json_fragments(dframe, reach_sqla_types_dict)
+            reach_sqla_types_dict[JSON_FRAGMENT_COLUMN] = JSON_FRAGMENT_TYPE
             logger.info("Current reach file: %s", reach_shpfile)
             reach_table_name = 'reaches'
             insert_into_db(
@@ -470,6 +531,8 @@ def load_nodes(engine, sword_shp_path):
             ]
 
             node_sqla_types_dict = dict(zip(node_headers, node_sqla_types))
+            gdf[JSON_FRAGMENT_COLUMN] = render_json_fragments(gdf, node_sqla_types_dict)
+            node_sqla_types_dict[JSON_FRAGMENT_COLUMN] = JSON_FRAGMENT_TYPE
             logger.info("Current node file: %s", node_shpfile)
             insert_into_db(
                 gdf, node_table_name, engine, node_sqla_types_dict
@@ -636,13 +699,157 @@ def table_index(engine):
     tbl_rvrname_node_index = text_query(
         "CREATE INDEX river_name_idx ON nodes (river_name(300)) USING BTREE"
     )
+    # Joins the nodes of the reaches found by river name
+    tbl_node_reach_index = text_query(
+        "CREATE INDEX node_reach_id_idx ON nodes(reach_id) USING BTREE"
+    )
     try:
         conn.execute(tbl_node_index)
         conn.execute(tbl_rvrname_node_index)
+        conn.execute(tbl_node_reach_index)
     except NoSuchTableError:
         logger.info("No table available")
 
 
+def table_spatial_index(engine):
+    """
+    Add a native geometry column, built from the WKT geometry of each row,
+    with a SPATIAL index for the API's bbox and polygon queries. Coordinates
+    stay lon/lat in SRID 0, where MBRIntersects compares them as planar
+    values. The column is NOT NULL with a fixed SRID, which MySQL requires
+    to use the index.
+
+    Parameters:
+    SQLAlchemy Engine
+    """
+    if engine.dialect.name != 'mysql':
+        logger.info("Spatial indexes need MySQL, skipping")
+        return
+
+    logger.info("Spatial indexing tables")
+    for table, geom_type in SPATIAL_TYPES.items():
+        with engine.begin() as conn:
+            conn.execute(text_query(
+                f"ALTER TABLE {table} ADD COLUMN {SPATIAL_COLUMN} {geom_type} SRID 0"
+            ))
+            conn.execute(text_query(
+                f"UPDATE {table} SET {SPATIAL_COLUMN} = ST_GeomFromText(geometry, 0)"
+            ))
+            conn.execute(text_query(
+                f"ALTER TABLE {table} MODIFY {SPATIAL_COLUMN} {geom_type} NOT NULL SRID 0, "
+                f"ADD SPATIAL INDEX {table}_geom_idx ({SPATIAL_COLUMN})"
+            ))
+
+
+def name_index_table(metadata):
+    """
+    Define the name search index table, which the HUC load also writes to
+    (see fts/db/huc/DBuserData.sh).
+
+    Parameters:
+    metadata: SQLAlchemy MetaData
+
+    Returns:
+    SQLAlchemy Table
+    """
+    return Table(
+        NAME_INDEX_TABLE, metadata,
+        Column('token', String(TOKEN_LENGTH), nullable=False),
+        Column('name', Text, nullable=False),
+        Column('name_type', String(16), nullable=False),
+        Column('folded', Text, nullable=False),
+        Column('hits', Integer, nullable=False),
+        Index('name_index_token_idx', 'token', 'name_type'),
+    )
+
+
+def load_name_index(engine):
+    """
+    Index the river names of the reaches and nodes for the API's name
+    search, replacing the reach and node rows of a previous load.
+
+    Parameters:
+    SQLAlchemy Engine
+
+    Returns:
+    int: number of index rows written
+    """
+    logger.info("Indexing river names")
+    table = name_index_table(MetaData())
+    table.create(engine, checkfirst=True)
+    written = 0
+    with engine.begin() as conn:
+        conn.execute(table.delete().where(table.c.name_type.in_(list(NAME_INDEX_TYPES.values()))))
+        for source, name_type in NAME_INDEX_TYPES.items():
+            counts = conn.execute(text_query(
+                f"SELECT river_name, COUNT(*) FROM {source} GROUP BY river_name"
+            )).all()
+            rows = name_index_rows(counts, name_type)
+            if rows:
+                conn.execute(table.insert(), rows)
+            written += len(rows)
+    return written
+
+
+def table_id_numbers(engine):
+    """
+    Add a BIGINT copy of the reach and node ids with its own index. The ids
+    are fixed width digit codes, so an id prefix is a range of numbers,
+    which the API reads with integer comparisons on a smaller index.
+
+    Parameters:
+    SQLAlchemy Engine
+    """
+    if engine.dialect.name != 'mysql':
+        logger.info("ID number columns need MySQL, skipping")
+        return
+
+    logger.info("Adding ID number columns")
+    for table, (id_column, number_column) in ID_NUMBER_COLUMNS.items():
+        with engine.begin() as conn:
+            conn.execute(text_query(
+                f"ALTER TABLE {table} ADD COLUMN {number_column} BIGINT UNSIGNED"
+            ))
+            conn.execute(text_query(
+                f"UPDATE {table} SET {number_column} = CAST({id_column} AS UNSIGNED)"
+            ))
+            conn.execute(text_query(
+                f"ALTER TABLE {table} MODIFY {number_column} BIGINT UNSIGNED NOT NULL, "
+                f"ADD INDEX {number_column}_idx ({number_column}) USING BTREE"
+            ))
+
+
+def stamp_dataset_version(engine, dataset):
+    """
+    Record a new version of a dataset in the metadata table. The API drops
+    its cached responses when the version changes.
+
+    Parameters:
+    SQLAlchemy Engine
+    dataset: str
+        'sword' or 'huc'
+
+    Returns:
+    str: the new version
+    """
+    version = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ') + '-' + uuid.uuid4().hex[:8]
+    logger.info("Stamping %s dataset version %s", dataset, version)
+    with engine.begin() as conn:
+        conn.execute(text_query(
+            "CREATE TABLE IF NOT EXISTS fts_metadata ("
+            "dataset VARCHAR(32) NOT NULL PRIMARY KEY, "
+            "version VARCHAR(64) NOT NULL, "
+            "updated_at VARCHAR(32) NOT NULL)"
+        ))
+        conn.execute(
+            text_query("REPLACE INTO fts_metadata (dataset, version, updated_at) "
+                       "VALUES (:dataset, :version, :updated_at)"),
+            {"dataset": dataset, "version": version,
+             "updated_at": datetime.now(timezone.utc).isoformat()}
+        )
+    return version
+
+
 def main():
     """
     Entry point to load sword db.
@@ -662,6 +869,10 @@ def main():
     load_nodes(engine, local_sword_path)
     load_reaches(engine, local_sword_path)
     table_index(engine)
+    table_spatial_index(engine)
+    table_id_numbers(engine)
+    load_name_index(engine)
+    stamp_dataset_version(engine, 'sword')
 
     # check RDS tables
     table_row_count(engine)
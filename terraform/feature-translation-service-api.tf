@@ -140,6 +140,9 @@ resource "aws_lambda_function" "fts_api_lambdav1" {
       DB_NAME              = aws_ssm_parameter.fts-db-name.value
       DB_USERNAME          = aws_ssm_parameter.fts-db-user.value
       DB_PASSWORD_SSM_NAME = aws_ssm_parameter.fts-db-user-pass.name
+      HUC_INDEX_PATH       = var.huc_index_path
+      DB_BACKEND           = var.db_backend
+      SNAPSHOT_PATH        = var.snapshot_path
     }
   }
 
@@ -171,6 +174,9 @@ resource "aws_api_gateway_rest_api" "fts-api-gateway" {
   parameters = {
     "basemap" = "split"
   }
+  # The Lambda integrations return JSON which API Gateway gzips or deflates
+  # for clients that accept it, as the Lambda itself can only for proxy events
+  minimum_compression_size = 32768
   endpoint_configuration {
     types = ["PRIVATE"]
   }
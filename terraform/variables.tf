@@ -27,6 +27,24 @@ variable "docker_db_tag" {
   default = "poodaac-cloud/podaac-ftsdb-sword:latest"
 }
 
+variable "huc_index_path" {
+  description = "Local path or s3:// URL of the HUC_Index.npz written by the HUC build; empty disables /v1/huc lookups"
+  type        = string
+  default     = ""
+}
+
+variable "db_backend" {
+  description = "mysql to serve the API from RDS, snapshot to serve it from the SQLite file at snapshot_path"
+  type        = string
+  default     = "mysql"
+}
+
+variable "snapshot_path" {
+  description = "Local path (e.g. in a Lambda layer under /opt) or s3:// URL of the snapshot written by fts/db/build_snapshot.py"
+  type        = string
+  default     = ""
+}
+
 variable "lambda_package" {
   type = string
 }
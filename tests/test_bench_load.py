@@ -0,0 +1,34 @@
+"""
+==============
+test_bench_load.py
+==============
+
+Test the synthetic data generator and load benchmark on a small dataset
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_bench_load(tmp_path):
+    """
+    A small synthetic snapshot answers every kind of request of the load
+    mix without errors
+    """
+    snapshot = str(tmp_path / 'bench.sqlite')
+    subprocess.run([sys.executable, '-m', 'benchmarks.synthetic_data', '--output', snapshot, '--basins', '3',
+                    '--reaches-per-basin', '5', '--nodes-per-reach', '4', '--huc-children', '2'],
+                   cwd=ROOT, capture_output=True, text=True, check=True)
+    result = subprocess.run([sys.executable, '-m', 'benchmarks.bench_load', '--snapshot', snapshot,
+                             '--requests', '60', '--concurrency', '2', '--json'],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    report = json.loads(result.stdout)
+
+    assert report['all']['requests'] == 60
+    assert report['all']['errors'] == 0
+    assert report['all']['rows_s'] > 0
+    assert set(report) == {'all', 'huc', 'huc_exact', 'region', 'reach', 'node', 'river'}
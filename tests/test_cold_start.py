@@ -0,0 +1,23 @@
+"""
+==============
+test_cold_start.py
+==============
+
+Test the cold start budget of the API Lambda
+"""
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_cold_start_budget():
+    """
+    The controller imports within the budget, without boto3 or the other
+    modules it only needs on first use, and without calling SSM
+    """
+    result = subprocess.run([sys.executable, '-m', 'benchmarks.bench_cold_start', '--repeat', '3'],
+                            cwd=ROOT, capture_output=True, text=True, check=False)
+    assert result.returncode == 0, result.stdout + result.stderr
@@ -0,0 +1,172 @@
+"""
+==============
+test_compression.py
+==============
+
+Test the Accept-Encoding negotiation and compression of API responses
+"""
+
+import base64
+import gzip
+import json
+import os
+import zlib
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from fts.api.controllers.compression import accepted_encoding, compress, compression_level
+from fts.api.controllers.db_connection import ConnectionManager
+from fts.api.controllers.result_cache import DatasetVersion, ResultCache
+
+
+@pytest.fixture(scope='function', autouse=True)
+def db_environs():
+    """Make sure no real values are in the database env vars"""
+    os.environ['DB_HOST'] = "foo"
+    os.environ['DB_NAME'] = "foo"
+    os.environ['DB_USERNAME'] = "foo"
+    os.environ['DB_PASSWORD'] = "foo"
+
+
+def test_accepted_encoding():
+    """
+    The best accepted encoding is picked by q value, brotli only when it is installed
+    """
+    assert accepted_encoding(None) is None
+    assert accepted_encoding({'Accept-Encoding': ''}) is None
+    assert accepted_encoding({'accept-encoding': 'gzip, deflate'}) == 'gzip'
+    assert accepted_encoding({'Accept-Encoding': 'gzip;q=0'}) is None
+    assert accepted_encoding({'Accept-Encoding': 'identity, *;q=0.5'}) == 'gzip'
+
+    fake_brotli = MagicMock()
+    fake_brotli.compress.side_effect = lambda body, quality: zlib.compress(body, quality)
+    with patch('fts.api.controllers.compression.brotli_module', return_value=fake_brotli):
+        assert accepted_encoding({'Accept-Encoding': 'gzip, deflate, br'}) == 'br'
+        assert accepted_encoding({'Accept-Encoding': 'br;q=0.5, gzip'}) == 'gzip'
+        assert zlib.decompress(compress(b'{}' * 100, 'br')) == b'{}' * 100
+        assert fake_brotli.compress.call_args.kwargs['quality'] == 8
+
+    with patch('fts.api.controllers.compression.brotli_module', return_value=None):
+        assert accepted_encoding({'Accept-Encoding': 'br'}) is None
+
+
+def test_compression_level():
+    """
+    Larger bodies get faster levels
+    """
+    assert compression_level('gzip', 10_000) == 6
+    assert compression_level('gzip', 1_000_000) == 4
+    assert compression_level('gzip', 8_000_000) == 1
+    assert compression_level('br', 8_000_000) == 3
+
+
+@patch('pymysql.connect')
+def test_lambda_handler_compression(mock_connect):
+    """
+    Large responses are gzipped for clients accepting gzip, small ones are
+    sent as they are
+    """
+    import fts.api.controllers.fts_controller as controller
+    controller.dataset_version = DatasetVersion(check_interval=60)
+
+    polygon = ','.join(str(i) for i in range(2000))
+    huc_row = ['1804', 'San Joaquin', polygon, polygon, '1,2,3,4']
+    cur = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    cur.fetchall.side_effect = lambda: ([('huc', '1')] if 'fts_metadata' in cur.execute.call_args.args[0]
+                                        else [(1,)] if 'COUNT(*)' in cur.execute.call_args.args[0] else [huc_row])
+
+    def request(headers=None):
+        event = {'body': {'HUC': '1804', 'exact': 'true', 'polygon_format': ''}}
+        if headers is not None:
+            event['headers'] = headers
+        with patch.object(controller, 'result_cache', ResultCache(max_entries=0, ttl=60, max_bytes=1 << 20)), \
+                patch.object(controller, 'connections', ConnectionManager('foo', 'foo', 'foo', 'foo')), \
+                patch.object(controller, 'METRICS_ENABLED', False):
+            return controller.lambda_handler(event, None)
+
+    plain = json.loads(request())
+
+    with patch.object(controller, 'COMPRESSION_MIN_BYTES', 100):
+        compressed = request({'Accept-Encoding': 'gzip, deflate'})
+    assert compressed['statusCode'] == 200
+    assert compressed['isBase64Encoded'] is True
+    assert compressed['headers']['Content-Encoding'] == 'gzip'
+    body = json.loads(gzip.decompress(base64.b64decode(compressed['body'])))
+    assert body['results'] == plain['results']
+    assert len(compressed['body']) < len(json.dumps(plain)) / 2
+
+    with patch.object(controller, 'COMPRESSION_MIN_BYTES', 1 << 20):
+        small = request({'Accept-Encoding': 'gzip'})
+    assert small['statusCode'] == 200
+    assert 'Content-Encoding' not in small['headers']
+    assert json.loads(small['body'])['results'] == plain['results']
+
+
+def proxy_event(resource, path=None, query=None, body=None, headers=None):
+    """A REST API proxy integration event"""
+    return {'resource': resource, 'httpMethod': 'POST' if body else 'GET', 'headers': headers,
+            'pathParameters': path, 'queryStringParameters': query, 'body': body, 'isBase64Encoded': False,
+            'requestContext': {'stage': 'v1'}}
+
+
+def test_proxy_request():
+    """
+    Proxy events get the request parameters the REST API request templates pass
+    """
+    from fts.api.controllers.fts_controller import proxy_request
+
+    event = proxy_request(proxy_event('/v1/huc/{huc}', {'huc': '1804'}, {'exact': 'true'}))
+    assert event == {'body': {'HUC': '1804', 'exact': 'true', 'river_name': ''}, 'headers': {}}
+
+    event = proxy_request(proxy_event('/v1/rivers/reach', query={'bbox': '0,0,1,1', 'spatial': 'huc'}))
+    assert event['body']['spatial'] == 'reach'
+
+    body = base64.b64encode(json.dumps({'ids': ['1804']}).encode()).decode()
+    event = proxy_event('/v1/batch/huc', query={'fields': 'HUC'}, body=body)
+    event['isBase64Encoded'] = True
+    assert proxy_request(event)['body'] == {'batch': 'HUC', 'ids': ['1804'], 'fields': 'HUC', 'river_name': ''}
+
+    function_url_event = {'rawPath': '/v1/rivers/reach/7651250001', 'routeKey': '$default', 'body': None,
+                          'queryStringParameters': {'river_name': 'Rio Grande'}, 'headers': {}}
+    assert proxy_request(function_url_event)['body'] == {'reach': '7651250001', 'river_name': 'Rio Grande'}
+
+    template_event = {'body': {'HUC': '1804'}}
+    assert proxy_request(template_event) is template_event
+
+
+@patch('pymysql.connect')
+def test_lambda_handler_proxy_event(mock_connect):
+    """
+    Proxy events are answered with proxy responses, request errors included
+    """
+    import fts.api.controllers.fts_controller as controller
+    controller.dataset_version = DatasetVersion(check_interval=60)
+
+    rows = []
+    cur = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    cur.fetchall.side_effect = lambda: ([('huc', '1')] if 'fts_metadata' in cur.execute.call_args.args[0]
+                                        else [(len(rows),)] if 'COUNT(*)' in cur.execute.call_args.args[0] else rows)
+
+    def request(event):
+        with patch.object(controller, 'result_cache', ResultCache(max_entries=0, ttl=60, max_bytes=1 << 20)), \
+                patch.object(controller, 'connections', ConnectionManager('foo', 'foo', 'foo', 'foo')), \
+                patch.object(controller, 'METRICS_ENABLED', False):
+            return controller.lambda_handler(event, None)
+
+    event = proxy_event('/v1/huc/{huc}', {'huc': '1804'}, {'exact': 'true'}, headers={'Accept': '*/*'})
+    missing = request(event)
+    assert missing['statusCode'] == 404
+    assert missing['headers'] == {'Content-Type': 'application/json'}
+    assert json.loads(missing['body'])['error'].startswith('404: Results with the specified HUC 1804')
+
+    rows.append(['1804', 'San Joaquin', '1,2,3,4,5,6', '1,2,3,4,5,6', '1,2,3,4'])
+    found = request(event)
+    assert found['statusCode'] == 200
+    assert 'ETag' in found['headers']
+    body = json.loads(found['body'])
+    assert body['results'][0]['HUC'] == '1804'
+    assert 'etag' not in body
+
+    invalid = request(proxy_event('/v1/huc/{huc}', {'huc': '1804'}, {'page_size': 'ten'}))
+    assert invalid['statusCode'] == 400
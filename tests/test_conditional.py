@@ -0,0 +1,120 @@
+"""
+==============
+test_conditional.py
+==============
+
+Test the ETag, If-None-Match and Cache-Control handling of API responses
+"""
+
+import json
+import os
+from unittest.mock import patch
+
+import pytest
+
+from fts.api.controllers.conditional import cache_control, etag_matches, if_none_match, response_etag
+from fts.api.controllers.db_connection import ConnectionManager
+from fts.api.controllers.result_cache import DatasetVersion, ResultCache, normalize_request
+
+
+@pytest.fixture(scope='function', autouse=True)
+def db_environs():
+    """Make sure no real values are in the database env vars"""
+    os.environ['DB_HOST'] = "foo"
+    os.environ['DB_NAME'] = "foo"
+    os.environ['DB_USERNAME'] = "foo"
+    os.environ['DB_PASSWORD'] = "foo"
+
+
+def test_response_etag():
+    """
+    Requests with the same result share an ETag, which changes with the dataset version
+    """
+    key = normalize_request({'HUC': '1804', 'exact': 'TRUE', 'debug_timing': 'true'})
+    etag = response_etag('huc=1', key)
+    assert etag.startswith('W/"') and etag.endswith('"')
+    assert etag == response_etag('huc=1', normalize_request({'HUC': '1804', 'exact': 'true', 'if_none_match': etag}))
+    assert etag != response_etag('huc=2', key)
+    assert etag != response_etag('huc=1', normalize_request({'HUC': '1804'}))
+
+
+def test_if_none_match():
+    """
+    If-None-Match is read from the headers in any case, or the request parameter
+    """
+    assert if_none_match({'body': {}}) == ''
+    assert if_none_match({'body': {'if_none_match': ' "a" '}}) == '"a"'
+    assert if_none_match({'headers': {'if-none-match': '"b"'}, 'body': {'if_none_match': '"a"'}}) == '"b"'
+
+    assert etag_matches('"a"', '"a"')
+    assert etag_matches('"b", W/"a"', '"a"')
+    assert etag_matches('"a"', 'W/"a"')
+    assert etag_matches('"b", W/"a"', 'W/"a"')
+    assert etag_matches('*', '"a"')
+    assert not etag_matches('"b"', '"a"')
+
+    assert cache_control(300) == 'public, max-age=300'
+    assert cache_control(0) == 'no-cache'
+
+
+@patch('pymysql.connect')
+def test_lambda_handler_not_modified(mock_connect):
+    """
+    Responses carry an ETag, and requests sending it back are answered 304
+    without a query until the dataset version changes
+    """
+    import fts.api.controllers.fts_controller as controller
+    from fts.api.controllers.fts_controller import RequestError
+
+    versions = [[('huc', '1')]]
+    huc_row = ['1804', 'San Joaquin', '1,2,3,4,5,6', '1,2,3,4,5,6', '1,2,3,4']
+    cur = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    cur.fetchall.side_effect = lambda: (versions[0] if 'fts_metadata' in cur.execute.call_args.args[0]
+                                        else [(1,)] if 'COUNT(*)' in cur.execute.call_args.args[0] else [huc_row])
+    controller.dataset_version = DatasetVersion(check_interval=60)
+
+    def request(headers=None, proxy=None, **params):
+        event = proxy or {'body': {'HUC': '1804', 'exact': 'true', 'polygon_format': '', **params}}
+        if headers is not None:
+            event['headers'] = headers
+        with patch.object(controller, 'result_cache', ResultCache(max_entries=0, ttl=60, max_bytes=1 << 20)), \
+                patch.object(controller, 'connections', ConnectionManager('foo', 'foo', 'foo', 'foo')), \
+                patch.object(controller, 'METRICS_ENABLED', False):
+            return controller.lambda_handler(event, None)
+
+    body = request()
+    response = json.loads(body)
+    etag = response['etag']
+    assert etag.startswith('W/"')
+    # The REST API response templates cut the validators off the body
+    assert json.loads(body[:body.rindex(b', "etag": ')] + b'}') == {
+        key: value for key, value in response.items() if key not in ('etag', 'cache_control')}
+    assert response['cache_control'] == f'public, max-age={controller.CACHE_MAX_AGE}'
+    assert response['results'][0]['HUC'] == '1804'
+
+    queries = cur.execute.call_count
+    with pytest.raises(RequestError, match=f'^304: Not Modified {etag}$'):
+        request(if_none_match=etag)
+    proxied = request({'If-None-Match': etag})
+    assert proxied == {'statusCode': 304, 'headers': {'ETag': etag, 'Cache-Control': response['cache_control']},
+                       'body': ''}
+    assert cur.execute.call_count == queries
+
+    # A real proxy integration event, with the parameters in the path and query string
+    proxied = request(proxy={'resource': '/v1/huc/{huc}', 'pathParameters': {'huc': '1804'}, 'body': None,
+                             'queryStringParameters': {'exact': 'true'}, 'headers': {'if-none-match': etag}})
+    assert proxied['statusCode'] == 304 and proxied['headers']['ETag'] == etag
+
+    proxied = request({'If-None-Match': '"other"'})
+    assert proxied['statusCode'] == 200 and proxied['headers']['ETag'] == etag
+    assert json.loads(proxied['body'])['results'] == response['results']
+
+    # A reload stamps a new version, read once the check interval is over
+    versions[0] = [('huc', '2')]
+    controller.dataset_version.check_interval = 0
+    response = json.loads(request(if_none_match=etag))
+    assert response['etag'] != etag
+
+    # No validators before a loader stamps a version
+    versions[0] = []
+    assert 'etag' not in json.loads(request(if_none_match=etag))
@@ -0,0 +1,163 @@
+"""
+==============
+test_db_connection.py
+==============
+
+Test the API's MySQL connection manager
+"""
+
+from unittest.mock import MagicMock, patch
+
+import pymysql
+import pytest
+
+from fts.api.controllers.db_connection import ConnectionBudgetExceeded, ConnectionManager, SSMSecret
+
+
+def make_manager(**kwargs):
+    """Connection manager with retries that do not sleep"""
+    kwargs.setdefault('backoff_base', 0)
+    return ConnectionManager('host', 'user', 'pass', 'db', **kwargs)
+
+
+@patch('pymysql.connect')
+def test_connects_lazily(mock_connect):
+    """
+    No connection is opened until one is acquired, and it is reused after
+    """
+    manager = make_manager()
+    assert not mock_connect.called
+
+    with manager.connection() as first:
+        pass
+    with manager.connection() as second:
+        pass
+
+    assert first is second
+    assert mock_connect.call_count == 1
+    assert manager.stats()['connects'] == 1
+    assert manager.stats()['open_connections'] == 1
+
+
+@patch('pymysql.connect')
+def test_reconnects_when_ping_fails(mock_connect):
+    """
+    An idle connection which fails its ping is replaced
+    """
+    stale = MagicMock()
+    stale.ping.side_effect = pymysql.OperationalError(2006, 'MySQL server has gone away')
+    fresh = MagicMock()
+    mock_connect.side_effect = [stale, fresh]
+
+    manager = make_manager(ping_interval=0)
+    with manager.connection():
+        pass
+    with manager.connection() as conn:
+        assert conn is fresh
+
+    stats = manager.stats()
+    assert stats['reconnects'] == 1
+    assert stats['pings'] == 1
+    assert stats['open_connections'] == 1
+    assert stale.close.called
+
+
+@patch('pymysql.connect')
+def test_connect_retries_with_backoff(mock_connect):
+    """
+    Connect failures are retried up to max_retries before giving up
+    """
+    mock_connect.side_effect = [pymysql.OperationalError(2003, "Can't connect"), MagicMock()]
+    manager = make_manager(max_retries=1)
+    with manager.connection():
+        pass
+    assert manager.stats()['connect_failures'] == 1
+
+    mock_connect.side_effect = pymysql.OperationalError(2003, "Can't connect")
+    manager = make_manager(max_retries=2)
+    with pytest.raises(pymysql.OperationalError):
+        manager.acquire()
+    assert manager.stats()['connect_failures'] == 3
+    assert manager.stats()['open_connections'] == 0
+
+
+@patch('pymysql.connect')
+def test_connection_budget(mock_connect):
+    """
+    No more than max_connections are opened at once, and a broken connection
+    frees its slot
+    """
+    manager = make_manager(max_connections=1, acquire_timeout=0.01)
+    conn = manager.acquire()
+
+    with pytest.raises(ConnectionBudgetExceeded):
+        manager.acquire()
+
+    manager.release(conn, broken=True)
+    assert manager.stats()['open_connections'] == 0
+    manager.release(manager.acquire())
+    assert mock_connect.call_count == 2
+
+
+def test_iam_auth_requires_ssl_ca():
+    """
+    IAM auth tokens must only be sent over TLS
+    """
+    with pytest.raises(ValueError):
+        make_manager(iam_auth=True)
+
+
+@patch('pymysql.connect')
+@patch('boto3.client')
+def test_ssm_secret(mock_client, mock_connect):
+    """
+    The SSM password is read on the first connect, cached, and read again
+    after MySQL rejects it
+    """
+    mock_client.return_value.get_parameter.side_effect = [
+        {'Parameter': {'Value': 'old'}}, {'Parameter': {'Value': 'new'}}]
+    mock_connect.side_effect = [MagicMock(), pymysql.OperationalError(1045, 'Access denied'), MagicMock()]
+    secret = SSMSecret('fts-user-pass')
+    manager = ConnectionManager('host', 'user', secret, 'db', backoff_base=0, max_connections=2)
+    assert not mock_client.called
+
+    first = manager.acquire()
+    manager.acquire()
+
+    passwords = [call.kwargs['password'] for call in mock_connect.call_args_list]
+    assert passwords == ['old', 'old', 'new']
+    assert mock_client.return_value.get_parameter.call_count == 2
+    manager.release(first)
+
+    mock_client.return_value.get_parameter.side_effect = Exception('no SSM')
+    fallback = SSMSecret('fts-user-pass', fallback='env')
+    assert fallback() == 'env'
+    with pytest.raises(Exception):
+        SSMSecret('fts-user-pass')()
+
+
+@patch('pymysql.connect')
+def test_submit(mock_connect):
+    """
+    Submitted queries run on a second connection, and are refused without
+    waiting when no connection is free
+    """
+    first, second = MagicMock(), MagicMock()
+    mock_connect.side_effect = [first, second]
+    second.cursor.return_value.__enter__.return_value.fetchone.return_value = (42,)
+
+    assert make_manager().submit(lambda cur: cur.fetchone()) is None
+
+    manager = make_manager(max_connections=2, acquire_timeout=5)
+    with manager.connection() as conn:
+        assert conn is first
+        future = manager.submit(lambda cur: cur.fetchone())
+        assert future.result() == (42,)
+
+        with manager.connection():
+            assert manager.submit(lambda cur: cur.fetchone()) is None
+
+    stats = manager.stats()
+    assert stats['connects'] == 2
+    assert stats['budget_waits'] == 0
+    assert stats['open_connections'] == 2
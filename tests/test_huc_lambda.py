@@ -1,3 +1,4 @@
+import json
 import os
 from unittest.mock import patch
 
@@ -103,6 +104,41 @@ def test_return_geojson_huc(db_environs):
     assert visvalingam_geojson[0] == visvalingam_geojson[-1]
 
 
+@patch('pymysql.connect')
+def test_return_precomputed_geojson_huc(db_environs):
+    """
+    GeoJSON precomputed by the HUC build gives the same feature
+    collection as GeoJSON built from the flat polygons.
+    """
+    import json
+
+    from fts.db.huc.simplify_huc import flat_bbox_to_geojson_polygon, flat_to_geojson_polygon
+    import fts.api.controllers.fts_controller as huc_controller
+    from fts.api.controllers.json_fragments import serialize_response
+
+    class MockConn:
+        def __init__(self, results):
+            self.results = results
+
+        def fetchall(self): return self.results
+
+    flat_row = [huc, name, convex_hull, visvalingam, bbox]
+    precomputed_row = [huc, name, flat_to_geojson_polygon(convex_hull),
+                       flat_to_geojson_polygon(visvalingam), flat_bbox_to_geojson_polygon(bbox)]
+
+    from_flat = huc_controller.return_json(MockConn([flat_row]), 'HUC', huc, True, 'geojson', 0, 1, 1, 100)
+    precomputed = huc_controller.return_json(MockConn([precomputed_row]), 'HUC', huc, True, 'geojson', 0, 1, 1, 100)
+
+    # The stored text is spliced into the response without being parsed
+    with patch('json.loads') as loads:
+        body = serialize_response(precomputed)
+    assert not loads.called
+    assert flat_to_geojson_polygon(visvalingam) in body
+    assert json.loads(body) == json.loads(serialize_response(from_flat))
+    assert 'COALESCE(`GeoJSON Convex Hull`, `Polygon Convex Hull`)' in huc_controller.huc_columns('geojson')
+    assert huc_controller.huc_columns('') == "`HUC`, `Region`, `Polygon Convex Hull`, `Polygon Visvalingam`, `Bounding Box`"
+
+
 @patch('pymysql.connect')
 def test_return_json_empty(db_environs):
     """
@@ -291,3 +327,157 @@ def test_missing_polygon_format(db_environs):
     assert response_json_empty['search on'].pop('polygon_format') == empty_polygon_format
 
     assert response_json_flat == response_json_none == response_json_empty
+
+
+@patch('pymysql.connect')
+def test_huc_fields(db_environs):
+    """
+    fields= returns only the requested polygons, and include_geometry=false none
+    """
+    import fts.api.controllers.fts_controller as huc_controller
+
+    class MockConn:
+        def __init__(self, results):
+            self.results = results
+
+        def fetchall(self): return self.results
+
+    assert huc_controller.huc_columns('', ('bbox',)) == "`HUC`, `Region`, `Bounding Box`"
+
+    response = huc_controller.return_json(MockConn([[huc, name, bbox]]), 'HUC', huc, True, 'geojson', 0, 1, 1, 100,
+                                          polygons=('bbox',))
+    features = response['results'][0]['geojson']['features']
+    assert [feature['properties']['type'] for feature in features] == ['bbox']
+
+    response = huc_controller.return_json(MockConn([[huc, name]]), 'HUC', huc, True, '', 0, 1, 1, 100, polygons=())
+    assert set(response['results'][0]) == {'Region Name', 'HUC', 'USGS Polygon'}
+
+
+@patch('pymysql.connect')
+def test_huc_level(db_environs):
+    """
+    Partial HUC queries read the (huc_level, HUC) index in order, and level=
+    narrows HUC and region queries to one level
+    """
+    import fts.api.controllers.fts_controller as huc_controller
+
+    class MockConn:
+        def __init__(self):
+            self.executed = []
+
+        def execute(self, query, args=None):
+            self.executed.append((query, args))
+
+        def fetchall(self):
+            if 'COUNT(*)' in self.executed[-1][0]:
+                return [[1]]
+            return [[huc, name, bbox]]
+
+    cur = MockConn()
+    response = huc_controller.handle_request({'body': {'HUC': huc, 'polygon_format': 'flat', 'fields': 'bbox'}}, cur)
+    count, page = cur.executed
+    assert count == ("select COUNT(*) from huc_table where `huc_level` IN (" + ", ".join(["%s"] * 13) + ") AND `HUC` LIKE %s",
+                     tuple(range(4, 17)) + ('1804%',))
+    assert page[0].endswith(" AND `HUC` LIKE %s ORDER BY `huc_level`, `HUC` LIMIT %s,%s")
+    assert page[1] == tuple(range(4, 17)) + ('1804%', 0, 100)
+    assert 'level' not in response['search on']
+
+    cur = MockConn()
+    response = huc_controller.handle_request({'body': {'HUC': huc, 'level': '8', 'fields': 'bbox'}}, cur)
+    assert cur.executed[0][1] == (8, '1804%')
+    assert "where `huc_level` = %s AND `HUC` LIKE %s ORDER BY" in cur.executed[1][0]
+    assert response['search on']['level'] == 8
+
+    cur = MockConn()
+    huc_controller.handle_request({'body': {'region': 'San%20Joaquin', 'level': '4', 'fields': 'bbox'}}, cur)
+    assert cur.executed[0] == ("select COUNT(*) from huc_table where `Region` LIKE %s AND `huc_level` = %s",
+                               ('San Joaquin%', 4))
+    assert cur.executed[1][1] == ('San Joaquin%', 4, 0, 100)
+
+    cur = MockConn()
+    huc_controller.handle_request({'body': {'region': name, 'exact': 'true', 'level': '4', 'fields': 'bbox'}}, cur)
+    assert cur.executed[0][0].endswith("where `Region` = %s AND `huc_level` = %s")
+
+    with pytest.raises(huc_controller.RequestError, match='400'):
+        huc_controller.handle_request({'body': {'HUC': huc, 'level': '17'}}, MockConn())
+
+
+@patch('pymysql.connect')
+def test_batch_huc(db_environs):
+    """
+    A batch HUC lookup returns the HUC results keyed by HUC, with null for
+    HUCs which do not exist
+    """
+    import fts.api.controllers.fts_controller as huc_controller
+
+    class MockConn:
+        def __init__(self):
+            self.executed = []
+
+        def execute(self, query, args=None):
+            self.executed.append((query, args))
+
+        def fetchall(self): return [[huc, name, bbox]]
+
+    cur = MockConn()
+    response = huc_controller.process_batch('HUC', [huc, '99'], cur, 0, 'flat', ('bbox',))
+
+    assert cur.executed[0][1] == (huc, '99')
+    assert 'FROM huc_table WHERE `HUC` IN (%s, %s)' in cur.executed[0][0]
+    assert response['results'][huc]['Bounding Box'] == bbox
+    assert response['results']['99'] is None
+    assert response['not_found'] == ['99']
+    assert response['hits'] == 1
+
+
+@patch('pymysql.connect')
+def test_huc_lookup(db_environs, tmp_path):
+    """
+    Points and polygons are looked up in the HUC index written by the HUC
+    build, without a database connection
+    """
+    import pandas as pd
+    import fts.api.controllers.fts_controller as huc_controller
+    from fts.api.controllers.huc_index import load_huc_index
+    from fts.db.huc.simplify_huc import write_huc_index
+
+    path = str(tmp_path / 'HUC_Index.npz')
+    write_huc_index(pd.DataFrame({
+        'HUC': ['18', '1804', '19'],
+        'Region': ['California Region', name, 'Alaska Region'],
+        'Polygon Visvalingam': ['-125,32,-114,32,-114,43,-125,43,-125,32',
+                                '-122,36,-118,36,-118,39,-122,39,-122,36',
+                                '-170,52,-130,52,-130,71,-170,71,-170,52'],
+    }), path)
+
+    def lookup(**params):
+        return json.loads(huc_controller.lambda_handler({'body': dict(params, lookup='huc')}, None))
+
+    load_huc_index.cache_clear()
+    with patch.object(huc_controller, 'HUC_INDEX_PATH', path):
+        response = lookup(point='-120,37.5', level='')
+        assert [result['HUC'] for result in response['results']] == ['18', '1804']
+        assert response['results'][1]['Region Name'] == name
+
+        response = lookup(point='-120,37.5', level='4')
+        assert [result['HUC'] for result in response['results']] == ['1804']
+
+        response = lookup(polygon='-150,36,-119,36,-119,60,-150,60')
+        assert [result['HUC'] for result in response['results']] == ['18', '19', '1804']
+
+        response = lookup(points=[[-120, 37.5], [0, 0]])
+        assert response['hits'] == 1
+        assert [result['HUC'] for result in response['results'][0]['results']] == ['18', '1804']
+        assert response['results'][1] == {'point': [0.0, 0.0], 'results': []}
+
+        with pytest.raises(huc_controller.RequestError, match='404'):
+            huc_controller.lambda_handler({'body': {'lookup': 'huc', 'point': '0,0'}}, None)
+        for body in ({'point': '0,0,1,1'}, {'point': '0,0', 'polygon': '0,0,1,0,1,1'}, {'points': [[0]]},
+                     {'points': 'x'}, {'point': '0,0', 'level': 'a'}):
+            with pytest.raises(huc_controller.RequestError, match='400'):
+                huc_controller.lambda_handler({'body': dict(body, lookup='huc')}, None)
+    load_huc_index.cache_clear()
+
+    with patch.object(huc_controller, 'HUC_INDEX_PATH', ''), \
+            pytest.raises(huc_controller.RequestError, match='^501: HUC lookup is not available'):
+        huc_controller.lambda_handler({'body': {'lookup': 'huc', 'point': '0,0'}}, None)
@@ -0,0 +1,79 @@
+"""
+==============
+test_name_search.py
+==============
+
+Test the name search autocomplete of the API
+"""
+
+import os
+from unittest.mock import patch
+
+import pytest
+
+from fts.api.controllers.name_search import fold_name, search_query
+from fts.db import name_index
+
+
+@pytest.fixture(scope='function', autouse=True)
+def db_environs():
+    """Make sure no real values are in the database env vars"""
+    os.environ['DB_HOST'] = "foo"
+    os.environ['DB_NAME'] = "foo"
+    os.environ['DB_USERNAME'] = "foo"
+    os.environ['DB_PASSWORD'] = "foo"
+
+
+def test_fold_name():
+    """
+    The API folds queries the way the loads fold names
+    """
+    for name in ('Río Negro', 'California Creek-Kuskokwim River', 'SAINT-LAURENT; Fleuve', 'Øresund_Å', ''):
+        assert fold_name(name) == name_index.fold_name(name)
+    assert fold_name('California Creek-Kuskokwim River') == 'california creek kuskokwim river'
+    assert fold_name('Río  NEGRO') == 'rio negro'
+
+
+def test_search_query():
+    """
+    The last word is a token prefix, the other words must be in the name
+    """
+    query, args = search_query(['kuskokwim', 'ri'], 'region', 5)
+    assert query.startswith("SELECT DISTINCT `name`, `name_type`, `hits`, `folded` FROM name_index"
+                            " WHERE `token` LIKE %s AND `name_type` = %s AND CONCAT(' ', `folded`, ' ') LIKE %s")
+    assert query.endswith("ORDER BY `folded` = %s DESC, `folded` LIKE %s DESC, `hits` DESC, `name` LIMIT %s")
+    assert args == ('ri%', 'region', '% kuskokwim %', 'kuskokwim ri', 'kuskokwim ri%', 5)
+
+
+@patch('pymysql.connect')
+def test_process_search(db_environs):
+    """
+    /search returns the ranked names with their types and hit counts
+    """
+    import fts.api.controllers.fts_controller as controller
+
+    class MockConn:
+        def __init__(self, rows):
+            self.rows = rows
+            self.executed = []
+
+        def execute(self, query, args=None):
+            self.executed.append((query, args))
+
+        def fetchall(self): return self.rows
+
+    cur = MockConn([('California Creek-Kuskokwim River', 'region', 1, 'california creek kuskokwim river'),
+                    ('Kuskokwim River', 'reach', 812, 'kuskokwim river')])
+    response = controller.handle_request({'body': {'search': 'names', 'q': 'Kúskokwim', 'type': '', 'limit': ''}}, cur)
+
+    assert cur.executed[0][1] == ('kuskokwim%', 'kuskokwim', 'kuskokwim%', 10)
+    assert response['hits'] == 2
+    assert response['results'][1] == {'name': 'Kuskokwim River', 'type': 'reach', 'hits': 812}
+    assert response['search on'] == {'parameter': 'search', 'q': 'Kúskokwim', 'type': None, 'limit': 10}
+
+    with pytest.raises(controller.RequestError, match='404'):
+        controller.handle_request({'body': {'search': 'names', 'q': 'zz'}}, MockConn([]))
+    for body in ({'q': 'k'}, {'q': ' - '}, {'q': 'ku', 'type': 'lake'}, {'q': 'ku', 'limit': '0'},
+                 {'q': 'ku', 'limit': '101'}):
+        with pytest.raises(controller.RequestError, match='400'):
+            controller.handle_request({'body': dict(body, search='names')}, MockConn([]))
@@ -0,0 +1,81 @@
+"""
+==============
+test_query_plans.py
+==============
+
+Test the query plan regression suite. The plans are checked on MySQL
+when FTS_PLAN_DB_URL is set to a database the suite may seed.
+"""
+
+import importlib.util
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPEC = importlib.util.spec_from_file_location('query_plans', os.path.join(ROOT, 'benchmarks', 'query_plans.py'))
+query_plans = importlib.util.module_from_spec(SPEC)
+SPEC.loader.exec_module(query_plans)
+
+
+def explained(*tables, filesort=False):
+    """An EXPLAIN FORMAT=JSON plan reading tables in a nested loop"""
+    loop = [{'table': {'table_name': name, 'access_type': access, 'key': key, 'rows_examined_per_scan': rows}}
+            for name, access, key, rows in tables]
+    return {'query_block': {'select_id': 1, 'ordering_operation': {'using_filesort': filesort,
+                                                                   'nested_loop': loop}}}
+
+
+def test_check_plan():
+    """
+    Plans as good as expected pass; scans, other keys, more rows and
+    unexpected sorts are reported
+    """
+    expected = query_plans.plan(query_plans.read('reaches', 'ref', 'river_name_idx', 100),
+                                query_plans.read('nodes', 'ref', 'node_reach_id_idx', 50))
+
+    assert not query_plans.check_plan(explained(('reaches', 'ref', 'river_name_idx', 12),
+                                                ('nodes', 'eq_ref', 'node_reach_id_idx', 10)), expected)
+
+    problems = query_plans.check_plan(explained(('reaches', 'ALL', None, 1000),
+                                                ('nodes', 'ref', 'node_id_idx', 80), filesort=True), expected)
+    assert problems == [
+        'reaches is read by ALL, expected ref or better',
+        'reaches is read with key None, expected river_name_idx',
+        'reaches examines 1000 rows per scan, expected at most 100',
+        'nodes is read with key node_id_idx, expected node_reach_id_idx',
+        'nodes examines 80 rows per scan, expected at most 50',
+        'uses filesort',
+    ]
+
+    assert query_plans.check_plan(explained(('reaches', 'ref', 'river_name_idx', 12)), expected) == [
+        'nodes is not read']
+
+
+def test_plan_statements(tmp_path):
+    """
+    Each case runs the statements it has expectations for
+    """
+    snapshot = str(tmp_path / 'plans.sqlite')
+    scale = query_plans.SCALE
+    subprocess.run([sys.executable, '-m', 'benchmarks.synthetic_data', '--output', snapshot,
+                    '--seed', str(scale['seed']), '--basins', str(scale['basins']),
+                    '--reaches-per-basin', str(scale['reaches_per_basin']),
+                    '--nodes-per-reach', str(scale['nodes_per_reach']),
+                    '--huc-children', str(scale['huc_children']), '--vertices', str(scale['vertices'])],
+                   cwd=ROOT, capture_output=True, text=True, check=True)
+    result = subprocess.run([sys.executable, '-m', 'benchmarks.query_plans', '--snapshot', snapshot],
+                            cwd=ROOT, capture_output=True, text=True, check=False)
+    assert result.returncode == 0, result.stdout + result.stderr
+
+
+@pytest.mark.skipif(not os.environ.get('FTS_PLAN_DB_URL'), reason='FTS_PLAN_DB_URL is not set')
+def test_query_plans():
+    """
+    No query plan on the seeded MySQL database is worse than expected
+    """
+    result = subprocess.run([sys.executable, '-m', 'benchmarks.query_plans', '--db-url',
+                             os.environ['FTS_PLAN_DB_URL']], cwd=ROOT, capture_output=True, text=True, check=False)
+    assert result.returncode == 0, result.stdout + result.stderr
@@ -0,0 +1,93 @@
+"""
+==============
+test_request_metrics.py
+==============
+
+Test the per-request phase timing and embedded metrics of the API
+"""
+
+import json
+import os
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from fts.api.controllers.request_metrics import PHASES, RequestTimer, TimedCursor
+from fts.api.controllers.result_cache import DatasetVersion, ResultCache
+
+
+@pytest.fixture(scope='function', autouse=True)
+def db_environs():
+    """Make sure no real values are in the database env vars"""
+    os.environ['DB_HOST'] = "foo"
+    os.environ['DB_NAME'] = "foo"
+    os.environ['DB_USERNAME'] = "foo"
+    os.environ['DB_PASSWORD'] = "foo"
+
+
+def test_timed_cursor():
+    """
+    Queries are timed as count or page queries, and fetched rows are counted
+    """
+    cur = MagicMock()
+    cur.fetchall.return_value = [(1,), (2,)]
+    cur.fetchmany.return_value = [(3,)]
+    timer = RequestTimer(0)
+    timed = TimedCursor(cur, timer)
+
+    timed.execute("EXPLAIN SELECT COUNT(*) FROM huc_table")
+    timed.execute("select `HUC` from huc_table where `HUC` = %s", '1804')
+    timed.fetchall()
+    timed.fetchmany(10)
+
+    summary = timer.summary()
+    assert summary['parse_ms'] > 0
+    assert summary['queries'] == 2
+    assert summary['rows'] == 3
+    assert timed.description is cur.description
+
+    record = timer.emf({'endpoint': 'huc', 'exact': 'true', 'format': 'json'}, {'status': '200'})
+    metrics = record['_aws']['CloudWatchMetrics'][0]
+    assert metrics['Dimensions'] == [['endpoint', 'exact', 'format']]
+    assert {'Name': 'bytes', 'Unit': 'Bytes'} in metrics['Metrics']
+    assert {'Name': 'count_query_ms', 'Unit': 'Milliseconds'} in metrics['Metrics']
+    assert record['endpoint'] == 'huc' and record['status'] == '200' and record['rows'] == 3
+
+
+@patch('pymysql.connect')
+def test_lambda_handler_metrics(mock_connect, capsys):
+    """
+    Each request logs one EMF line, and debug_timing=true adds the phases
+    with the connection and cache counters to the response
+    """
+    import fts.api.controllers.fts_controller as controller
+    controller.connections.close()
+
+    huc_row = ['1804', 'San Joaquin', '1,2,3,4,5,6', '1,2,3,4,5,6', '1,2,3,4']
+    cur = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    cur.fetchall.side_effect = [[('huc', '1')], [(1,)], [huc_row]]
+
+    controller.dataset_version = DatasetVersion(check_interval=60)
+    capsys.readouterr()
+
+    event = {'body': {'HUC': '1804', 'exact': 'true', 'polygon_format': '', 'debug_timing': 'true'}}
+    with patch.object(controller, 'result_cache', ResultCache(max_entries=8, ttl=60, max_bytes=1 << 20)):
+        response = json.loads(controller.lambda_handler(event, None))
+        cached = json.loads(controller.lambda_handler({'body': {'HUC': '1804', 'exact': 'true'}}, None))
+
+    timing = response['debug_timing']
+    assert [f'{phase}_ms' for phase in PHASES] == [key for key in timing if key[:-3] in PHASES]
+    assert timing['queries'] == 2 and timing['rows'] == 2 and timing['bytes'] > 0
+    assert timing['source'] == 'database'
+    assert timing['connections']['connects'] == 1
+    assert 'debug_timing' not in cached
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [record['source'] for record in records] == ['database', 'cache']
+    assert records[0]['endpoint'] == 'huc' and records[0]['exact'] == 'true' and records[0]['format'] == 'json'
+    assert records[0]['status'] == '200' and records[0]['rows'] == 2
+    assert records[1]['queries'] == 0
+
+    with pytest.raises(controller.RequestError):
+        controller.lambda_handler({'body': {'HUC': '1804', 'format': 'xml'}}, None)
+    assert json.loads(capsys.readouterr().out)['status'] == '400'
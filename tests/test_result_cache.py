@@ -0,0 +1,172 @@
+"""
+==============
+test_result_cache.py
+==============
+
+Test the in-process result cache of the API
+"""
+
+import json
+import os
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from fts.api.controllers.json_fragments import response_status, with_attributes, with_time
+from fts.api.controllers.result_cache import DatasetVersion, ResultCache, normalize_request
+
+
+@pytest.fixture(scope='function', autouse=True)
+def db_environs():
+    """Make sure no real values are in the database env vars"""
+    os.environ['DB_HOST'] = "foo"
+    os.environ['DB_NAME'] = "foo"
+    os.environ['DB_USERNAME'] = "foo"
+    os.environ['DB_PASSWORD'] = "foo"
+
+
+def test_normalize_request():
+    """
+    Requests which give the same result share a key
+    """
+    plain = {'region': 'San%20Joaquin', 'exact': 'FALSE', 'page_number': '', 'page_size': '100',
+             'polygon_format': 'GeoJSON'}
+    same = {'region': 'San Joaquin', 'exact': '', 'page_number': '01', 'polygon_format': 'geojson'}
+    other_page = dict(same, page_number='2')
+
+    assert normalize_request(plain) == normalize_request(same)
+    assert normalize_request(plain) != normalize_request(other_page)
+    assert normalize_request({'HUC': '18'}) != normalize_request({'region': '18'})
+
+
+def test_lru_eviction_and_memory_cap():
+    """
+    The least recently used entries are evicted past max_entries or max_bytes
+    """
+    cache = ResultCache(max_entries=2, max_bytes=100, max_entry_bytes=60)
+    cache.put('a', {'v': 1}, size=10)
+    cache.put('b', {'v': 2}, size=10)
+    assert cache.get('a') == {'v': 1}
+    cache.put('c', {'v': 3}, size=10)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == {'v': 1}
+
+    cache = ResultCache(max_entries=10, max_bytes=100, max_entry_bytes=60)
+    for key in 'abcd':
+        cache.put(key, {'v': key}, size=20)
+    cache.put('e', {'v': 'e'}, size=60)
+    assert cache.get('a') is None
+    assert cache.get('b') is None
+    assert cache.get('d') == {'v': 'd'}
+    assert cache.stats()['bytes'] == 100
+
+    cache.put('f', {'v': 'f'}, size=61)
+    assert cache.get('f') is None
+
+    stats = cache.stats()
+    assert stats['evictions'] == 2
+    assert stats['oversize'] == 1
+
+
+def test_ttl_and_version_invalidation():
+    """
+    Entries expire after the TTL and are dropped when the dataset version changes
+    """
+    cache = ResultCache(ttl=0)
+    cache.put('a', b'{"v": 1}')
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
+
+    cache = ResultCache()
+    cache.set_version('huc=1')
+    cache.put('a', b'{"v": 1}')
+    cache.set_version('huc=1')
+    assert cache.get('a') == b'{"v": 1}'
+    cache.set_version('huc=2')
+    assert cache.get('a') is None
+    assert cache.stats()['invalidations'] == 1
+
+
+def test_dataset_version_read_interval():
+    """
+    The version is read once per check interval
+    """
+    cur = MagicMock()
+    cur.fetchall.return_value = [('huc', '1'), ('sword', '2')]
+    version = DatasetVersion(check_interval=60)
+
+    assert version.is_stale()
+    assert version.refresh(cur) == 'huc=1;sword=2'
+    assert not version.is_stale()
+
+
+@patch('pymysql.connect')
+def test_lambda_handler_serves_from_cache(mock_connect):
+    """
+    A repeated request is answered without running any query
+    """
+    import fts.api.controllers.fts_controller as controller
+    controller.connections.close()
+
+    huc_row = ['1804', 'San Joaquin', '1,2,3,4,5,6', '1,2,3,4,5,6', '1,2,3,4']
+    cur = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    cur.fetchall.side_effect = [[('huc', '1')], [(1,)], [huc_row]]
+
+    controller.result_cache.clear()
+    controller.dataset_version = DatasetVersion(check_interval=60)
+    event = {'body': {'HUC': '1804', 'exact': 'true', 'polygon_format': ''}}
+
+    with patch.object(controller, 'METRICS_ENABLED', True):
+        first = json.loads(controller.lambda_handler(event, None))
+        executed = cur.execute.call_count
+        # The cached bytes are returned as they are, with only the time replaced
+        with patch('fts.api.controllers.json_fragments.serialize_response') as serialize:
+            second = json.loads(controller.lambda_handler({'body': {'HUC': '1804', 'exact': 'TRUE'}}, None))
+
+    assert cur.execute.call_count == executed
+    assert not serialize.called
+    assert second['results'] == first['results']
+    assert second['time'].endswith(' ms.')
+    assert controller.result_cache.stats()['hits'] == 1
+
+
+def test_encoded_response_attributes():
+    """
+    The status, time and extra attributes of an encoded response are read
+    and changed without parsing it
+    """
+    body = json.dumps({'status': '206 PARTIAL CONTENT', 'time': '12.5 ms.', 'hits': 3, 'results': [{'time': 1}]})
+    body = body.encode('utf-8')
+
+    assert response_status(body) == '206 PARTIAL CONTENT'
+    assert response_status(b'{"results": []}') == ''
+    assert json.loads(with_time(body, 0.1)) == dict(json.loads(body), time='0.1 ms.')
+    assert with_time(b'{"results": []}', 0.1) == b'{"results": []}'
+    assert json.loads(with_attributes(body, {'etag': '"a"'})) == dict(json.loads(body), etag='"a"')
+
+
+@patch('pymysql.connect')
+def test_lambda_handler_does_not_cache_ndjson(mock_connect):
+    """
+    NDJSON pages are read from the database each time and never stored
+    """
+    import fts.api.controllers.fts_controller as controller
+    controller.connections.close()
+
+    huc_row = ['1804', 'San Joaquin', '1,2,3,4,5,6', '1,2,3,4,5,6', '1,2,3,4']
+    cur = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    cur.fetchall.side_effect = [[('huc', '1')], [(1,)], [(1,)]]
+    cur.fetchmany.side_effect = [[huc_row], [], [huc_row], []]
+
+    controller.result_cache.clear()
+    controller.dataset_version = DatasetVersion(check_interval=60)
+    event = {'body': {'HUC': '1804', 'exact': 'true', 'polygon_format': '', 'format': 'ndjson'}}
+
+    first = json.loads(controller.lambda_handler(event, None))
+    executed = cur.execute.call_count
+    second = json.loads(controller.lambda_handler(event, None))
+
+    assert cur.execute.call_count > executed
+    assert second['ndjson'].splitlines()[0] == first['ndjson'].splitlines()[0]
+    assert controller.result_cache.stats()['entries'] == 0
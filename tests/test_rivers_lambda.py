@@ -165,4 +165,445 @@ def test_return_river_name(db_environs):
     geo = geojson.GeoJSON.to_instance(json_results[0]['geojson'])
     assert geo.is_valid
     assert geo['type'] == 'LineString'
-    assert len(geo['coordinates']) == 55
\ No newline at end of file
+    assert len(geo['coordinates']) == 55
+
+
+class MockCursor:
+    """Records executed statements and returns canned rows for page queries"""
+    def __init__(self, rows, hits):
+        self.rows = rows
+        self.hits = hits
+        self.executed = []
+        self.description = [['reach_id'], ['geojson']]
+        self._last = None
+
+    def execute(self, query, args=None):
+        self.executed.append((query, args))
+        self._last = query
+
+    def fetchall(self):
+        if 'COUNT(*)' in self._last:
+            return [[self.hits]]
+        return self.rows
+
+
+@patch('pymysql.connect')
+def test_next_token_round_trip(db_environs):
+    """
+    A next_token decodes back to the values it was encoded with, and is rejected
+    when used with a different query
+    """
+    import fts.api.controllers.fts_controller as controller
+
+    query = controller.page_query_key('reach', '7311', '', False)
+    token = controller.encode_next_token(query, '73110000045', 479, 100)
+
+    assert controller.decode_next_token(token, query) == {'last': '73110000045', 'hits': 479, 'seen': 100}
+
+    other_query = controller.page_query_key('reach', '7312', '', False)
+    with pytest.raises(controller.RequestError, match='400'):
+        controller.decode_next_token(token, other_query)
+    with pytest.raises(controller.RequestError, match='400'):
+        controller.decode_next_token('not-a-token', query)
+
+
+@patch('pymysql.connect')
+def test_reach_keyset_pagination(db_environs):
+    """
+    The first page counts hits and hands out a next_token; the following page
+    seeks past the last reach_id and does not count again
+    """
+    import fts.api.controllers.fts_controller as controller
+
+    rows = [[f'7311000{i:04d}', reach_set['geojson']] for i in range(2)]
+    cur = MockCursor(rows, hits=5)
+
+    first = controller.process_reach('7311', '', False, cur, 0, 1, 2)
+
+    assert first['hits'] == 5
+    assert any('COUNT(*)' in query for query, _ in cur.executed)
+    assert 'next_token' in first
+
+    cur = MockCursor(rows, hits=5)
+    second = controller.process_reach('7311', '', False, cur, 0, 1, 2, first['next_token'])
+
+    assert second['hits'] == 5
+    assert len(cur.executed) == 1
+    query, args = cur.executed[0]
+    assert 'reach_num BETWEEN %s AND %s AND reach_num > %s' in query
+    assert args == (73110000000, 73119999999, 73110000001, 0, 2)
+    assert 'next_token' in second
+
+    # Last page: nothing left to hand out
+    cur = MockCursor(rows[:1], hits=5)
+    third = controller.process_reach('7311', '', False, cur, 0, 1, 2, second['next_token'])
+    assert 'next_token' not in third
+
+
+@patch('pymysql.connect')
+def test_river_name_join(db_environs):
+    """
+    Reaches and nodes of a river are joined from the reaches found by name,
+    and the counts match the page queries
+    """
+    import fts.api.controllers.fts_controller as controller
+
+    rows = [[f'7311000{i:04d}1', reach_set['geojson']] for i in range(2)]
+    cur = MockCursor(rows, hits=2)
+    controller.process_river('Ohio', False, cur, 0, True, True, 1, 100)
+
+    (count, count_args), (page, page_args) = cur.executed
+    assert count == "SELECT COUNT(*) FROM reaches JOIN nodes ON nodes.reach_id = reaches.reach_id WHERE reaches.river_name LIKE %s"
+    assert count_args == 'Ohio%'
+    assert "FROM reaches JOIN nodes ON nodes.reach_id = reaches.reach_id WHERE reaches.river_name LIKE %s ORDER BY node_id" in page
+    assert 'nodes.river_name' not in page
+    assert page_args == ('Ohio%', 0, 100)
+
+    cur = MockCursor(rows, hits=2)
+    controller.process_river('Ohio', True, cur, 0, True, True, 1, 100)
+    assert cur.executed[0][0].endswith("WHERE reaches.river_name = %s")
+    assert cur.executed[0][1] == 'Ohio'
+
+    cur = MockCursor(rows, hits=2)
+    controller.process_river('Ohio', False, cur, 0, False, True, 1, 100)
+    assert cur.executed[0] == ("SELECT COUNT(*) FROM nodes WHERE river_name LIKE %s", 'Ohio%')
+
+
+@patch('pymysql.connect')
+def test_id_prefix_range(db_environs):
+    """
+    Digit prefixes of reach and node ids are ranges on the BIGINT id columns,
+    other prefixes stay LIKE on the id
+    """
+    import fts.api.controllers.fts_controller as controller
+
+    assert controller.id_prefix_predicate('node_id', '7311') == (
+        'node_num BETWEEN %s AND %s', (73110000000000, 73119999999999), 'node_num')
+    assert controller.id_prefix_predicate('reach_id', '73110000045') == (
+        'reach_num BETWEEN %s AND %s', (73110000045, 73110000045), 'reach_num')
+    assert controller.id_prefix_predicate('reach_id', '7311x', {'last': '7311x1', 'hits': 1, 'seen': 1}) == (
+        'reach_id LIKE %s AND reach_id > %s', ('7311x%', '7311x1'), 'reach_id')
+    assert controller.id_prefix_predicate('reach_id', '731100000451')[2] == 'reach_id'
+
+    cur = MockCursor([], hits=3)
+    controller.process_node('7311', 'Ohio', False, cur, 0, 1, 2, count_only=True)
+    assert cur.executed[0] == ("SELECT COUNT(*) FROM nodes WHERE node_num BETWEEN %s AND %s AND river_name LIKE %s",
+                               (73110000000000, 73119999999999, 'Ohio%'))
+
+
+@patch('pymysql.connect')
+def test_count_none_skips_count(db_environs):
+    """
+    count=none does not count hits and fetches one extra row to tell whether
+    another page follows
+    """
+    import fts.api.controllers.fts_controller as controller
+
+    rows = [[f'7311000{i:04d}', reach_set['geojson']] for i in range(3)]
+    cur = MockCursor(rows, hits=5)
+
+    response = controller.process_reach('7311', '', False, cur, 0, 1, 2, count_mode='none')
+
+    assert len(cur.executed) == 1
+    assert cur.executed[0][1] == (73110000000, 73119999999, 0, 3)
+    assert response['hits'] is None
+    assert response['has_more'] is True
+    assert response['status'] == '206 PARTIAL CONTENT'
+    assert len(response['results']) == 2
+    assert 'next_token' in response
+
+
+@patch('pymysql.connect')
+def test_count_estimate_uses_explain(db_environs):
+    """
+    count=estimate reads the optimizer row estimate instead of counting
+    """
+    import fts.api.controllers.fts_controller as controller
+
+    class ExplainCursor(MockCursor):
+        def fetchall(self):
+            if self._last.startswith('EXPLAIN'):
+                self.description = [['id'], ['table'], ['rows'], ['filtered']]
+                return [[1, 'reaches', 400, 50.0]]
+            self.description = [['reach_id'], ['geojson']]
+            return self.rows
+
+    rows = [[f'7311000{i:04d}', reach_set['geojson']] for i in range(3)]
+    cur = ExplainCursor(rows, hits=5)
+
+    response = controller.process_reach('7311', 'Ohio', False, cur, 0, 1, 2, count_mode='estimate')
+
+    assert cur.executed[0][0].startswith('EXPLAIN SELECT COUNT(*)')
+    assert response['hits'] == 200
+    assert response['has_more'] is True
+    assert response['search on']['count'] == 'estimate'
+
+
+@patch('pymysql.connect')
+def test_count_only(db_environs):
+    """
+    count_only returns the hits count without querying for results
+    """
+    import fts.api.controllers.fts_controller as controller
+
+    assert controller.get_count_mode({'count': '', 'count_only': 'true'}) == ('exact', True)
+    with pytest.raises(controller.RequestError, match='400'):
+        controller.get_count_mode({'count': 'foo'})
+    with pytest.raises(controller.RequestError, match='400'):
+        controller.get_count_mode({'count': 'none', 'count_only': 'true'})
+
+    cur = MockCursor([], hits=5)
+    response = controller.process_node('7311', '', False, cur, 0, 1, 2, count_only=True)
+
+    assert len(cur.executed) == 1
+    assert 'COUNT(*)' in cur.executed[0][0]
+    assert response['hits'] == 5
+    assert 'results' not in response
+
+
+@patch('pymysql.connect')
+def test_ndjson_stream_reach(db_environs):
+    """
+    format=ndjson fetches rows in batches and writes one result per line with
+    the stored GeoJSON spliced in, followed by the page summary
+    """
+    import json
+    import fts.api.controllers.fts_controller as controller
+
+    class BatchCursor(MockCursor):
+        def __init__(self, rows, hits):
+            super().__init__(rows, hits)
+            self.batches = []
+
+        def fetchmany(self, size):
+            done = sum(self.batches)
+            batch = self.rows[done:done + size]
+            self.batches.append(len(batch))
+            return batch
+
+    rows = [[f'7311000{i:04d}', reach_set['geojson']] for i in range(5)]
+    cur = BatchCursor(rows, hits=9)
+
+    with patch.object(controller, 'NDJSON_BATCH_SIZE', 2):
+        lines = controller.process_reach('7311', '', False, cur, 0, 1, 4, output_format='ndjson')
+        assert cur.batches == []
+        lines = list(lines)
+
+    assert cur.batches == [2, 2, 1]
+    assert len(lines) == 5
+    assert all(line.endswith('\n') for line in lines)
+
+    results = [json.loads(line) for line in lines[:-1]]
+    assert [result['reach_id'] for result in results] == [row[0] for row in rows[:4]]
+    assert results[0]['geojson'] == json.loads(reach_set['geojson'])
+
+    summary = json.loads(lines[-1])
+    assert summary['status'] == '206 PARTIAL CONTENT'
+    assert summary['results_count'] == 4
+    token = controller.decode_next_token(summary['next_token'], controller.page_query_key('reach', '7311', '', False, 'exact'))
+    assert token['last'] == rows[3][0]
+
+    collected = controller.collect(iter(lines))
+    assert collected == {'status': '206 PARTIAL CONTENT', 'format': 'ndjson', 'ndjson': ''.join(lines)}
+
+    with pytest.raises(controller.RequestError, match='404'):
+        list(controller.process_reach('7311', '', False, BatchCursor([], hits=0), 0, 1, 4, output_format='ndjson'))
+    with pytest.raises(controller.RequestError, match='400'):
+        controller.get_output_format({'format': 'xml'})
+
+
+@patch('pymysql.connect')
+def test_fields_projection(db_environs):
+    """
+    fields= and include_geometry=false select only the requested columns, and
+    the paging key is always selected
+    """
+    import fts.api.controllers.fts_controller as controller
+
+    assert controller.get_fields({'fields': 'wse, width,wse', 'include_geometry': 'False'}) == (('wse', 'width'), False)
+    assert controller.get_fields({'fields': ''}) == (None, True)
+
+    cur = MockCursor([['73110000001', 242.7]], hits=1)
+    cur.description = [['reach_id'], ['wse']]
+    response = controller.process_reach('73110000001', '', True, cur, 0, 1, 100, fields=('wse',))
+    assert cur.executed[0][0].startswith('SELECT `reach_id`, `wse` FROM reaches')
+    assert response['results'] == [{'reach_id': '73110000001', 'wse': 242.7}]
+
+    columns = controller.river_columns(('reaches', 'nodes'), 'node_id', include_geometry=False)
+    assert columns.startswith('nodes.`node_id`, nodes.`x`')
+    assert 'reaches.`reach_len`' in columns
+    assert 'geojson' not in columns and 'geometry' not in columns
+    assert controller.river_columns(('nodes',), 'node_id') == '*'
+
+    with pytest.raises(controller.RequestError, match='400: Invalid fields: reach_len'):
+        controller.river_columns(('nodes',), 'node_id', ('wse', 'reach_len'))
+
+    assert controller.huc_polygons(('visvalingam', 'bbox'), True) == ('visvalingam', 'bbox')
+    assert controller.huc_polygons(None, False) == ()
+    with pytest.raises(controller.RequestError, match='400'):
+        controller.huc_polygons(('wse',), True)
+
+
+@patch('pymysql.connect')
+def test_geometry_precision_and_simplify(db_environs):
+    """
+    precision= rounds and simplify= thins the geojson of a page, and the
+    bytes saved are reported
+    """
+    import json
+    import fts.api.controllers.fts_controller as controller
+
+    assert controller.get_geometry_reduction({'precision': '3', 'simplify': '25.5'}) == (3, 25.5)
+    assert controller.get_geometry_reduction({'precision': '', 'simplify': ''}) == (None, None)
+    for body in ({'precision': '16'}, {'precision': 'a'}, {'simplify': '0'}, {'simplify': 'nan'}):
+        with pytest.raises(controller.RequestError, match='400'):
+            controller.get_geometry_reduction(body)
+
+    rows = [[f'7311000{i:04d}', reach_set['geojson']] for i in range(2)]
+    response = controller.process_reach('7311', '', False, MockCursor(rows, hits=2), 0, 1, 100, precision=3)
+
+    coordinates = response['results'][0]['geojson']['coordinates']
+    assert len(coordinates) == 55
+    assert all(round(value, 3) == value for point in coordinates for value in point)
+    assert response['bytes_saved'] > 0
+    assert response['search on']['precision'] == 3
+
+    response = controller.process_reach('7311', '', False, MockCursor(rows, hits=2), 0, 1, 100, simplify=100)
+    assert 2 <= len(response['results'][0]['geojson']['coordinates']) < 55
+    assert response['bytes_saved'] > 0
+
+    texts, saved = controller.reduce_geojson([reach_set['geojson'], None], precision=2)
+    assert texts[1] is None and saved[1] == 0
+    assert len(json.loads(texts[0])['coordinates']) == 55
+    assert saved[0] == len(reach_set['geojson']) - len(texts[0])
+
+
+@patch('pymysql.connect')
+def test_json_fragments(db_environs):
+    """
+    With JSON_FRAGMENTS on, a reach page reads the pre-rendered results and
+    splices them into a response equal to the one built from the columns
+    """
+    import json
+    import fts.api.controllers.fts_controller as controller
+
+    rows = [[f'7311000{i:04d}', reach_set['geojson']] for i in range(2)]
+    expected = controller.process_reach('7311', '', False, MockCursor(rows, hits=2), 0, 1, 100)
+
+    fragment_rows = [[reach_id, json.dumps({'reach_id': reach_id, 'geojson': geojson.loads(text)})]
+                     for reach_id, text in rows]
+    cur = MockCursor(fragment_rows, hits=2)
+    cur.description = [['reach_id'], ['json_fragment']]
+    with patch.object(controller, 'JSON_FRAGMENTS', True):
+        response = controller.process_reach('7311', '', False, cur, 0, 1, 100)
+
+        # Reduced geometries and NDJSON are still built from the columns
+        assert controller.river_columns(('reaches',), 'reach_id', None, True,
+                                        controller.use_json_fragments('json', 3, None)) == '*'
+
+    assert '`reach_id`, `json_fragment`' in cur.executed[-1][0]
+    assert isinstance(response['results'], controller.JSONFragments)
+
+    body = controller.encode_response(response)
+    assert isinstance(body, bytes)
+    assert dict(json.loads(body), time=None) == dict(json.loads(json.dumps(expected)), time=None)
+    assert json.loads(controller.encode_response(expected)) == json.loads(json.dumps(expected))
+
+
+def test_raw_json():
+    """
+    RawJSON values are spliced in as they are, also when a string of the
+    response looks like the placeholder
+    """
+    import json
+
+    from fts.api.controllers.json_fragments import RAW_PLACEHOLDER, RawJSON, dumps
+
+    value = {'a': RawJSON('{"x":[1,2.50]}'), 'b': [RawJSON('null'), 'text']}
+    assert dumps(value) == '{"a": {"x":[1,2.50]}, "b": [null, "text"]}'
+    collision = dict(value, c=RAW_PLACEHOLDER)
+    assert json.loads(dumps(collision)) == {'a': {'x': [1, 2.5]}, 'b': [None, 'text'], 'c': RAW_PLACEHOLDER}
+    with pytest.raises(TypeError):
+        dumps({'a': object()})
+
+
+@patch('pymysql.connect')
+def test_batch_reach(db_environs):
+    """
+    A batch lookup runs one IN query per chunk of ids, keys the results by
+    id and marks the ids which were not found
+    """
+    import fts.api.controllers.fts_controller as controller
+
+    class BatchCursor(MockCursor):
+        def fetchall(self):
+            _, args = self.executed[-1]
+            return [row for row in self.rows if row[0] in args]
+
+    rows = [[f'7311000{i:04d}', reach_set['geojson']] for i in range(3)]
+    cur = BatchCursor(rows, hits=0)
+    body = {'batch': 'reach', 'ids': ['73110000002', '73110000000', '73119999999', '73110000000', '73110000001']}
+
+    with patch.object(controller, 'BATCH_CHUNK_SIZE', 2):
+        response = controller.handle_request({'body': body}, cur)
+
+    assert len(cur.executed) == 2
+    assert 'WHERE `reach_id` IN (%s, %s)' in cur.executed[0][0]
+    assert response['status'] == '200 OK'
+    assert response['hits'] == 3
+    assert list(response['results']) == ['73110000002', '73110000000', '73119999999', '73110000001']
+    assert response['results']['73119999999'] is None
+    assert response['not_found'] == ['73119999999']
+    assert response['results']['73110000000']['geojson']['type'] == 'LineString'
+
+    assert controller.get_batch_ids({'ids': '1, 2,,1'}) == ['1', '2']
+    with patch.object(controller, 'BATCH_MAX_IDS', 2):
+        for body in ({'ids': ['1', '2', '3']}, {'ids': []}, {'ids': None}, {}):
+            with pytest.raises(controller.RequestError, match='400'):
+                controller.get_batch_ids(body)
+    with pytest.raises(controller.RequestError, match='400'):
+        controller.process_batch('region', ['1'], cur, 0)
+
+
+@patch('pymysql.connect')
+def test_spatial_query(db_environs):
+    """
+    bbox and polygon queries use the spatial index through MBRIntersects, with
+    the river_name and attribute filters, and page on the id column
+    """
+    import fts.api.controllers.fts_controller as controller
+
+    rows = [[f'7311000{i:04d}', reach_set['geojson'], b'\x00\x00'] for i in range(2)]
+    cur = MockCursor(rows, hits=2)
+    cur.description = [['reach_id'], ['geojson'], ['geom']]
+    body = {'spatial': 'reach', 'bbox': '-10,40.5,5,52', 'river_name': 'Loire', 'min_width': '50', 'type': ''}
+
+    response = controller.handle_request({'body': body}, cur)
+
+    count_query, count_args = cur.executed[0]
+    assert count_query.startswith('SELECT COUNT(*) FROM reaches WHERE MBRIntersects(`geom`, ST_GeomFromText(%s))')
+    query, args = cur.executed[1]
+    assert 'FROM reaches WHERE MBRIntersects' in query and '`width` >= %s' in query and 'ORDER BY reach_id' in query
+    assert args == ('POLYGON((-10.0 40.5, 5.0 40.5, 5.0 52.0, -10.0 52.0, -10.0 40.5))', 'Loire%', 50.0, 0, 100)
+    assert response['hits'] == 2
+    assert response['search on']['parameter'] == 'bbox'
+    assert 'geom' not in response['results'][0]
+
+    identifier, _, wkt = controller.get_spatial_area({'polygon': '0,0,1,0,1,1,0,0'})
+    assert identifier == 'polygon'
+    assert wkt == 'POLYGON((0.0 0.0, 1.0 0.0, 1.0 1.0, 0.0 0.0))'
+
+    cur = MockCursor([row[:2] for row in rows], hits=2)
+    controller.process_spatial('node', ('polygon', '', wkt), '', ('', ()), cur, 0, 1, 100, count_mode='none')
+    query, args = cur.executed[0]
+    assert 'FROM nodes WHERE MBRIntersects' in query and 'ST_Intersects(`geom`' in query
+    assert args == (wkt, wkt, 0, 101)
+
+    for body in ({}, {'bbox': '1,2,3'}, {'bbox': '5,0,1,1'}, {'bbox': '0,0,1,91'}, {'bbox': '0,0,1,1', 'polygon': '0,0,1,0,1,1'},
+                 {'polygon': '0,0,1,1'}, {'polygon': 'a,b,c,d,e,f'}):
+        with pytest.raises(controller.RequestError, match='400'):
+            controller.get_spatial_area(body)
+    with pytest.raises(controller.RequestError, match='400'):
+        controller.get_attribute_filters({'lakeflag': 'nan'})
+    with pytest.raises(controller.RequestError, match='400'):
+        controller.process_spatial('HUC', ('bbox', '', wkt), '', ('', ()), cur, 0, 1, 100)
@@ -59,8 +59,8 @@ class TestSWORDdb(unittest.TestCase):
         """
         Test that data is found within each table have the correct number of fields
         """
-        self.assertEqual(29, len(self.one_reach))
-        self.assertEqual(25, len(self.one_node))
+        self.assertEqual(30, len(self.one_reach))
+        self.assertEqual(26, len(self.one_node))
 
     def test_geom_type(self):
         """
@@ -73,3 +73,143 @@ class TestSWORDdb(unittest.TestCase):
 
     def tearDown(self):
         self.session.close()
+
+
+class TestDatasetVersion(unittest.TestCase):
+    """
+    Test the dataset version stamp read by the API result cache
+    """
+
+    def test_stamp_dataset_version(self):
+        """
+        Each load replaces the version of its dataset and leaves the others
+        """
+        engine = create_engine('sqlite:///:memory:')
+
+        setup_sword.stamp_dataset_version(engine, 'huc')
+        first = setup_sword.stamp_dataset_version(engine, 'sword')
+        second = setup_sword.stamp_dataset_version(engine, 'sword')
+        self.assertNotEqual(first, second)
+
+        with engine.connect() as conn:
+            rows = conn.execute(setup_sword.text_query(
+                "SELECT dataset, version FROM fts_metadata ORDER BY dataset")).fetchall()
+        self.assertEqual(['huc', 'sword'], [row[0] for row in rows])
+        self.assertEqual(second, rows[1][1])
+
+
+class TestJSONFragments(unittest.TestCase):
+    """
+    Test the pre-rendered JSON results stored with each row
+    """
+
+    def test_render_json_fragments(self):
+        """
+        Fragments hold the values the API reads back: FLOAT columns to 6
+        significant digits, NULL for missing values and parsed geojson
+        """
+        import json
+        import pandas as pd
+        from sqlalchemy import Float, Integer, Text
+
+        frame = pd.DataFrame({
+            'reach_id': ['56100100013', '56100100023'],
+            'wse_var': [0.75223712, float('nan')],
+            'n_nodes': [9, 10],
+            'geojson': ['{"type": "Point", "coordinates": [115.8203307618278, -29.45151128768198]}'] * 2,
+        })
+        types = {'reach_id': Text, 'wse_var': Float, 'n_nodes': Integer, 'geojson': Text}
+
+        fragments = setup_sword.render_json_fragments(frame, types)
+
+        first, second = [json.loads(fragment) for fragment in fragments]
+        self.assertEqual(['reach_id', 'wse_var', 'n_nodes', 'geojson'], list(first))
+        self.assertEqual(0.752237, first['wse_var'])
+        self.assertEqual(9, first['n_nodes'])
+        self.assertEqual([115.820331, -29.451511], first['geojson']['coordinates'])
+        self.assertIsNone(second['wse_var'])
+
+
+class TestSpatialIndex(unittest.TestCase):
+    """
+    Test the geometry columns added for spatial queries
+    """
+
+    def test_table_spatial_index(self):
+        """
+        MySQL tables get a NOT NULL geom column filled from the WKT geometry
+        and a SPATIAL index; other databases are left alone
+        """
+        from unittest.mock import MagicMock
+
+        engine = MagicMock()
+        engine.dialect.name = 'mysql'
+        conn = engine.begin.return_value.__enter__.return_value
+
+        setup_sword.table_spatial_index(engine)
+
+        statements = [str(call.args[0]) for call in conn.execute.call_args_list]
+        self.assertEqual(6, len(statements))
+        self.assertIn("ALTER TABLE reaches ADD COLUMN geom GEOMETRY SRID 0", statements)
+        self.assertIn("UPDATE nodes SET geom = ST_GeomFromText(geometry, 0)", statements)
+        self.assertIn("ADD SPATIAL INDEX nodes_geom_idx (geom)", statements[-1])
+        self.assertIn("MODIFY geom POINT NOT NULL SRID 0", statements[-1])
+
+        engine = create_engine('sqlite:///:memory:')
+        setup_sword.table_spatial_index(engine)
+
+    def test_table_id_numbers(self):
+        """
+        MySQL tables get an indexed BIGINT copy of their id
+        """
+        from unittest.mock import MagicMock
+
+        engine = MagicMock()
+        engine.dialect.name = 'mysql'
+        conn = engine.begin.return_value.__enter__.return_value
+
+        setup_sword.table_id_numbers(engine)
+
+        statements = [str(call.args[0]) for call in conn.execute.call_args_list]
+        self.assertEqual(6, len(statements))
+        self.assertIn("UPDATE reaches SET reach_num = CAST(reach_id AS UNSIGNED)", statements)
+        self.assertIn("ADD INDEX node_num_idx (node_num)", statements[-1])
+
+
+class TestNameIndex(unittest.TestCase):
+    """
+    Test the name search index of the river names
+    """
+
+    def test_load_name_index(self):
+        """
+        Every word of a river name is an index row with the folded name and
+        the number of reaches or nodes; a reload replaces the river rows and
+        keeps the HUC region rows
+        """
+        from sqlalchemy.sql import text as text_query
+
+        engine = create_engine('sqlite:///:memory:')
+        with engine.begin() as conn:
+            conn.execute(text_query("CREATE TABLE reaches (reach_id TEXT, river_name TEXT)"))
+            conn.execute(text_query("CREATE TABLE nodes (node_id TEXT, river_name TEXT)"))
+            conn.execute(text_query("INSERT INTO reaches VALUES ('1', 'Río Negro'), ('2', 'Río Negro'), ('3', 'NODATA')"))
+            conn.execute(text_query("INSERT INTO nodes VALUES ('1', 'Kuskokwim River; Holitna River')"))
+
+        self.assertEqual(5, setup_sword.load_name_index(engine))
+        with engine.begin() as conn:
+            conn.execute(text_query("INSERT INTO name_index VALUES ('coyote', 'Coyote', 'region', 'coyote', 1)"))
+        self.assertEqual(5, setup_sword.load_name_index(engine))
+
+        with engine.connect() as conn:
+            rows = conn.execute(text_query(
+                "SELECT token, name, name_type, folded, hits FROM name_index ORDER BY name_type, token"
+            )).all()
+        self.assertEqual([
+            ('holitna', 'Kuskokwim River; Holitna River', 'node', 'kuskokwim river holitna river', 1),
+            ('kuskokwim', 'Kuskokwim River; Holitna River', 'node', 'kuskokwim river holitna river', 1),
+            ('river', 'Kuskokwim River; Holitna River', 'node', 'kuskokwim river holitna river', 1),
+            ('negro', 'Río Negro', 'reach', 'rio negro', 2),
+            ('rio', 'Río Negro', 'reach', 'rio negro', 2),
+            ('coyote', 'Coyote', 'region', 'coyote', 1),
+        ], [tuple(row) for row in rows])
@@ -0,0 +1,154 @@
+"""
+==============
+test_shared_cache.py
+==============
+
+Test the result cache tier shared between Lambda instances
+"""
+
+import json
+import os
+from unittest.mock import patch
+
+import pytest
+
+from fts.api.controllers.result_cache import DatasetVersion
+from fts.api.controllers.shared_cache import (COMPRESSED, RAW, InMemoryBackend, NegativeResult, SharedCache,
+                                              create_backend)
+
+
+@pytest.fixture(scope='function', autouse=True)
+def db_environs():
+    """Make sure no real values are in the database env vars"""
+    os.environ['DB_HOST'] = "foo"
+    os.environ['DB_NAME'] = "foo"
+    os.environ['DB_USERNAME'] = "foo"
+    os.environ['DB_PASSWORD'] = "foo"
+
+
+class FailingBackend:
+    """Backend whose server is unreachable"""
+    def get(self, key):
+        raise ConnectionError('unreachable')
+
+    def set(self, key, value, ttl):
+        raise ConnectionError('unreachable')
+
+
+def test_round_trip_compressed():
+    """
+    Large responses are stored compressed and come back unchanged
+    """
+    backend = InMemoryBackend()
+    cache = SharedCache(backend, compress_min_bytes=100)
+    response = {'status': '200 OK', 'results': [{'river_name': 'Ohio River'}] * 50}
+    body = json.dumps(response).encode('utf-8')
+
+    cache.put(('name', 'Ohio'), 'sword=1', body)
+
+    payload = backend.get(cache.make_key(('name', 'Ohio'), 'sword=1'))
+    assert payload.startswith(COMPRESSED)
+    assert len(payload) < len(body)
+    assert cache.get(('name', 'Ohio'), 'sword=1') == body
+    assert cache.get(('name', 'Ohio'), 'sword=2') is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_negative_caching():
+    """
+    404 results are cached as NegativeResult
+    """
+    cache = SharedCache(create_backend('memory://'))
+    cache.put_not_found(('HUC', '99'), None, '404: Results with the specified HUC 99 were not found.')
+
+    result = cache.get(('HUC', '99'), None)
+    assert isinstance(result, NegativeResult)
+    assert result.message.startswith('404')
+    assert cache.stats()['negative_hits'] == 1
+
+
+def test_backend_errors_are_misses():
+    """
+    An unreachable server never fails the request
+    """
+    cache = SharedCache(FailingBackend())
+    cache.put(('HUC', '18'), None, b'{}')
+    assert cache.get(('HUC', '18'), None) is None
+    assert cache.stats()['errors'] == 2
+
+
+def test_undecodable_values_are_misses():
+    """
+    Truncated or foreign values under a key are counted as errors and missed
+    """
+    backend = InMemoryBackend()
+    cache = SharedCache(backend)
+    for index, payload in enumerate([COMPRESSED + b'not zlib', RAW + b'{"status": "200', b'\x00foreign']):
+        backend.set(cache.make_key(('HUC', str(index)), None), payload, 60)
+        assert cache.get(('HUC', str(index)), None) is None
+    assert cache.stats()['errors'] == 3
+    assert cache.stats()['hits'] == 0
+
+
+@patch('pymysql.connect')
+def test_lambda_handler_uses_shared_cache(mock_connect):
+    """
+    A cold instance answers from the shared cache what another instance
+    already queried, including 404 results
+    """
+    import fts.api.controllers.fts_controller as controller
+    controller.connections.close()
+
+    huc_row = ['1804', 'San Joaquin', '1,2,3,4,5,6', '1,2,3,4,5,6', '1,2,3,4']
+    cur = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    cur.fetchall.side_effect = [[('huc', '1')], [(1,)], [huc_row], [(0,)], []]
+
+    controller.shared_cache = SharedCache(InMemoryBackend())
+    controller.result_cache.clear()
+    controller.dataset_version = DatasetVersion(check_interval=60)
+
+    first = controller.lambda_handler({'body': {'HUC': '1804', 'exact': 'true'}}, None)
+    with pytest.raises(controller.RequestError, match='404'):
+        controller.lambda_handler({'body': {'HUC': '99', 'exact': 'true'}}, None)
+    executed = cur.execute.call_count
+
+    # Another instance: empty in-process cache
+    controller.result_cache.clear()
+    second = controller.lambda_handler({'body': {'HUC': '1804', 'exact': 'true'}}, None)
+    with pytest.raises(controller.RequestError, match='404'):
+        controller.lambda_handler({'body': {'HUC': '99', 'exact': 'true'}}, None)
+
+    assert cur.execute.call_count == executed
+    assert json.loads(second)['results'] == json.loads(first)['results']
+    assert controller.shared_cache.stats()['hits'] == 1
+    assert controller.shared_cache.stats()['negative_hits'] == 1
+
+    controller.shared_cache = SharedCache()
+
+
+@patch('pymysql.connect')
+def test_lambda_handler_does_not_cache_ndjson_not_found(mock_connect):
+    """
+    NDJSON requests are not cached, so their 404 results are not stored
+    either
+    """
+    import fts.api.controllers.fts_controller as controller
+    controller.connections.close()
+
+    cur = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    cur.fetchall.side_effect = [[('huc', '1')], [(0,)]]
+    cur.fetchmany.side_effect = [[]]
+
+    backend = InMemoryBackend()
+    controller.shared_cache = SharedCache(backend)
+    controller.result_cache.clear()
+    controller.dataset_version = DatasetVersion(check_interval=60)
+
+    with patch.object(backend, 'set', wraps=backend.set) as stored:
+        with pytest.raises(controller.RequestError, match='404'):
+            controller.lambda_handler({'body': {'HUC': '99', 'exact': 'true', 'format': 'ndjson'}}, None)
+
+    assert not stored.called
+
+    controller.shared_cache = SharedCache()
@@ -0,0 +1,236 @@
+"""
+==============
+test_snapshot_backend.py
+==============
+
+Test the SQLite snapshot builder and serving the API from a snapshot
+"""
+
+import json
+import os
+import sqlite3
+from unittest.mock import MagicMock, patch
+
+import pymysql
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text as text_query
+
+from fts.api.controllers.db_connection import ConnectionManager
+from fts.api.controllers.snapshot_backend import SnapshotConnections
+from fts.db.build_snapshot import build_snapshot
+
+
+@pytest.fixture(scope='function', autouse=True)
+def db_environs():
+    """Make sure no real values are in the database env vars"""
+    os.environ['DB_HOST'] = "foo"
+    os.environ['DB_NAME'] = "foo"
+    os.environ['DB_USERNAME'] = "foo"
+    os.environ['DB_PASSWORD'] = "foo"
+
+
+@pytest.fixture(name='snapshot')
+def snapshot_fixture(tmp_path):
+    """A snapshot built from a small source database"""
+    source = create_engine(f"sqlite:///{tmp_path / 'source.sqlite'}")
+    with source.begin() as conn:
+        conn.execute(text_query(
+            "CREATE TABLE huc_table (HUC VARCHAR(50), Region VARCHAR(500), `Polygon Convex Hull` TEXT,"
+            " `Polygon Visvalingam` TEXT, `Bounding Box` VARCHAR(255), `GeoJSON Convex Hull` TEXT,"
+            " `GeoJSON Visvalingam` TEXT, `GeoJSON Bounding Box` TEXT, huc_level TINYINT)"))
+        for huc in ('18', '1804', '180400', '18040001'):
+            conn.execute(text_query(
+                "INSERT INTO huc_table VALUES (:huc, 'San Joaquin', '', '', '-120,37,-119,38', NULL, NULL, NULL, :level)"),
+                {'huc': huc, 'level': len(huc)})
+        conn.execute(text_query(
+            "CREATE TABLE reaches (reach_id VARCHAR(11), river_name TEXT, width FLOAT, geometry TEXT, geojson TEXT)"))
+        conn.execute(text_query(
+            "CREATE TABLE nodes (node_id VARCHAR(14), reach_id VARCHAR(11), river_name TEXT, geometry TEXT, geojson TEXT)"))
+        for i in range(3):
+            conn.execute(text_query("INSERT INTO reaches VALUES (:id, 'Loire', 120.0, :wkt, :geojson)"), {
+                'id': f'2311000000{i}', 'wkt': f'LINESTRING ({i} 47, {i + 0.5} 47.5)',
+                'geojson': f'{{"type": "LineString", "coordinates": [[{i}, 47], [{i + 0.5}, 47.5]]}}'})
+            conn.execute(text_query("INSERT INTO nodes VALUES (:id, :reach, 'Loire', :wkt, :geojson)"), {
+                'id': f'2311000000{i}001', 'reach': f'2311000000{i}', 'wkt': f'POINT ({i} 47)',
+                'geojson': f'{{"type": "Point", "coordinates": [{i}, 47]}}'})
+        conn.execute(text_query(
+            "CREATE TABLE name_index (token VARCHAR(64), name TEXT, name_type VARCHAR(16), folded TEXT, hits INTEGER)"))
+        conn.execute(text_query("INSERT INTO name_index VALUES ('loire', 'Loire', 'reach', 'loire', 3)"))
+
+    path = str(tmp_path / 'fts_snapshot.sqlite')
+    assert build_snapshot(source, path) == {'huc_table': 4, 'reaches': 3, 'nodes': 3, 'name_index': 1}
+    connections = SnapshotConnections(path)
+    yield connections
+    connections.close()
+
+
+def test_build_snapshot(snapshot):
+    """
+    The snapshot has the indexes of the API's queries, WKB geometries and id numbers
+    """
+    with snapshot.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+        indexes = {row[0] for row in cur.fetchall()}
+        cur.execute("SELECT reach_num, geom FROM reaches ORDER BY reach_id LIMIT %s", 1)
+        reach_num, geom = cur.fetchone()
+        cur.execute("EXPLAIN QUERY PLAN SELECT * FROM nodes WHERE node_id = %s", "23110000001001")
+        plan = ' '.join(str(row[-1]) for row in cur.fetchall())
+
+    assert {'huc_table_huc_level_huc_idx', 'reaches_reach_num_idx', 'nodes_reach_id_idx',
+            'name_index_token_name_type_idx', 'fts_metadata_dataset_idx'} - indexes == set()
+    assert reach_num == 23110000000
+    assert isinstance(geom, bytes)
+    assert "nodes_node_id_idx" in plan
+
+
+def test_spatial_index(snapshot):
+    """
+    Spatial queries are prefiltered with the R*Tree of the bounding boxes,
+    so only the rows whose box intersects the area are read as geometries
+    """
+    from fts.api.controllers import snapshot_backend
+
+    query = ("SELECT reach_id FROM reaches WHERE MBRIntersects(`geom`, ST_GeomFromText(%s))"
+             " AND river_name LIKE %s ORDER BY reach_id")
+    with snapshot.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT id, min_x, max_x FROM reaches_geom_rtree ORDER BY id")
+        assert cur.fetchall() == [(23110000000, 0.0, 0.5), (23110000001, 1.0, 1.5), (23110000002, 2.0, 2.5)]
+
+        with patch.object(snapshot_backend, '_row_geometry', wraps=snapshot_backend._row_geometry) as geometry:
+            cur.execute(query, ('POLYGON ((1.2 46, 1.8 46, 1.8 48, 1.2 48, 1.2 46))', 'Loi%'))
+            assert cur.fetchall() == [('23110000001',)]
+        assert geometry.call_count == 1
+
+        cur.execute("EXPLAIN QUERY PLAN " + query, ('POINT (9 9)', '%'))
+        plan = ' '.join(str(row[-1]) for row in cur.fetchall())
+    assert 'reaches_geom_rtree' in plan
+
+    with pytest.raises(sqlite3.OperationalError):
+        with snapshot.connection() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM reaches")
+
+
+@patch('pymysql.connect')
+def test_snapshot_requests(db_environs, snapshot):
+    """
+    The API's queries run unchanged on the snapshot
+    """
+    import fts.api.controllers.fts_controller as controller
+
+    def request(body):
+        with snapshot.connection() as conn, conn.cursor() as cur:
+            return controller.handle_request({'body': body}, cur)
+
+    response = request({'HUC': '1804', 'level': '', 'fields': 'bbox'})
+    assert [result['HUC'] for result in response['results']] == ['1804', '180400', '18040001']
+
+    response = request({'region': 'san%20joaquin', 'exact': 'true', 'level': '4', 'fields': 'bbox'})
+    assert response['hits'] == 1
+
+    # Exact matches are paged and counted like prefix matches
+    pages = [request({'region': 'san%20joaquin', 'exact': 'true', 'level': '', 'page_size': '1', 'page_number': page})
+             for page in ('1', '2')]
+    assert [page['hits'] for page in pages] == [4, 4]
+    assert [result['HUC'] for page in pages for result in page['results']] == ['18', '1804']
+    response = request({'region': 'san%20joaquin', 'exact': 'true', 'level': '', 'count_only': 'true'})
+    assert response['hits'] == 4
+    with pytest.raises(controller.RequestError, match='404'):
+        request({'HUC': '1804', 'exact': 'true', 'level': '', 'page_size': '1', 'page_number': '2'})
+
+    # The HUC and region counts are lower case select queries
+    response = request({'HUC': '18', 'level': '', 'count': 'estimate'})
+    assert response['hits'] == 4
+    response = request({'region': 'san', 'level': '', 'count': 'estimate', 'count_only': 'true'})
+    assert response['hits'] == 4
+
+    response = request({'reach': '231100', 'river_name': '', 'count': 'estimate'})
+    assert response['hits'] == 3
+    assert [result['reach_id'] for result in response['results']] == ['23110000000', '23110000001', '23110000002']
+
+    response = request({'name': 'LOIRE', 'exact': 'true'})
+    assert response['hits'] == 3
+    assert {result['node_id'] for result in response['results']} == {'23110000000001', '23110000001001', '23110000002001'}
+
+    response = request({'search': 'names', 'q': 'Loi'})
+    assert response['results'] == [{'name': 'Loire', 'type': 'reach', 'hits': 3}]
+
+    response = request({'spatial': 'node', 'bbox': '0.5,46,2.5,48', 'river_name': ''})
+    assert [result['node_id'] for result in response['results']] == ['23110000001001', '23110000002001']
+
+    assert snapshot.stats()['connects'] == 1
+
+
+def test_parallel_count(db_environs, snapshot):
+    """
+    With PARALLEL_COUNT the hits are counted on a second pooled connection,
+    and the responses are the same as counting first on the request's own
+    """
+    import fts.api.controllers.fts_controller as controller
+
+    def open_snapshot(**_):
+        # A connection of its own to the snapshot for each pooled connection
+        with SnapshotConnections(snapshot.location).connection() as conn:
+            return conn
+
+    requests = [
+        {'HUC': '18', 'level': ''},
+        {'region': 'san', 'level': ''},
+        {'reach': '231100', 'river_name': ''},
+        {'node': '2311000000', 'river_name': '', 'count': 'estimate'},
+        {'name': 'Loire'},
+        {'name': 'Loire', 'count_only': 'true'},
+        {'spatial': 'reach', 'bbox': '0.5,46,2.5,48', 'river_name': ''},
+    ]
+
+    def responses(parallel):
+        manager = ConnectionManager('host', 'user', 'pass', 'db', max_connections=2)
+        answered = []
+        with patch('pymysql.connect', side_effect=open_snapshot), \
+                patch.object(controller, 'connections', manager), \
+                patch.object(controller, 'PARALLEL_COUNT', parallel):
+            for body in requests:
+                with manager.connection() as conn, conn.cursor() as cur:
+                    response = controller.handle_request({'body': dict(body)}, cur)
+                answered.append({key: value for key, value in response.items() if key != 'time'})
+        return answered, manager.stats()
+
+    serial, serial_stats = responses(False)
+    parallel, parallel_stats = responses(True)
+
+    assert parallel == serial
+    assert [response['hits'] for response in parallel] == [4, 4, 3, 3, 3, 3, 3]
+    assert serial_stats['connects'] == 1
+    assert parallel_stats['connects'] == 2
+
+
+def test_parallel_count_worker_fails(db_environs, snapshot):
+    """
+    A lost connection of the parallel count only drops the worker's
+    connection: the request is retried on its own connection, which is
+    kept, with the count on a new worker connection
+    """
+    import fts.api.controllers.fts_controller as controller
+    from fts.api.controllers.request_metrics import RequestTimer
+
+    def open_snapshot():
+        with SnapshotConnections(snapshot.location).connection() as conn:
+            return conn
+
+    lost = MagicMock()
+    lost.cursor.return_value.__enter__.return_value.execute.side_effect = \
+        pymysql.OperationalError(2013, 'Lost connection to MySQL server during query')
+
+    manager = ConnectionManager('host', 'user', 'pass', 'db', max_connections=2)
+    event = {'body': {'name': 'Loire', 'exact': 'false', 'page_number': '1', 'page_size': '100'}}
+    with patch('pymysql.connect', side_effect=[open_snapshot(), lost, open_snapshot()]), \
+            patch.object(controller, 'connections', manager), \
+            patch.object(controller, 'PARALLEL_COUNT', True), \
+            patch.object(controller.dataset_version, 'is_stale', return_value=False):
+        response = json.loads(controller.get_response(event, 0, RequestTimer(0)))
+
+    assert response['hits'] == 3
+    assert lost.close.called
+    stats = manager.stats()
+    assert stats['connects'] == 3
+    assert stats['open_connections'] == 2